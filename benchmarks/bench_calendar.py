@@ -0,0 +1,61 @@
+"""
+Бенчмарк клавиатуры календаря бронирования.
+
+Сравнивает построение календаря заново (create_month_calendar + копирование рядов
+с кнопкой "В главное меню", как было в start_reservation) с выдачей из кэша
+get_reservation_calendar.
+
+Запуск: python benchmarks/bench_calendar.py [число_повторов]
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+os.environ.setdefault("BOT_TOKEN", "123456:bench")
+os.environ.setdefault("ADMIN_CHAT_ID", "-1000000000000")
+os.chdir(tempfile.mkdtemp(prefix="botbao-bench-")) # Файлы данных создаются во временной папке
+
+import botbao
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+
+def build_uncached(year, month, min_date):
+    calendar_markup = botbao.create_month_calendar(year, month, min_date=min_date)
+    rows = list(calendar_markup.inline_keyboard)
+    rows.append([InlineKeyboardButton("🔙 В главное меню", callback_data="start")])
+    return InlineKeyboardMarkup(rows)
+
+
+def main():
+    number = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    today = botbao.moscow_today()
+    # Типичная нагрузка: открытие календаря и перелистывание на пару месяцев вперед
+    months = [(today.year, today.month)]
+    for _ in range(2):
+        year, month = months[-1]
+        months.append((year + month // 12, month % 12 + 1))
+
+    def run_uncached():
+        for year, month in months:
+            build_uncached(year, month, today)
+
+    def run_cached():
+        for year, month in months:
+            botbao.get_reservation_calendar(year, month, today)
+
+    # Кэш должен отдавать ту же клавиатуру, что и построение заново
+    assert botbao.get_reservation_calendar(*months[0], today) == build_uncached(*months[0], today)
+
+    uncached = min(timeit.repeat(run_uncached, number=number, repeat=3))
+    cached = min(timeit.repeat(run_cached, number=number, repeat=3))
+    calls = number * len(months)
+    print(f"Без кэша: {uncached / calls * 1e6:8.1f} мкс на календарь")
+    print(f"С кэшем:  {cached / calls * 1e6:8.1f} мкс на календарь")
+    print(f"Ускорение: x{uncached / cached:.1f}")
+
+
+if __name__ == "__main__":
+    main()
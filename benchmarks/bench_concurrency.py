@@ -0,0 +1,172 @@
+"""
+Проверка параллельной обработки обновлений (ChatOrderedUpdateProcessor).
+
+Собирает Application через build_application с офлайн-слоем Bot API, у которого
+каждый вызов занимает --latency-ms, и кладет в update_queue вперемешку обновления
+многих гостей (шаг 1 всех гостей, затем шаг 2 и т.д.) - так же, как их отдает
+getUpdates под нагрузкой. Сценарии: бронирование, меню, живой чат.
+
+Проверяется:
+  - обновления одного чата начинаются строго в порядке поступления;
+  - в одном чате никогда не обрабатываются два обновления одновременно;
+  - все диалоги дошли до конца: каждая бронь пришла в админ-чат, каждый живой чат закрыт
+    (при нарушении порядка ConversationHandler потерял бы шаги);
+  - пропускная способность при UPDATE_CONCURRENCY=1 (последовательно) и при заданных значениях.
+
+Каждое значение UPDATE_CONCURRENCY прогоняется в отдельном процессе с чистой папкой данных.
+При нарушении порядка скрипт завершается с кодом 1.
+
+Запуск:
+  python benchmarks/bench_concurrency.py [--users 60] [--latency-ms 20] [--concurrency 1 8 32]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+FLOWS = ("reservation", "menu", "live_chat")
+
+
+async def run_one(args):
+    """Один прогон в текущем процессе; возвращает словарь с результатами."""
+    os.environ["UPDATE_CONCURRENCY"] = str(args.run_one)
+    os.environ["LIVE_CHAT_COALESCE_SECONDS"] = "0" # Склейка сообщений живого чата не влияет на порядок
+    from bench_flows import UpdateFactory, build_flows, percentile, seed_data
+    from tools.offline_bot import OfflineRequest, import_botbao, start_application, stop_application
+
+    botbao = import_botbao(tempfile.mkdtemp(prefix="botbao-bench-concurrency-"))
+    logging.getLogger().setLevel(logging.WARNING)
+    seed_data(botbao, users=100, messages=0)
+
+    request = OfflineRequest(latency=args.latency_ms / 1000)
+    application = botbao.build_application(request=request, get_updates_request=OfflineRequest())
+    processor = application.update_processor
+
+    enqueued_at = {} # update_id -> время постановки в очередь
+    finished_at = {}
+    started_order = {} # chat_id -> [update_id в порядке начала обработки]
+    in_flight = {} # chat_id -> сколько обновлений чата обрабатывается прямо сейчас
+    overlaps = []
+
+    async def traced(update, coroutine):
+        chat_id = processor.ordering_key(update)
+        started_order.setdefault(chat_id, []).append(update.update_id)
+        in_flight[chat_id] = in_flight.get(chat_id, 0) + 1
+        if in_flight[chat_id] > 1:
+            overlaps.append((chat_id, update.update_id))
+        try:
+            await coroutine
+        finally:
+            in_flight[chat_id] -= 1
+            finished_at[update.update_id] = time.perf_counter()
+
+    # Обертка внутри процессора: фиксируется момент, когда обновление действительно начало обрабатываться
+    process_update = processor.do_process_update
+    processor.do_process_update = lambda update, coroutine: process_update(update, traced(update, coroutine))
+
+    await start_application(application)
+    try:
+        flows = build_flows(UpdateFactory(application.bot), botbao)
+        per_user = []
+        for i in range(args.users):
+            flow = FLOWS[i % len(FLOWS)]
+            per_user.append((flow, flows[flow](botbao_user(i))))
+        expected = {chat: [u.update_id for u in updates] for chat, updates in
+                    ((updates[0].effective_chat.id, updates) for _, updates in per_user)}
+
+        # Вперемешку: шаг 1 всех гостей, затем шаг 2 и т.д.
+        interleaved = [updates[step] for step in range(max(len(u) for _, u in per_user))
+                       for _, updates in per_user if step < len(updates)]
+        with contextlib.redirect_stdout(io.StringIO()): # Отладочные print в обработчиках
+            started = time.perf_counter()
+            for update in interleaved:
+                enqueued_at[update.update_id] = time.perf_counter()
+                await application.update_queue.put(update)
+            await application.update_queue.join()
+            elapsed = time.perf_counter() - started
+    finally:
+        with contextlib.redirect_stdout(io.StringIO()): # Остановка дожидается отправки очереди админ-чата
+            await stop_application(application)
+
+    reservations_expected = sum(1 for flow, _ in per_user if flow == "reservation")
+    reservations_sent = sum(1 for method, params in request.calls
+                            if method == "sendMessage" and str(params.get("chat_id")) == str(botbao.ADMIN_CHAT_ID)
+                            and "бронирование" in str(params.get("text", "")).lower())
+    live_chats_left = sum(1 for state in botbao.user_states_data.values() if state.get("state") == "chat_active")
+    out_of_order = [chat for chat, order in started_order.items() if order != expected.get(chat)]
+    latencies = sorted(finished_at[uid] - enqueued_at[uid] for uid in finished_at if uid in enqueued_at)
+    return {
+        "concurrency": application.concurrent_updates,
+        "updates": len(interleaved),
+        "seconds": round(elapsed, 3),
+        "updates_per_sec": round(len(interleaved) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 1),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 1),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 1) if latencies else 0.0,
+        "out_of_order_chats": len(out_of_order),
+        "overlaps": len(overlaps),
+        "reservations": f"{reservations_sent}/{reservations_expected}",
+        "reservations_ok": reservations_sent == reservations_expected,
+        "live_chats_left_open": live_chats_left,
+    }
+
+
+def botbao_user(index):
+    return 700_000_000 + index
+
+
+def run_child(value, args):
+    command = [sys.executable, os.path.abspath(__file__), "--run-one", str(value),
+               "--users", str(args.users), "--latency-ms", str(args.latency_ms)]
+    output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=60, help="сколько гостей одновременно проходят сценарии")
+    parser.add_argument("--latency-ms", type=float, default=20.0, help="задержка каждого вызова Bot API, мс")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32],
+                        help="значения UPDATE_CONCURRENCY для сравнения")
+    parser.add_argument("--run-one", type=int, help=argparse.SUPPRESS) # Внутренний режим: один прогон в дочернем процессе
+    args = parser.parse_args()
+
+    if args.run_one is not None:
+        print(json.dumps(asyncio.run(run_one(args)), ensure_ascii=False))
+        return
+
+    print(f"Гостей {args.users}, сценарии {', '.join(FLOWS)}, задержка Bot API {args.latency_ms} мс")
+    print(f"{'параллельно':>11} {'обн.':>6} {'обн./с':>9} {'p50, мс':>9} {'p95, мс':>9} "
+          f"{'порядок':>8} {'наложения':>10} {'брони':>8} {'чаты открыты':>13}")
+    failed = False
+    baseline = None
+    for value in args.concurrency:
+        row = run_child(value, args)
+        baseline = baseline or row["updates_per_sec"]
+        ok = row["out_of_order_chats"] == 0 and row["overlaps"] == 0 and row["reservations_ok"] \
+            and row["live_chats_left_open"] == 0
+        failed = failed or not ok
+        print(f"{row['concurrency']:>11} {row['updates']:>6} {row['updates_per_sec']:>9} {row['p50_ms']:>9} "
+              f"{row['p95_ms']:>9} {'OK' if row['out_of_order_chats'] == 0 else row['out_of_order_chats']:>8} "
+              f"{row['overlaps']:>10} {row['reservations']:>8} {row['live_chats_left_open']:>13}"
+              f"   x{row['updates_per_sec'] / baseline:.1f}")
+    if failed:
+        print("ОШИБКА: нарушен порядок обработки или диалоги не дошли до конца")
+        sys.exit(1)
+    print("OK: порядок внутри чатов сохранен, все диалоги завершены")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+"""
+Бенчмарк основных сценариев бота на настоящих обработчиках без сети.
+
+Собирает тот же Application, что и main() (build_application), но с офлайн-слоем
+Bot API (tools/offline_bot.OfflineRequest), и прогоняет через process_update
+синтетические обновления по сценариям:
+  start        - /start
+  menu         - категории меню и возврат
+  faq          - вопросы FAQ
+  reservation  - мастер бронирования от календаря до подтверждения
+  review_media - отзыв с фото
+  problem_media- проблема с видео
+  live_chat    - чат поддержки: текст, фото, завершение
+
+Перед запуском данные заполняются в реалистичном объеме (по умолчанию 20 000
+пользователей и 100 000 сообщений в журнале). Для каждого сценария печатаются
+обновлений/с и p50/p95/p99 задержки одного обновления; результат сохраняется в
+benchmarks/results/flows-<коммит>-<хранилище>.json для сравнения между коммитами.
+
+Запуск:
+  python benchmarks/bench_flows.py [--users-per-flow 200] [--backend json|sqlite]
+                                   [--seed-users 20000] [--seed-messages 100000]
+                                   [--compare benchmarks/results/flows-<коммит>-json.json]
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(REPO_DIR, "benchmarks", "results")
+sys.path.insert(0, REPO_DIR)
+
+# Лимиты очереди админ-чата рассчитаны на настоящий Telegram; в бенчмарке они только мешают
+os.environ.setdefault("OUTBOX_GLOBAL_RATE", "1000000000")
+os.environ.setdefault("OUTBOX_CHAT_RATE_PER_MINUTE", "1000000000")
+os.environ.setdefault("OUTBOX_CHAT_BURST", "1000000000")
+os.environ.setdefault("RESERVATION_TABLES_PER_SLOT", "1000000000") # Все гости бронируют один и тот же слот
+
+from telegram import Update
+
+from tools.offline_bot import BOT_USER, OfflineRequest, import_botbao, start_application, stop_application
+
+FIRST_USER_ID = 500_000_000
+
+
+def seed_data(botbao, users: int, messages: int):
+    """Заполняет data/ пользователями, журналом сообщений, меню и FAQ."""
+    os.makedirs(botbao.MESSAGES_JOURNAL_DIR, exist_ok=True)
+    now = datetime.now()
+    registry = {}
+    for i in range(users):
+        user_id = 100_000_000 + i
+        seen = (now - timedelta(days=i % 365)).isoformat()
+        registry[str(user_id)] = {
+            "telegram_id": user_id, "username": f"guest{i}", "first_name": f"Гость {i}", "last_name": None,
+            "profile_link": f"@guest{i}", "first_seen": seen, "last_seen": seen,
+        }
+    with open(botbao.USERS_FILE, "w", encoding="utf-8") as f:
+        json.dump(registry, f, ensure_ascii=False, indent=4)
+
+    per_day = 1000
+    for day_index in range(0, messages, per_day):
+        day = (now - timedelta(days=day_index // per_day + 1)).date()
+        with open(os.path.join(botbao.MESSAGES_JOURNAL_DIR, f"messages-{day.isoformat()}.jsonl"), "w", encoding="utf-8") as f:
+            for i in range(day_index, min(day_index + per_day, messages)):
+                user_id = 100_000_000 + i % max(users, 1)
+                f.write(json.dumps({
+                    "message_id": i, "user_id": user_id, "username": f"guest{i % max(users, 1)}",
+                    "text": "Здравствуйте! Подскажите, пожалуйста, есть ли свободные столы на вечер?",
+                    "timestamp": f"{day.isoformat()}T12:00:00", "chat_id": user_id,
+                }, ensure_ascii=False) + "\n")
+
+    menu = {
+        f"Категория {c}": [
+            {"name": f"Блюдо {c}.{i}", "description": "Рис, овощи, соус терияки (300 г)", "price": 450 + 10 * i}
+            for i in range(12)
+        ]
+        for c in range(8)
+    }
+    faq = {"Вопросы": [{"question": f"Вопрос {i}?", "answer": f"Ответ на вопрос {i}: *да*, конечно."} for i in range(15)]}
+    for filepath, data in ((botbao.MENU_FILE, menu), (botbao.FAQ_FILE, faq)):
+        with open(filepath, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=4)
+
+
+class UpdateFactory:
+    """Собирает объекты Update так же, как их присылает Telegram."""
+
+    def __init__(self, bot):
+        self.bot = bot
+        self._ids = iter(range(1, 10 ** 12))
+
+    def _user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"Гость {user_id}", "username": f"u{user_id}"}
+
+    def message(self, user_id, text=None, **extra):
+        message = {"message_id": next(self._ids), "date": int(time.time()),
+                   "chat": {"id": user_id, "type": "private"}, "from": self._user(user_id)}
+        if text is not None:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        message.update(extra)
+        return Update.de_json({"update_id": next(self._ids), "message": message}, self.bot)
+
+    def callback(self, user_id, data):
+        query = {
+            "id": str(next(self._ids)), "chat_instance": "bench", "data": data, "from": self._user(user_id),
+            "message": {"message_id": next(self._ids), "date": int(time.time()),
+                        "chat": {"id": user_id, "type": "private"}, "from": BOT_USER, "text": "..."},
+        }
+        return Update.de_json({"update_id": next(self._ids), "callback_query": query}, self.bot)
+
+    @staticmethod
+    def photo(file_id="bench-photo"):
+        return {"photo": [{"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 960}]}
+
+    @staticmethod
+    def video(file_id="bench-video"):
+        return {"video": {"file_id": file_id, "file_unique_id": file_id, "width": 1280, "height": 720, "duration": 12}}
+
+
+def build_flows(factory: UpdateFactory, botbao):
+    """Сценарии: имя -> функция, возвращающая список обновлений для одного гостя."""
+    menu_version = botbao.menu_snapshots.current.version
+    faq_version = botbao.faq_snapshots.current.version
+    reservation_day = (botbao.moscow_today() + timedelta(days=3)).isoformat()
+    reservation_time = botbao.SLOT_LABELS[len(botbao.SLOT_LABELS) // 2]
+    f = factory
+    return {
+        "start": lambda u: [f.message(u, "/start")],
+        "menu": lambda u: [f.callback(u, "menu"), f.callback(u, f"menu_cat_{menu_version}_0"), f.callback(u, "menu"),
+                           f.callback(u, f"menu_cat_{menu_version}_5"), f.callback(u, "start")],
+        "faq": lambda u: [f.callback(u, "faq"), f.callback(u, f"faq_q_{faq_version}_0"), f.callback(u, "faq"),
+                          f.callback(u, f"faq_q_{faq_version}_7"), f.callback(u, "start")],
+        "reservation": lambda u: [
+            f.callback(u, "start_reservation"), f.callback(u, f"date_{reservation_day}"),
+            f.callback(u, f"time_{reservation_time}"), f.message(u, "4"), f.message(u, "Анна"),
+            f.message(u, "+79991234567"), f.message(u, "нет пожеланий"), f.callback(u, "confirm_reserve"),
+        ],
+        "review_media": lambda u: [f.callback(u, "start_review"),
+                                   f.message(u, caption="Очень вкусно, спасибо!", **f.photo())],
+        "problem_media": lambda u: [f.callback(u, "start_problem"),
+                                    f.message(u, caption="Долго несли заказ", **f.video())],
+        "live_chat": lambda u: [
+            f.callback(u, "support"), f.message(u, "Здравствуйте!"), f.message(u, "Можно забронировать на 8 человек?"),
+            f.message(u, "И будет ли живая музыка?"), f.message(u, caption="Вот наш прошлый стол", **f.photo()),
+            f.callback(u, "end_chat"),
+        ],
+    }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+async def run_flows(application, flows, users_per_flow):
+    results = {}
+    next_user = FIRST_USER_ID
+    for name, make_updates in flows.items():
+        # Обновления готовятся заранее: в замер попадает только обработка
+        batches = [make_updates(next_user + i) for i in range(users_per_flow)]
+        next_user += users_per_flow
+        latencies = []
+        started = time.perf_counter()
+        for updates in batches:
+            for update in updates:
+                update_started = time.perf_counter()
+                await application.process_update(update)
+                latencies.append(time.perf_counter() - update_started)
+        total = time.perf_counter() - started
+        latencies.sort()
+        results[name] = {
+            "updates": len(latencies),
+            "updates_per_sec": round(len(latencies) / total, 1),
+            "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+            "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+            "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+            "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        }
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def print_results(results, baseline=None):
+    header = f"{'сценарий':14} {'обн.':>6} {'обн./с':>10} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9}"
+    if baseline:
+        header += f" {'обн./с к базе':>14}"
+    print(header)
+    for name, row in results.items():
+        line = (f"{name:14} {row['updates']:>6} {row['updates_per_sec']:>10} "
+                f"{row['p50_ms']:>9} {row['p95_ms']:>9} {row['p99_ms']:>9}")
+        base = (baseline or {}).get(name)
+        if base:
+            line += f" {(row['updates_per_sec'] / base['updates_per_sec'] - 1) * 100:>+13.1f}%"
+        print(line)
+
+
+async def main_async(args):
+    data_dir = tempfile.mkdtemp(prefix="botbao-bench-flows-")
+    os.environ["STORAGE_BACKEND"] = args.backend
+    botbao = import_botbao(data_dir)
+    logging.getLogger().setLevel(logging.WARNING) # Журнал INFO на каждое сообщение исказил бы замер
+
+    seed_started = time.perf_counter()
+    seed_data(botbao, args.seed_users, args.seed_messages)
+    if args.backend == "sqlite":
+        botbao.migrate_json_to_sqlite()
+    print(f"Данные: {args.seed_users} пользователей, {args.seed_messages} сообщений, хранилище {args.backend} "
+          f"(подготовка {time.perf_counter() - seed_started:.1f} с)")
+
+    request = OfflineRequest()
+    application = botbao.build_application(request=request, get_updates_request=OfflineRequest())
+    await start_application(application)
+    try:
+        flows = build_flows(UpdateFactory(application.bot), botbao)
+        if args.flows:
+            flows = {name: flows[name] for name in args.flows}
+        with contextlib.redirect_stdout(io.StringIO()): # Отладочные print в обработчиках
+            results = await run_flows(application, flows, args.users_per_flow)
+    finally:
+        await stop_application(application)
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "backend": args.backend,
+        "users_per_flow": args.users_per_flow,
+        "seed": {"users": args.seed_users, "messages": args.seed_messages},
+        "bot_api_calls": len(request.calls),
+        "flows": results,
+    }
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)["flows"]
+    print_results(results, baseline)
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    output = args.output or os.path.join(RESULTS_DIR, f"flows-{report['commit']}-{args.backend}.json")
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результат сохранен: {output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users-per-flow", type=int, default=200, help="сколько гостей проходит каждый сценарий")
+    parser.add_argument("--backend", choices=("json", "sqlite"), default="json")
+    parser.add_argument("--seed-users", type=int, default=20_000)
+    parser.add_argument("--seed-messages", type=int, default=100_000)
+    parser.add_argument("--flows", nargs="+", help="запустить только указанные сценарии")
+    parser.add_argument("--compare", help="файл результата другого коммита для сравнения")
+    parser.add_argument("--output", help="куда сохранить результат (по умолчанию benchmarks/results/)")
+    asyncio.run(main_async(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
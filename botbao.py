@@ -1,44 +1,129 @@
-﻿import calendar
-from email import message
+﻿import time as _time
+_MODULE_IMPORT_STARTED = _time.perf_counter() # Для измерения времени запуска (см. STARTUP_METRICS_FILE)
+
+import asyncio
+import calendar
+import contextlib
+import cProfile
+import functools
+import hashlib
+import hmac
+import heapq
+import inspect
+import io
+import itertools
+from bisect import bisect_left
 import logging
 import json
 import os
+import pstats
+import random
 import threading
 import re
-from socket import fromfd
-from xml.dom.minidom import NamedNodeMap
-from dotenv import load_dotenv; load_dotenv()
+import secrets
+import signal
+import sqlite3
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
 load_dotenv()
 from datetime import datetime, timedelta, date, time 
-from telegram import MessageId, Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ConversationHandler, ContextTypes, filters
+    Application, BasePersistence, BaseUpdateProcessor, CommandHandler, MessageHandler, CallbackQueryHandler,
+    ConversationHandler, ContextTypes, PersistenceInput, TypeHandler, filters
 )
-from telegram.error import BadRequest
-from telegram import Bot
-from telegram_bot_calendar import DetailedTelegramCalendar
+from telegram.error import BadRequest, NetworkError, RetryAfter, TimedOut
+from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
+import httpx
 import pytz
 from html import escape
+from types import MappingProxyType
+from collections import OrderedDict, deque
 
 
 
 MOSCOW_TZ = pytz.timezone('Europe/Moscow')
 
-# Настройка логирования
+# Настройка логирования (в режиме WORKERS строки воркеров помечаются номером процесса)
+_WORKER_LOG_TAG = f"worker {os.environ['BOTBAO_WORKER_INDEX']} - " if os.getenv("BOTBAO_WORKER_INDEX") else ""
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO
+    format=f'%(asctime)s - {_WORKER_LOG_TAG}%(name)s - %(levelname)s - %(message)s', level=logging.INFO
 )
 logger = logging.getLogger(__name__)
 
 DATA_LOCK = threading.Lock() # Для безопасной работы с файлом при многопоточности
+# Весь файловый ввод-вывод из обработчиков выполняется в одном выделенном потоке:
+# цикл событий не блокируется, а записи в файлы выполняются строго по порядку
+STORAGE_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
 
 
 # --- КОНФИГУРАЦИЯ БОТА ---
+# Токен и ID админ-чата проверяются в main(); импорт модуля не обращается ни к сети, ни к диску.
+# Старый вебхук в режиме polling снимает сам run_polling.
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-bot = Bot(token=BOT_TOKEN)
-ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID"))
-success = bot.delete_webhook()
+ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID") or 0)
+BOT_VERSION = os.getenv("BOT_VERSION", "dev") # Метка версии в журнале времени запуска
+# Адрес Bot API (по умолчанию https://api.telegram.org). Для нагрузочных тестов - tools/fake_telegram_server.py
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
+
+# Реестр пользователей держится в памяти и сбрасывается на диск пачками
+USERS_FLUSH_INTERVAL = int(os.getenv("USERS_FLUSH_INTERVAL", "30")) # Период сброса изменений users.json, секунд
+USERS_MAX_DIRTY = int(os.getenv("USERS_MAX_DIRTY", "200")) # При таком числе несохраненных пользователей сбрасываем сразу
+STATS_FLUSH_INTERVAL = int(os.getenv("STATS_FLUSH_INTERVAL", "30")) # Период сброса приращений счетчиков статистики, секунд
+
+# Горячая перезагрузка menu.json и faq.json
+CONTENT_RELOAD_INTERVAL = int(os.getenv("CONTENT_RELOAD_INTERVAL", "10")) # Период проверки mtime файлов, секунд (0 - выключено)
+CONTENT_SNAPSHOTS_KEPT = 5 # Сколько последних версий хранить для кнопок из уже отправленных сообщений
+
+# Часы работы для бронирования (время по Москве, ЧЧ:ММ) и шаг слотов
+RESERVATION_FIRST_SLOT = os.getenv("RESERVATION_FIRST_SLOT", "11:00") # Первое время, доступное для брони
+RESERVATION_LAST_SLOT = os.getenv("RESERVATION_LAST_SLOT", "21:00") # Последнее время, доступное для брони (включительно)
+RESERVATION_SLOT_MINUTES = int(os.getenv("RESERVATION_SLOT_MINUTES", "30")) # Шаг слотов, минут
+RESERVATION_TABLES_PER_SLOT = int(os.getenv("RESERVATION_TABLES_PER_SLOT", "8")) # Сколько столов можно забронировать на один слот
+RESERVATION_SEATS_PER_TABLE = int(os.getenv("RESERVATION_SEATS_PER_TABLE", "4")) # Мест за столом: компания побольше занимает несколько столов
+
+# Режим получения обновлений: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "") # Публичный адрес бота, например https://bot.example.com
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "") # Проверяется в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40")) # 1-100, передается Telegram и ограничивает локальные соединения
+HEALTH_PATH = "/health"
+
+# Параллельная обработка обновлений: разные чаты обрабатываются одновременно, один чат - строго по порядку
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "32")) # Сколько обновлений обрабатывается одновременно, 1 - последовательно
+
+# Несколько процессов: фронт получает обновления (polling или webhook) и раздает их воркерам
+# по ID пользователя (консистентное хеширование). Нужен STORAGE_BACKEND=sqlite.
+WORKERS = int(os.getenv("WORKERS", "0")) # Число процессов-воркеров, 0 - все в одном процессе
+WORKER_BASE_PORT = int(os.getenv("WORKER_BASE_PORT", "8600")) # Воркер i слушает 127.0.0.1:WORKER_BASE_PORT+i
+WORKER_INDEX = int(os.getenv("BOTBAO_WORKER_INDEX", "-1")) # Номер этого воркера (задает фронт), -1 - не воркер
+WORKER_SECRET = os.getenv("BOTBAO_WORKER_SECRET", "") # Общий секрет фронта и воркеров (задает фронт)
+WORKER_UPDATE_PATH = "/update"
+WORKER_BROADCAST_FIELD = "botbao_broadcast" # Метка обновления админ-чата, которое фронт разослал всем воркерам
+
+# Склейка сообщений гостя в живом чате: текст, пришедший в течение окна после первого
+# сообщения, дописывается в то же сообщение админам (редактированием), а не отправляется отдельно
+LIVE_CHAT_COALESCE_SECONDS = float(os.getenv("LIVE_CHAT_COALESCE_SECONDS", "2.5")) # 0 - выключено
+# Автозакрытие брошенных чатов поддержки
+LIVE_CHAT_IDLE_TTL = float(os.getenv("LIVE_CHAT_IDLE_TTL", "3600")) # Секунд без сообщений до закрытия чата, 0 - не закрывать
+LIVE_CHAT_SWEEP_INTERVAL = float(os.getenv("LIVE_CHAT_SWEEP_INTERVAL", "300")) # Как часто искать брошенные чаты, сек
+LIVE_CHAT_SWEEP_BATCH = int(os.getenv("LIVE_CHAT_SWEEP_BATCH", "100")) # Сколько чатов закрывать за одну запись в хранилище
+LIVE_CHAT_ACTIVITY_WRITE_INTERVAL = 60 # Время активности пишется на диск не чаще раза в минуту на чат
+
+# Очередь исходящих сообщений в админ-чат (лимиты Telegram: ~30 сообщений/с на бота, ~20 в минуту на группу)
+OUTBOX_GLOBAL_RATE = float(os.getenv("OUTBOX_GLOBAL_RATE", "30")) # Сообщений в секунду на весь бот
+OUTBOX_CHAT_RATE_PER_MINUTE = float(os.getenv("OUTBOX_CHAT_RATE_PER_MINUTE", "20")) # Сообщений в минуту в один чат
+OUTBOX_CHAT_BURST = int(os.getenv("OUTBOX_CHAT_BURST", "3")) # Сколько сообщений в один чат можно отправить подряд без пауз
+OUTBOX_MAX_ATTEMPTS = 5 # Попыток отправки при сетевых ошибках и RetryAfter
+REPLY_ROUTES_SIZE = int(os.getenv("REPLY_ROUTES_SIZE", "50000")) # Сколько последних сообщений админ-чата помнить для ответов
+# Режим тем форума: админ-чат - супергруппа с включенными темами, у каждого гостя живого чата своя тема
+ADMIN_FORUM_TOPICS = os.getenv("ADMIN_FORUM_TOPICS", "0") == "1"
 
            
 # --------------------------
@@ -74,10 +159,347 @@ REVIEWS_FILE = os.path.join(DATA_DIR, 'reviews.json')
 PROBLEMS_FILE = os.path.join(DATA_DIR, 'problems.json')
 USER_STATES_FILE = os.path.join(DATA_DIR, 'user_states.json')
 USERS_FILE = os.path.join(DATA_DIR, 'users.json') # Для логирования уникальных пользователей
-MESSAGES_FILE = os.path.join(DATA_DIR, 'messages.json') # Для логирования всех сообщений
+MESSAGES_FILE = os.path.join(DATA_DIR, 'messages.json') # Старый формат лога сообщений (только для чтения при replay)
+MESSAGES_JOURNAL_DIR = os.path.join(DATA_DIR, 'messages') # Журнал сообщений: суточные сегменты, одна JSON-запись на строку
+STARTUP_METRICS_FILE = os.path.join(DATA_DIR, 'startup_metrics.jsonl') # Время импорта и запуска, одна запись на запуск
+PROFILE_STATS_FILE = os.path.join(DATA_DIR, 'profile_stats.txt') # Сводка cProfile по команде /profile
+REPLY_ROUTES_FILE = os.path.join(DATA_DIR, 'reply_routes.jsonl') # Сообщение в админ-чате -> гость, одна пара на строку
+FORUM_TOPICS_FILE = os.path.join(DATA_DIR, 'forum_topics.json') # Гость -> тема форума в админ-чате
+RESERVATIONS_FILE = os.path.join(DATA_DIR, 'reservations.json') # Брони столов (для хранилища json)
+STATS_ROLLUPS_FILE = os.path.join(DATA_DIR, 'stats_rollups.jsonl') # Приращения счетчиков статистики (для хранилища json)
+
+# Хранилище пользователей, сообщений, отзывов, проблем и состояний чатов: json (по умолчанию) или sqlite
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "json")
+SQLITE_PATH = os.getenv("SQLITE_PATH", os.path.join(DATA_DIR, 'botbao.sqlite3'))
+
+# Сохранение незавершенных диалогов (бронирование, отзыв, проблема, живой чат) между перезапусками
+PERSISTENCE_DIR = os.path.join(DATA_DIR, 'persistence') # Снимок + журнал изменений
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "5")) # Как часто PTB передает изменения, сек
+PERSISTENCE_COMPACT_EVERY = int(os.getenv("PERSISTENCE_COMPACT_EVERY", "1000")) # Через сколько записей журнала делать новый снимок
+
+# Метрики в формате Prometheus (текстовый формат, без внешних зависимостей)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0")) # 0 - HTTP-эндпоинт выключен (метрики все равно собираются)
+METRICS_PATH = "/metrics"
+
+if WORKER_INDEX >= 0:
+    # У каждого воркера свои журнал диалогов, таблица ответов, темы форума и порт метрик
+    PERSISTENCE_DIR = os.path.join(PERSISTENCE_DIR, f"worker-{WORKER_INDEX}")
+    REPLY_ROUTES_FILE = os.path.join(DATA_DIR, f'reply_routes-{WORKER_INDEX}.jsonl')
+    FORUM_TOPICS_FILE = os.path.join(DATA_DIR, f'forum_topics-{WORKER_INDEX}.json')
+    PROFILE_STATS_FILE = os.path.join(DATA_DIR, f'profile_stats-{WORKER_INDEX}.txt')
+    if METRICS_PORT:
+        METRICS_PORT += WORKER_INDEX
+    # Лимиты Telegram общие для бота: делим их между воркерами
+    OUTBOX_GLOBAL_RATE /= max(1, WORKERS)
+    OUTBOX_CHAT_RATE_PER_MINUTE /= max(1, WORKERS)
+    OUTBOX_CHAT_BURST = max(1, OUTBOX_CHAT_BURST // max(1, WORKERS))
+
+# Профилирование обработки обновлений
+PROFILE_SLOW_UPDATE_MS = float(os.getenv("PROFILE_SLOW_UPDATE_MS", "500")) # Обновления дольше порога пишутся в лог с цепочкой обработчиков
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0")) # Доля обновлений под cProfile (0 - выключено, 0.01 - каждое сотое)
+PROFILE_POST_GROUP = 1000 # Группа обработчика, завершающего замер (после всех остальных групп)
+
+# --- Метрики ---
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BYTES_BUCKETS = (1 << 10, 4 << 10, 16 << 10, 64 << 10, 256 << 10, 1 << 20, 4 << 20, 16 << 20, 64 << 20)
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labelnames, values, extra=""):
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(labelnames, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+class Counter:
+    """Счетчик с метками. Потокобезопасен (пишется и из потока хранилища)."""
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {value}"
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин и метками."""
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {} # метки -> [счетчики по корзинам (+Inf последней), сумма, количество]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(labels[name] for name in self.labelnames)
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            data = self._values.get(key)
+            if data is None:
+                data = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            data[0][index] += 1
+            data[1] += value
+            data[2] += 1
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = [(key, (list(data[0]), data[1], data[2])) for key, data in self._values.items()]
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                le_label = f'le="{le}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le_label)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, key)} {total}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, key)} {count}"
+
+class Gauge:
+    """Показатель, значение которого вычисляется в момент запроса /metrics."""
+
+    def __init__(self, name: str, documentation: str, func):
+        self.name = name
+        self.documentation = documentation
+        self.func = func
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        try:
+            yield f"{self.name} {self.func()}"
+        except Exception as e:
+            logger.error(f"Не удалось вычислить метрику {self.name}: {e}")
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for metric in self._metrics for line in metric.render()) + "\n"
+
+metrics = MetricsRegistry()
+HANDLER_SECONDS = metrics.register(Histogram(
+    "botbao_handler_seconds", "Время работы обработчика обновления", ("handler",)))
+UPDATES_TOTAL = metrics.register(Counter(
+    "botbao_updates_total", "Полученные обновления по типу", ("type",)))
+STORAGE_IO_SECONDS = metrics.register(Histogram(
+    "botbao_storage_io_seconds", "Время чтения/записи JSON-файлов данных", ("operation", "file")))
+STORAGE_CALL_SECONDS = metrics.register(Histogram(
+    "botbao_storage_call_seconds", "Время вызова в потоке хранилища (без ожидания очереди)", ("storage", "operation")))
+STORAGE_IO_BYTES = metrics.register(Histogram(
+    "botbao_storage_io_bytes", "Размер прочитанного/записанного JSON-файла", ("operation", "file"), BYTES_BUCKETS))
+BOT_API_SECONDS = metrics.register(Histogram(
+    "botbao_bot_api_seconds", "Время вызова метода Bot API", ("method",)))
+BOT_API_ERRORS = metrics.register(Counter(
+    "botbao_bot_api_errors_total", "Ошибки вызовов Bot API (HTTP-код или тип исключения)", ("method", "code")))
+metrics.register(Gauge("botbao_live_chats_active", "Активные чаты поддержки",
+                       lambda: sum(1 for state in user_states_data.values() if state.get("state") == "chat_active")))
+metrics.register(Gauge("botbao_reviews_in_memory", "Размер списка отзывов в памяти", lambda: len(reviews_data)))
+metrics.register(Gauge("botbao_problems_in_memory", "Размер списка проблем в памяти", lambda: len(problems_data)))
+metrics.register(Gauge("botbao_admin_outbox_depth", "Сообщений в очереди админ-чата", lambda: admin_outbox.depth))
+metrics.register(Gauge("botbao_updates_running", "Обновлений в обработке", lambda: update_processor.running))
+metrics.register(Gauge("botbao_updates_waiting", "Обновлений, ожидающих очереди своего чата или свободного места",
+                       lambda: update_processor.waiting))
+
+def timed_file_io(operation: str):
+    """Декоратор для load_data/save_data: время операции и размер файла после нее."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(filepath, *args, **kwargs):
+            started = _time.perf_counter()
+            try:
+                return func(filepath, *args, **kwargs)
+            finally:
+                labels = {"operation": operation, "file": os.path.basename(filepath)}
+                STORAGE_IO_SECONDS.observe(_time.perf_counter() - started, **labels)
+                try:
+                    STORAGE_IO_BYTES.observe(os.path.getsize(filepath), **labels)
+                except OSError:
+                    pass
+        return wrapper
+    return decorator
+
+def _timed_callback(callback):
+    """Оборачивает callback обработчика замером времени (метка - имя функции)."""
+    name = getattr(callback, "__name__", type(callback).__name__)
+
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = _time.perf_counter()
+        try:
+            result = callback(update, context)
+            if inspect.isawaitable(result):
+                result = await result
+            return result
+        finally:
+            elapsed = _time.perf_counter() - started
+            HANDLER_SECONDS.observe(elapsed, handler=name)
+            update_profiler.record_handler(update, name, elapsed)
+    wrapper.is_timed = True
+    return wrapper
+
+def _instrument_handler(handler):
+    if isinstance(handler, ConversationHandler):
+        nested = itertools.chain(handler.entry_points, *handler.states.values(), handler.fallbacks)
+        for nested_handler in nested:
+            _instrument_handler(nested_handler)
+    elif callable(getattr(handler, "callback", None)) and not getattr(handler.callback, "is_timed", False):
+        handler.callback = _timed_callback(handler.callback)
+
+def instrument_handlers(application: Application) -> None:
+    """Добавляет замер времени ко всем зарегистрированным обработчикам, включая вложенные в ConversationHandler."""
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            _instrument_handler(handler)
+
+async def count_update(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Считает обновления по типу (message, callback_query, ...). Регистрируется в группе -2."""
+    update_type = next((kind for kind in Update.ALL_TYPES if getattr(update, kind, None) is not None), "unknown")
+    UPDATES_TOTAL.inc(type=update_type)
+
+class UpdateProfiler:
+    """
+    Замер обработки обновления целиком: before_update (группа -1) запоминает время начала,
+    after_update (группа PROFILE_POST_GROUP) - конец. Обработчики между ними отмечаются
+    через record_handler (см. _timed_callback), поэтому для медленного обновления в лог
+    попадает вся цепочка. Доля sample_rate обновлений выполняется под cProfile,
+    статистика накапливается и выдается командой /profile.
+    cProfile меряет поток целиком, поэтому замер начинается, только когда других обновлений
+    в обработке нет, а замер, во время которого началось другое обновление, отбрасывается.
+    Фоновые задачи (очередь админ-чата, задания по таймеру) в замер все равно попадают.
+    """
+    MAX_TRACKED = 1000 # Обновления, для которых after_update не вызвался (ошибка), не копятся бесконечно
+
+    def __init__(self, slow_ms: float, sample_rate: float):
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self._active = OrderedDict() # id(update) -> {"started", "chain", "profile"}
+        self._profiling = False # cProfile может профилировать только одно обновление за раз
+        self._profile_overlapped = False # Во время текущего замера началось другое обновление
+        self._stats = None
+        self.updates_total = 0
+        self.slow_total = 0
+        self.profiled_total = 0
+        self.discarded_total = 0
+        self.slow_updates = deque(maxlen=20)
+
+    async def before_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        record = {"started": _time.perf_counter(), "chain": [], "profile": None}
+        if self._profiling:
+            self._profile_overlapped = True
+        elif self.sample_rate > 0 and update_processor.running <= 1 and random.random() < self.sample_rate:
+            record["profile"] = cProfile.Profile()
+            record["profile"].enable()
+            self._profiling = True
+            self._profile_overlapped = False
+        self._active[id(update)] = record
+        while len(self._active) > self.MAX_TRACKED:
+            _, stale = self._active.popitem(last=False)
+            self._finish_profile(stale)
+
+    def record_handler(self, update, name: str, seconds: float) -> None:
+        record = self._active.get(id(update))
+        if record is not None:
+            record["chain"].append((name, seconds))
+
+    async def after_update(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+        record = self._active.pop(id(update), None)
+        if record is None:
+            return
+        elapsed_ms = (_time.perf_counter() - record["started"]) * 1000
+        self._finish_profile(record)
+        self.updates_total += 1
+        if elapsed_ms >= self.slow_ms:
+            self.slow_total += 1
+            update_type = next((kind for kind in Update.ALL_TYPES if getattr(update, kind, None) is not None), "unknown")
+            chain = " -> ".join(f"{name} {seconds * 1000:.1f} мс" for name, seconds in record["chain"]) or "нет обработчиков"
+            self.slow_updates.append(f"{datetime.now():%H:%M:%S} {update_type} {elapsed_ms:.0f} мс: {chain}")
+            logger.warning(f"Медленное обновление {update.update_id} ({update_type}): {elapsed_ms:.0f} мс, обработчики: {chain}")
+
+    def _finish_profile(self, record):
+        profile = record["profile"]
+        if profile is None:
+            return
+        profile.disable()
+        record["profile"] = None
+        self._profiling = False
+        if self._profile_overlapped:
+            self.discarded_total += 1 # Профиль смешал бы несколько обновлений
+            return
+        self.profiled_total += 1
+        if self._stats is None:
+            self._stats = pstats.Stats(profile)
+        else:
+            self._stats.add(profile)
+
+    def summary(self) -> str:
+        lines = [
+            f"Обновлений: {self.updates_total}, медленных (>= {self.slow_ms:.0f} мс): {self.slow_total}, "
+            f"под cProfile: {self.profiled_total} (доля {self.sample_rate}), "
+            f"отброшено из-за параллельных обновлений: {self.discarded_total}",
+            "Цифры cProfile приблизительные: в них входят фоновые задачи, работавшие во время замера."
+        ]
+        if self.slow_updates:
+            lines.append("Последние медленные:")
+            lines.extend(self.slow_updates)
+        return "\n".join(lines)
+
+    def report(self, limit: int = 40) -> str | None:
+        """Сводка cProfile по накопленным обновлениям (сортировка по cumulative), None - если данных нет."""
+        if self._stats is None:
+            return None
+        buffer = io.StringIO()
+        self._stats.stream = buffer
+        self._stats.sort_stats("cumulative").print_stats(limit)
+        return buffer.getvalue()
+
+    def reset(self):
+        self._stats = None
+        self.updates_total = self.slow_total = self.profiled_total = self.discarded_total = 0
+        self.slow_updates.clear()
 
-# Убедимся, что директория data существует
-os.makedirs(DATA_DIR, exist_ok=True)
+update_profiler = UpdateProfiler(PROFILE_SLOW_UPDATE_MS, PROFILE_SAMPLE_RATE)
+
+class InstrumentedRequest(HTTPXRequest):
+    """Сетевой слой Bot API с замером времени и подсчетом ошибок по методам."""
+
+    async def do_request(self, url, method, *args, **kwargs):
+        api_method = "file" if "/file/bot" in url else url.rsplit("/", 1)[-1]
+        started = _time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            BOT_API_ERRORS.inc(method=api_method, code=type(e).__name__)
+            raise
+        finally:
+            BOT_API_SECONDS.observe(_time.perf_counter() - started, method=api_method)
+        if code >= 400:
+            BOT_API_ERRORS.inc(method=api_method, code=str(code))
+        return code, payload
 
 # --- Функции для работы с данными (загрузка/сохранение) ---
 
@@ -91,6 +513,7 @@ async def get_file_id(update: Update, context: ContextTypes.DEFAULT_TYPE):
     else:
         await update.message.reply_text("Пожалуйста, отправьте фотографию или файл.")
 
+@timed_file_io("load_data")
 def load_data(filepath, default_value=None):
     """
     Загружает данные из JSON-файла.
@@ -122,6 +545,7 @@ def load_data(filepath, default_value=None):
             logger.error(f"Неизвестная ошибка при загрузке данных из {filepath}: {e}")
             return default_value
 
+@timed_file_io("save_data")
 def save_data(filepath, data):
     """
     Сохраняет данные в JSON-файл.
@@ -134,100 +558,1744 @@ def save_data(filepath, data):
         except Exception as e:
             logger.error(f"Ошибка при сохранении данных в файл {filepath}: {e}")
 
-# --- Глобальные переменные для данных, которые загружаются при старте и редко изменяются ---
-# Для часто изменяемых данных (логи, отзывы, проблемы), мы будем загружать, обновлять и сохранять их в каждом обработчике.
-menu_data = load_data(MENU_FILE)
-faq_data = load_data(FAQ_FILE)
-user_states_data = load_data(USER_STATES_FILE) # Для активных чатов поддержки (если не используете Persistence)
-reviews_data = load_data(REVIEWS_FILE, default_value=[])
-problems_data = load_data(PROBLEMS_FILE, default_value=[])
+class MessageJournal:
+    """
+    Журнал сообщений только на дозапись (append-only).
+    Каждая запись - одна строка JSON, файлы разбиты на суточные сегменты по московскому
+    времени (messages-ГГГГ-ММ-ДД.jsonl), как и дни в /stats, поэтому запись одного сообщения стоит одинаково
+    независимо от того, сколько истории уже накоплено.
+    """
+    SEGMENT_PREFIX = "messages-"
+    SEGMENT_SUFFIX = ".jsonl"
+
+    def __init__(self, directory, legacy_file=None):
+        self.directory = directory
+        self.legacy_file = legacy_file # Старый messages.json, читается первым при replay
+        self._lock = threading.Lock()
+        self._segment_day = None
+        self._segment_file = None
+
+    def _segment_path(self, day: date) -> str:
+        return os.path.join(self.directory, f"{self.SEGMENT_PREFIX}{day.isoformat()}{self.SEGMENT_SUFFIX}")
+
+    def _open_segment(self, day: date):
+        """Переключается на сегмент нужного дня (ротация в полночь)."""
+        if self._segment_file is not None:
+            self._segment_file.close()
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._segment_path(day)
+        # Если после сбоя последняя строка недописана, начинаем новую запись с новой строки
+        needs_newline = False
+        if os.path.exists(path) and os.path.getsize(path) > 0:
+            with open(path, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                needs_newline = f.read(1) != b"\n"
+        self._segment_file = open(path, 'a', encoding='utf-8')
+        if needs_newline:
+            self._segment_file.write("\n")
+        self._segment_day = day
+
+    def append(self, entry: dict):
+        """Дописывает одну запись в сегмент текущего дня."""
+        line = json.dumps(entry, ensure_ascii=False) + "\n"
+        day = moscow_today()
+        with self._lock:
+            try:
+                if self._segment_day != day or self._segment_file is None:
+                    self._open_segment(day)
+                self._segment_file.write(line)
+                self._segment_file.flush()
+            except Exception as e:
+                logger.error(f"Ошибка записи в журнал сообщений {self.directory}: {e}")
+
+    def segments(self):
+        """Возвращает список (день, путь) всех сегментов в хронологическом порядке."""
+        if not os.path.isdir(self.directory):
+            return []
+        result = []
+        for name in os.listdir(self.directory):
+            if not (name.startswith(self.SEGMENT_PREFIX) and name.endswith(self.SEGMENT_SUFFIX)):
+                continue
+            try:
+                day = date.fromisoformat(name[len(self.SEGMENT_PREFIX):-len(self.SEGMENT_SUFFIX)])
+            except ValueError:
+                continue
+            result.append((day, os.path.join(self.directory, name)))
+        result.sort()
+        return result
+
+    def replay(self, since: date | None = None, until: date | None = None):
+        """
+        Последовательно отдает все записи журнала (включая старый messages.json)
+        за период [since, until] (дни - по Москве). Поврежденные строки (например, недописанная
+        последняя строка после сбоя) пропускаются.
+        """
+        if self.legacy_file and os.path.exists(self.legacy_file):
+            legacy_entries = _iter_json_stream(self.legacy_file)
+            for entry in legacy_entries:
+                moment = moscow_datetime(entry.get("timestamp")) if isinstance(entry, dict) else None
+                entry_day = moment.date() if moment is not None else None
+                if entry_day is not None:
+                    if (since and entry_day < since) or (until and entry_day > until):
+                        continue
+                yield entry
+
+        with self._lock:
+            if self._segment_file is not None:
+                self._segment_file.flush()
+        for day, path in self.segments():
+            if (since and day < since) or (until and day > until):
+                continue
+            with open(path, 'r', encoding='utf-8') as f:
+                for line_no, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        logger.warning(f"Пропущена поврежденная запись {path}:{line_no}")
+
+    def close(self):
+        with self._lock:
+            if self._segment_file is not None:
+                self._segment_file.close()
+                self._segment_file = None
+                self._segment_day = None
+
+# --- Асинхронный слой хранения: вызовы из обработчиков не блокируют цикл событий ---
+
+def _timed_storage_call(func, *args):
+    """
+    Вызов в потоке хранилища с замером времени. Метки: хранилище (json/sqlite) или класс
+    владельца метода (ReplyRoutes, StatsRollups, ...) и имя метода.
+    """
+    started = _time.perf_counter()
+    try:
+        return func(*args)
+    finally:
+        owner = getattr(func, "__self__", None)
+        if isinstance(owner, (JsonStorage, SqliteStorage)):
+            owner_name = owner.name
+        else:
+            owner_name = type(owner).__name__ if owner is not None else "-"
+        STORAGE_CALL_SECONDS.observe(_time.perf_counter() - started, storage=owner_name,
+                                     operation=getattr(func, "__name__", "-"))
 
-# --- Функции логирования ---
+async def run_in_storage(func, *args):
+    """Выполняет синхронную функцию ввода-вывода в потоке хранилища и ожидает результат."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(STORAGE_EXECUTOR, _timed_storage_call, func, *args)
 
-def _log_user(user):
-    """Логирует информацию о пользователе, если он еще не зарегистрирован, или обновляет 'last_seen'."""
-    users = load_data(USERS_FILE)
-    user_id_str = str(user.id)
-    now = datetime.now().isoformat()
-
-    user_mention_link = f"tg://user?id={user.id}"
-    if user.username:
-        user_mention_link = f"@{user.username}"
-
-    if user_id_str not in users:
-        users[user_id_str] = {
-            "telegram_id": user.id,
-            "username": user.username,
-            "first_name": user.first_name,
-            "last_name": user.last_name,
-            "profile_link": user_mention_link,
-            "first_seen": now,
-            "last_seen": now
+# --- Хранилища данных (выбираются переменной окружения STORAGE_BACKEND) ---
+# Все методы хранилищ синхронные и вызываются из обработчиков через run_in_storage,
+# т.е. всегда выполняются в одном потоке STORAGE_EXECUTOR.
+
+RECORD_KINDS = ("reviews", "problems") # Списки записей: отзывы и проблемы
+
+def _record_timestamp(entry: dict):
+    """Время записи: в разных версиях кода поле называлось 'timestamp' или 'date'."""
+    return entry.get("timestamp") or entry.get("date")
+
+class JsonStorage:
+    """
+    Исходное хранилище на JSON-файлах в DATA_DIR.
+    Пользователи, отзывы, проблемы и состояния чатов держатся в памяти и
+    перезаписываются целиком; сообщения пишутся в журнал MessageJournal.
+    """
+    name = "json"
+
+    def __init__(self):
+        self.journal = MessageJournal(MESSAGES_JOURNAL_DIR, legacy_file=MESSAGES_FILE)
+        self._record_files = {"reviews": REVIEWS_FILE, "problems": PROBLEMS_FILE}
+        self._records = {}
+        self._users = None
+        self._user_states = None
+        self._reservations = None
+        self._slot_tables = None # дата -> {время: занято столов активными бронями}
+        self._rollups = None # день -> {(метрика, метка): значение}
+        self._rollup_lines = 0
+
+    # Пользователи
+    def load_users(self) -> dict:
+        if self._users is None:
+            self._users = load_data(USERS_FILE, default_value={})
+        return dict(self._users)
+
+    def save_users(self, changed: dict):
+        """Сохраняет измененные записи пользователей {user_id_str: запись}."""
+        if self._users is None:
+            self.load_users()
+        self._users.update(changed)
+        save_data(USERS_FILE, self._users)
+
+    # Сообщения
+    def append_message(self, entry: dict):
+        self.journal.append(entry)
+
+    def iter_messages(self, since: date | None = None, until: date | None = None):
+        return self.journal.replay(since=since, until=until)
+
+    # Отзывы и проблемы
+    def load_records(self, kind: str) -> list:
+        if kind not in self._records:
+            self._records[kind] = load_data(self._record_files[kind], default_value=[])
+        return list(self._records[kind])
+
+    def append_record(self, kind: str, entry: dict):
+        if kind not in self._records:
+            self.load_records(kind)
+        self._records[kind].append(entry)
+        save_data(self._record_files[kind], self._records[kind])
+
+    # Состояния чатов поддержки
+    def load_user_states(self) -> dict:
+        if self._user_states is None:
+            self._user_states = load_data(USER_STATES_FILE, default_value={})
+        return dict(self._user_states)
+
+    def put_user_state(self, user_id: str, state: dict):
+        if self._user_states is None:
+            self.load_user_states()
+        self._user_states[str(user_id)] = state
+        save_data(USER_STATES_FILE, self._user_states)
+
+    def delete_user_states(self, user_ids):
+        if self._user_states is None:
+            self.load_user_states()
+        for user_id in user_ids:
+            self._user_states.pop(str(user_id), None)
+        save_data(USER_STATES_FILE, self._user_states)
+
+    # Брони столов: список в памяти и индексы по id, дате, гостю и телефону
+    def load_reservations(self) -> list:
+        if self._reservations is None:
+            self._reservations = load_data(RESERVATIONS_FILE, default_value=[])
+            self._reservation_index = {"id": {}, "date": {}, "user": {}, "phone": {}}
+            self._slot_tables = {}
+            for entry in self._reservations:
+                self._index_reservation(entry)
+        return list(self._reservations)
+
+    def _index_reservation(self, entry: dict):
+        index = self._reservation_index
+        index["id"][entry["id"]] = entry
+        index["date"].setdefault(entry["date"], []).append(entry)
+        index["user"].setdefault(entry.get("user_id"), []).append(entry)
+        if entry.get("phone"):
+            index["phone"].setdefault(entry["phone"], []).append(entry)
+        if entry.get("status") == "active":
+            day = self._slot_tables.setdefault(entry["date"], {})
+            day[entry["time"]] = day.get(entry["time"], 0) + entry["tables"]
+
+    def _reservations_by(self, field: str, value) -> list:
+        if self._reservations is None:
+            self.load_reservations()
+        entries = self._reservation_index[field].get(value, [])
+        return sorted((dict(entry) for entry in entries), key=lambda entry: (entry["date"], entry["time"]))
+
+    def reserve_slot(self, entry: dict, capacity: int) -> tuple:
+        """
+        Сохраняет бронь, если в ее слоте хватает свободных столов.
+        Возвращает (принята ли бронь, сколько столов слота занято после операции).
+        """
+        if self._reservations is None:
+            self.load_reservations()
+        booked = self._slot_tables.get(entry["date"], {}).get(entry["time"], 0)
+        if booked + entry["tables"] > capacity:
+            return False, booked
+        entry = dict(entry)
+        self._reservations.append(entry)
+        self._index_reservation(entry)
+        save_data(RESERVATIONS_FILE, self._reservations)
+        return True, booked + entry["tables"]
+
+    def set_reservation_status(self, reservation_id: str, status: str) -> tuple:
+        """Меняет статус брони. Возвращает (запись или None, сколько столов ее слота занято после операции)."""
+        if self._reservations is None:
+            self.load_reservations()
+        entry = self._reservation_index["id"].get(reservation_id)
+        if entry is None:
+            return None, 0
+        day = self._slot_tables.setdefault(entry["date"], {})
+        if entry["status"] != status:
+            delta = (status == "active") - (entry["status"] == "active")
+            day[entry["time"]] = day.get(entry["time"], 0) + delta * entry["tables"]
+            entry["status"] = status
+            entry["updated_at"] = datetime.now(MOSCOW_TZ).isoformat()
+            save_data(RESERVATIONS_FILE, self._reservations)
+        return dict(entry), day.get(entry["time"], 0)
+
+    def reservations_on(self, day: str) -> list:
+        return self._reservations_by("date", day)
+
+    def reservations_of_user(self, user_id: int) -> list:
+        return self._reservations_by("user", user_id)
+
+    def reservations_by_phone(self, phone: str) -> list:
+        return self._reservations_by("phone", phone)
+
+    def slot_tables(self, day: str) -> dict:
+        """Занятые столы по слотам дня: {'ЧЧ:ММ': столов}."""
+        if self._reservations is None:
+            self.load_reservations()
+        return dict(self._slot_tables.get(day, {}))
+
+    # Счетчики статистики: каждый сброс дописывает строку приращений {день: {"метрика|метка": n}},
+    # при чтении строки складываются; файл переписывается, когда строк вдвое больше, чем дней
+    def _load_rollups(self):
+        if self._rollups is not None:
+            return
+        self._rollups, self._rollup_lines = {}, 0
+        if os.path.exists(STATS_ROLLUPS_FILE):
+            with open(STATS_ROLLUPS_FILE, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        increments = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue # Недописанная строка после аварийной остановки
+                    for day, values in increments.items():
+                        counters = self._rollups.setdefault(day, {})
+                        for key, value in values.items():
+                            metric, _, label = key.partition("|")
+                            counters[(metric, label)] = counters.get((metric, label), 0) + value
+                    self._rollup_lines += 1
+
+    def add_rollups(self, increments: dict):
+        """Прибавляет приращения {(день, метрика, метка): n} к счетчикам."""
+        self._load_rollups()
+        line = {}
+        for (day, metric, label), value in increments.items():
+            counters = self._rollups.setdefault(day, {})
+            counters[(metric, label)] = counters.get((metric, label), 0) + value
+            line.setdefault(day, {})[f"{metric}|{label}"] = value
+        with open(STATS_ROLLUPS_FILE, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(line, ensure_ascii=False) + "\n")
+        self._rollup_lines += 1
+        if self._rollup_lines > 2 * len(self._rollups):
+            self._compact_rollups()
+
+    def _compact_rollups(self):
+        tmp_path = f"{STATS_ROLLUPS_FILE}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for day, counters in sorted(self._rollups.items()):
+                values = {f"{metric}|{label}": value for (metric, label), value in counters.items()}
+                f.write(json.dumps({day: values}, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, STATS_ROLLUPS_FILE)
+        self._rollup_lines = len(self._rollups)
+
+    def load_rollups(self, since: str | None = None, until: str | None = None) -> dict:
+        """Счетчики за дни с since по until включительно (ГГГГ-ММ-ДД): {(день, метрика, метка): значение}."""
+        self._load_rollups()
+        return {(day, metric, label): value
+                for day, counters in self._rollups.items() if (since or day) <= day <= (until or day)
+                for (metric, label), value in counters.items()}
+
+    def clear_rollups(self):
+        self._rollups, self._rollup_lines = {}, 0
+        self._compact_rollups()
+
+    def close(self):
+        self.journal.close()
+
+class SqliteStorage:
+    """
+    Хранилище в SQLite (режим WAL).
+    Каждая запись - небольшая транзакция вместо перезаписи многомегабайтного файла;
+    таблицы проиндексированы по user_id и времени. Полная запись хранится в колонке
+    data (JSON), поэтому формат записей совпадает с JSON-хранилищем.
+    """
+    name = "sqlite"
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            last_seen TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen);
+
+        CREATE TABLE IF NOT EXISTS messages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            chat_id INTEGER,
+            timestamp TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_messages_user_ts ON messages(user_id, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_messages_ts ON messages(timestamp);
+
+        CREATE TABLE IF NOT EXISTS reviews (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            timestamp TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_reviews_user_ts ON reviews(user_id, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_reviews_ts ON reviews(timestamp);
+
+        CREATE TABLE IF NOT EXISTS problems (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            timestamp TEXT,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_problems_user_ts ON problems(user_id, timestamp);
+        CREATE INDEX IF NOT EXISTS idx_problems_ts ON problems(timestamp);
+
+        CREATE TABLE IF NOT EXISTS user_states (
+            user_id INTEGER PRIMARY KEY,
+            updated_at TEXT,
+            data TEXT NOT NULL
+        );
+
+        CREATE TABLE IF NOT EXISTS reservations (
+            id TEXT PRIMARY KEY,
+            user_id INTEGER,
+            phone TEXT,
+            date TEXT NOT NULL,
+            time TEXT NOT NULL,
+            tables INTEGER NOT NULL,
+            status TEXT NOT NULL,
+            data TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_reservations_slot ON reservations(date, time, status);
+        CREATE INDEX IF NOT EXISTS idx_reservations_user ON reservations(user_id, date);
+
+        CREATE TABLE IF NOT EXISTS stats_rollups (
+            day TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            label TEXT NOT NULL,
+            value INTEGER NOT NULL,
+            PRIMARY KEY (day, metric, label)
+        ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # Соединение используется из потока хранилища, но мигратор работает из основного потока
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(self.SCHEMA)
+            self._upgrade_schema()
+            self._conn.commit()
+
+    def _upgrade_schema(self):
+        """Дополняет таблицы, созданные предыдущими версиями бота."""
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(reservations)")}
+        if "phone" not in columns:
+            self._conn.execute("ALTER TABLE reservations ADD COLUMN phone TEXT")
+            self._conn.execute("UPDATE reservations SET phone = json_extract(data, '$.phone')")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_reservations_phone ON reservations(phone, date)")
+
+    def nonempty_tables(self) -> list:
+        """Таблицы с данными - по ним мигратор узнает, что перенос уже выполнялся."""
+        with self._lock:
+            return [table for table in ("users", "messages", "reviews", "problems", "user_states", "reservations", "stats_rollups")
+                    if self._conn.execute(f"SELECT 1 FROM {table} LIMIT 1").fetchone()]
+
+    def _execute_many(self, sql, rows):
+        with self._lock, self._conn:
+            self._conn.executemany(sql, rows)
+
+    # Пользователи
+    def load_users(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, data FROM users").fetchall()
+        return {str(user_id): json.loads(data) for user_id, data in rows}
+
+    def save_users(self, changed: dict):
+        self._execute_many(
+            "INSERT INTO users (user_id, last_seen, data) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET last_seen = excluded.last_seen, data = excluded.data",
+            [(int(user_id), record.get("last_seen"), json.dumps(record, ensure_ascii=False))
+             for user_id, record in changed.items()]
+        )
+
+    # Сообщения
+    def append_message(self, entry: dict):
+        self.append_messages([entry])
+
+    def append_messages(self, entries):
+        self._execute_many(
+            "INSERT INTO messages (user_id, chat_id, timestamp, data) VALUES (?, ?, ?, ?)",
+            [(entry.get("user_id"), entry.get("chat_id"), entry.get("timestamp"), json.dumps(entry, ensure_ascii=False))
+             for entry in entries]
+        )
+
+    def iter_messages(self, since: date | None = None, until: date | None = None):
+        sql = "SELECT data FROM messages"
+        conditions, params = [], []
+        if since:
+            conditions.append("timestamp >= ?")
+            params.append(since.isoformat())
+        if until:
+            conditions.append("timestamp < ?")
+            params.append((until + timedelta(days=1)).isoformat())
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY id"
+        cursor = self._conn.cursor()
+        with self._lock:
+            cursor.execute(sql, params)
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(1000)
+            if not rows:
+                return
+            for (data,) in rows:
+                yield json.loads(data)
+
+    # Отзывы и проблемы
+    def load_records(self, kind: str) -> list:
+        if kind not in RECORD_KINDS:
+            raise ValueError(f"Неизвестный тип записей: {kind}")
+        with self._lock:
+            rows = self._conn.execute(f"SELECT data FROM {kind} ORDER BY id").fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def append_record(self, kind: str, entry: dict):
+        self.append_records(kind, [entry])
+
+    def append_records(self, kind: str, entries):
+        if kind not in RECORD_KINDS:
+            raise ValueError(f"Неизвестный тип записей: {kind}")
+        self._execute_many(
+            f"INSERT INTO {kind} (user_id, timestamp, data) VALUES (?, ?, ?)",
+            [(entry.get("user_id"), _record_timestamp(entry), json.dumps(entry, ensure_ascii=False)) for entry in entries]
+        )
+
+    # Состояния чатов поддержки
+    def load_user_states(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT user_id, data FROM user_states").fetchall()
+        return {str(user_id): json.loads(data) for user_id, data in rows}
+
+    def put_user_state(self, user_id: str, state: dict):
+        self.put_user_states({user_id: state})
+
+    def put_user_states(self, states: dict):
+        now = datetime.now().isoformat()
+        self._execute_many(
+            "INSERT INTO user_states (user_id, updated_at, data) VALUES (?, ?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET updated_at = excluded.updated_at, data = excluded.data",
+            [(int(user_id), now, json.dumps(state, ensure_ascii=False)) for user_id, state in states.items()]
+        )
+
+    def delete_user_states(self, user_ids):
+        self._execute_many("DELETE FROM user_states WHERE user_id = ?", [(int(user_id),) for user_id in user_ids])
+
+    # Брони столов
+    def load_reservations(self) -> list:
+        with self._lock:
+            rows = self._conn.execute("SELECT data FROM reservations ORDER BY rowid").fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def _reservation_row(self, entry: dict) -> tuple:
+        return (entry["id"], entry.get("user_id"), entry.get("phone"), entry["date"], entry["time"], entry["tables"],
+                entry["status"], json.dumps(entry, ensure_ascii=False))
+
+    def append_reservations(self, entries):
+        """Вставка без проверки вместимости (перенос из JSON)."""
+        self._execute_many("INSERT OR REPLACE INTO reservations (id, user_id, phone, date, time, tables, status, data) "
+                           "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [self._reservation_row(entry) for entry in entries])
+
+    def _booked_tables(self, day: str, label: str) -> int:
+        (booked,) = self._conn.execute(
+            "SELECT COALESCE(SUM(tables), 0) FROM reservations WHERE date = ? AND time = ? AND status = 'active'",
+            (day, label)
+        ).fetchone()
+        return booked
+
+    def reserve_slot(self, entry: dict, capacity: int) -> tuple:
+        """
+        Проверка вместимости и вставка в одной транзакции BEGIN IMMEDIATE: база общая
+        для всех воркеров, и два процесса не смогут одновременно занять последний стол.
+        Возвращает (принята ли бронь, сколько столов слота занято после операции).
+        """
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                booked = self._booked_tables(entry["date"], entry["time"])
+                accepted = booked + entry["tables"] <= capacity
+                if accepted:
+                    self._conn.execute("INSERT INTO reservations (id, user_id, phone, date, time, tables, status, data) "
+                                       "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", self._reservation_row(entry))
+                    booked += entry["tables"]
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+        return accepted, booked
+
+    def set_reservation_status(self, reservation_id: str, status: str) -> tuple:
+        """Меняет статус брони. Возвращает (запись или None, сколько столов ее слота занято после операции)."""
+        with self._lock:
+            try:
+                self._conn.execute("BEGIN IMMEDIATE")
+                row = self._conn.execute("SELECT data FROM reservations WHERE id = ?", (reservation_id,)).fetchone()
+                if row is None:
+                    self._conn.rollback()
+                    return None, 0
+                entry = json.loads(row[0])
+                if entry["status"] != status:
+                    entry["status"] = status
+                    entry["updated_at"] = datetime.now(MOSCOW_TZ).isoformat()
+                    self._conn.execute("UPDATE reservations SET status = ?, data = ? WHERE id = ?",
+                                       (status, json.dumps(entry, ensure_ascii=False), reservation_id))
+                booked = self._booked_tables(entry["date"], entry["time"])
+                self._conn.commit()
+            except Exception:
+                self._conn.rollback()
+                raise
+        return entry, booked
+
+    def _select_reservations(self, where: str, params: tuple) -> list:
+        with self._lock:
+            rows = self._conn.execute(f"SELECT data FROM reservations WHERE {where} ORDER BY date, time", params).fetchall()
+        return [json.loads(data) for (data,) in rows]
+
+    def reservations_on(self, day: str) -> list:
+        return self._select_reservations("date = ?", (day,))
+
+    def reservations_of_user(self, user_id: int) -> list:
+        return self._select_reservations("user_id = ?", (user_id,))
+
+    def reservations_by_phone(self, phone: str) -> list:
+        return self._select_reservations("phone = ?", (phone,))
+
+    def slot_tables(self, day: str) -> dict:
+        """Занятые столы по слотам дня: {'ЧЧ:ММ': столов}."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT time, SUM(tables) FROM reservations WHERE date = ? AND status = 'active' GROUP BY time", (day,)
+            ).fetchall()
+        return dict(rows)
+
+    # Счетчики статистики: приращения складываются upsert'ом, поэтому воркеры пишут в таблицу без координации
+    def add_rollups(self, increments: dict):
+        """Прибавляет приращения {(день, метрика, метка): n} к счетчикам."""
+        self._execute_many(
+            "INSERT INTO stats_rollups (day, metric, label, value) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(day, metric, label) DO UPDATE SET value = value + excluded.value",
+            [(day, metric, label, value) for (day, metric, label), value in increments.items()]
+        )
+
+    def load_rollups(self, since: str | None = None, until: str | None = None) -> dict:
+        """Счетчики за дни с since по until включительно (ГГГГ-ММ-ДД): {(день, метрика, метка): значение}."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT day, metric, label, value FROM stats_rollups WHERE day >= ? AND day <= ?",
+                (since or "", until or "9999-12-31")
+            ).fetchall()
+        return {(day, metric, label): value for day, metric, label, value in rows}
+
+    def clear_rollups(self):
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM stats_rollups")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+def create_storage(backend: str):
+    """Создает хранилище по имени: 'json' (по умолчанию) или 'sqlite'."""
+    backend = (backend or "json").lower()
+    if backend == "json":
+        return JsonStorage()
+    if backend == "sqlite":
+        return SqliteStorage(SQLITE_PATH)
+    raise ValueError(f"Неизвестное хранилище STORAGE_BACKEND={backend!r} (допустимо: json, sqlite)")
+
+# --- Перенос JSON-файлов в SQLite ---
+
+def _iter_json_stream(filepath, chunk_size=1 << 16):
+    """
+    Потоково читает JSON-файл с массивом или объектом верхнего уровня,
+    не загружая его целиком в память. Для массива отдает элементы,
+    для объекта - пары (ключ, значение).
+    """
+    decoder = json.JSONDecoder()
+    whitespace = " \t\r\n"
+    with open(filepath, 'r', encoding='utf-8-sig') as f:
+        buffer, pos, eof = "", 0, False
+
+        def read_more() -> bool:
+            nonlocal buffer, pos, eof
+            chunk = f.read(chunk_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+            return not eof
+
+        def skip(chars):
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos] in chars:
+                    pos += 1
+                if pos < len(buffer) or not read_more():
+                    return
+
+        skip(whitespace)
+        if pos >= len(buffer):
+            return # Пустой файл
+        container = buffer[pos]
+        if container not in "[{":
+            raise ValueError(f"{filepath}: ожидался массив или объект JSON")
+        closing = "]" if container == "[" else "}"
+        pos += 1
+
+        while True:
+            skip(whitespace + ",")
+            if pos >= len(buffer):
+                raise ValueError(f"{filepath}: неожиданный конец файла")
+            if buffer[pos] == closing:
+                return
+            while True:
+                try:
+                    if container == "{":
+                        key, end = decoder.raw_decode(buffer, pos)
+                        while end < len(buffer) and buffer[end] in whitespace + ":":
+                            end += 1
+                        value, end = decoder.raw_decode(buffer, end)
+                        item = (key, value)
+                    else:
+                        item, end = decoder.raw_decode(buffer, pos)
+                    if end >= len(buffer) and not eof:
+                        # Значение упирается в конец буфера (например, число) - дочитываем, чтобы не обрезать его
+                        raise ValueError("неполный элемент")
+                    break
+                except ValueError:
+                    # Элемент не поместился в буфер - дочитываем следующий кусок и пробуем снова
+                    if not read_more():
+                        raise
+            pos = end
+            yield item
+
+def migrate_json_to_sqlite(sqlite_path=None, batch_size=1000):
+    """
+    Однократно переносит данные из JSON-файлов DATA_DIR в SQLite.
+    Файлы читаются потоково и вставляются пачками по batch_size записей.
+    Журналы и счетчики дописываются, а не заменяются, поэтому в базу с данными перенос не выполняется.
+    """
+    target = SqliteStorage(sqlite_path or SQLITE_PATH)
+    filled = target.nonempty_tables()
+    if filled:
+        target.close()
+        raise ValueError(f"База {target.path} уже содержит данные ({', '.join(filled)}): перенос уже выполнялся. "
+                         f"Чтобы перенести заново, удалите файл базы.")
+    source = JsonStorage()
+    counts = {}
+
+    def flush(kind, batch):
+        if not batch:
+            return
+        if kind == "users":
+            target.save_users(dict(batch))
+        elif kind == "messages":
+            target.append_messages(batch)
+        elif kind == "user_states":
+            target.put_user_states(dict(batch))
+        elif kind == "reservations":
+            target.append_reservations(batch)
+        else:
+            target.append_records(kind, batch)
+        counts[kind] = counts.get(kind, 0) + len(batch)
+        batch.clear()
+
+    def stream(kind, items):
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batch_size:
+                flush(kind, batch)
+        flush(kind, batch)
+
+    def file_items(filepath):
+        if not os.path.exists(filepath):
+            return iter(())
+        return _iter_json_stream(filepath)
+
+    stream("users", file_items(USERS_FILE))
+    stream("messages", source.iter_messages())
+    stream("reviews", file_items(REVIEWS_FILE))
+    stream("problems", file_items(PROBLEMS_FILE))
+    stream("user_states", file_items(USER_STATES_FILE))
+    stream("reservations", file_items(RESERVATIONS_FILE))
+    rollups = source.load_rollups()
+    if rollups:
+        target.add_rollups(rollups)
+        counts["stats_rollups"] = len(rollups)
+    source.close()
+    target.close()
+    logger.info(f"Перенос в SQLite ({target.path}) завершен: {counts}")
+    return counts
+
+# --- Снимки меню и FAQ (предварительно отрисованные, с горячей перезагрузкой) ---
+
+def _parse_versioned_callback(data: str, prefix: str):
+    """
+    Разбирает callback_data вида '<prefix><версия>_<индекс>'.
+    Возвращает (версия, индекс) или (None, остаток) для старого формата без версии.
+    """
+    rest = data[len(prefix):]
+    version, sep, index = rest.partition("_")
+    if sep and version.isdigit() and index.isdigit():
+        return int(version), int(index)
+    return None, rest
+
+def validate_menu(menu) -> None:
+    """Проверяет структуру menu.json: {категория: [{name, description, price}, ...]}."""
+    if not isinstance(menu, dict):
+        raise ValueError("menu.json должен быть объектом {категория: [блюда]}")
+    for category, items in menu.items():
+        if not isinstance(items, list):
+            raise ValueError(f"Категория '{category}' должна содержать список блюд")
+        for i, item in enumerate(items):
+            if not isinstance(item, dict):
+                raise ValueError(f"Блюдо #{i + 1} в категории '{category}' должно быть объектом")
+            missing = [field for field in ("name", "description", "price") if field not in item]
+            if missing:
+                raise ValueError(f"Блюдо #{i + 1} в категории '{category}': нет полей {', '.join(missing)}")
+
+def validate_faq(faq) -> None:
+    """Проверяет структуру faq.json: {"Вопросы": [{question, answer}, ...]}."""
+    if not isinstance(faq, dict) or not isinstance(faq.get("Вопросы", []), list):
+        raise ValueError('faq.json должен быть объектом {"Вопросы": [...]}')
+    for i, item in enumerate(faq.get("Вопросы", [])):
+        if not isinstance(item, dict) or "question" not in item or "answer" not in item:
+            raise ValueError(f"Вопрос #{i + 1}: нужны поля question и answer")
+
+class MenuSnapshot:
+    """
+    Неизменяемый снимок menu.json, собранный один раз при загрузке.
+    Клавиатура категорий и текст каждой категории (с экранированием MarkdownV2)
+    готовы заранее, поэтому обработчики меню только берут готовый ответ.
+    В callback_data зашита версия снимка, чтобы кнопки уже отправленных
+    сообщений продолжали работать после перезагрузки меню.
+    """
+    PARSE_MODE = "MarkdownV2"
+
+    def __init__(self, menu: dict, version: int):
+        self.version = version
+        categories = list(menu)
+        self.category_index = MappingProxyType({category: i for i, category in enumerate(categories)})
+        keyboard = [[InlineKeyboardButton(category, callback_data=f"menu_cat_{version}_{i}")] for i, category in enumerate(categories)]
+        keyboard.append([InlineKeyboardButton("🔙 В главное меню", callback_data="start")])
+        self.categories_markup = InlineKeyboardMarkup(keyboard)
+        self.category_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К категориям", callback_data="menu")]])
+        self.category_texts = tuple(self._render_category(category, menu[category]) for category in categories)
+
+    @staticmethod
+    def _render_category(category: str, items: list) -> str:
+        md = lambda value: escape_markdown(str(value), version=2)
+        parts = [f"{md(f'--- {category} ---')}\n\n"]
+        for item in items:
+            parts.append(
+                f"*{md(item['name'])}* \n"
+                f"{md(item['description'])} \n"
+                f"_Цена:_ {md(item['price'])}₽ \n\n"
+            )
+        return "".join(parts)
+
+    def category_text(self, key):
+        """Текст категории по индексу (новый формат кнопок) или по имени (старый формат)."""
+        if isinstance(key, str):
+            key = self.category_index.get(key)
+        if key is None or not 0 <= key < len(self.category_texts):
+            return None
+        return self.category_texts[key]
+
+class FaqSnapshot:
+    """Неизменяемый снимок faq.json: готовая клавиатура вопросов и тексты ответов."""
+    PARSE_MODE = "Markdown"
+
+    def __init__(self, faq: dict, version: int):
+        self.version = version
+        questions = faq.get("Вопросы", [])
+        keyboard = [[InlineKeyboardButton(item['question'], callback_data=f"faq_q_{version}_{i}")] for i, item in enumerate(questions)]
+        keyboard.append([InlineKeyboardButton("🔙 В главное меню", callback_data="start")])
+        self.questions_markup = InlineKeyboardMarkup(keyboard)
+        self.answer_markup = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 К вопросам", callback_data="faq")]])
+        self.answers = tuple(f"*{item['question']}*\n\n{item['answer']}" for item in questions)
+
+    def answer_text(self, index: int):
+        if 0 <= index < len(self.answers):
+            return self.answers[index]
+        return None
+
+class ContentSnapshots:
+    """
+    Текущий снимок файла контента (menu.json или faq.json) и несколько предыдущих версий.
+    Новый снимок собирается вне цикла событий и подменяется одной операцией присваивания,
+    поэтому обработчики всегда видят либо старую, либо новую версию целиком.
+    """
+
+    def __init__(self, name, filepath, builder, validator, keep=CONTENT_SNAPSHOTS_KEPT):
+        self.name = name
+        self.filepath = filepath
+        self.builder = builder
+        self.validator = validator
+        self.keep = keep
+        self.current = None
+        self.loaded_mtime_ns = None
+        self._versions = itertools.count(1)
+        self._history = OrderedDict()
+
+    def build(self, data):
+        """Проверяет данные и собирает новый снимок (можно вызывать из другого потока)."""
+        self.validator(data)
+        return self.builder(data, next(self._versions))
+
+    def swap(self, snapshot, mtime_ns=None):
+        """Публикует собранный снимок как текущий."""
+        self._history[snapshot.version] = snapshot
+        while len(self._history) > self.keep:
+            self._history.popitem(last=False)
+        self.current = snapshot
+        if mtime_ns is not None:
+            self.loaded_mtime_ns = mtime_ns
+        logger.info(f"Опубликована версия {snapshot.version} снимка {self.name}.")
+
+    def get(self, version=None):
+        """Снимок нужной версии; если она уже вытеснена или не указана - текущий."""
+        if version is None:
+            return self.current
+        return self._history.get(version, self.current)
+
+    def _file_mtime_ns(self):
+        try:
+            return os.stat(self.filepath).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def load_from_file(self, force=False):
+        """
+        Читает, проверяет и собирает снимок из файла, если файл изменился.
+        Возвращает (снимок, mtime_ns) или None. Выполняется вне цикла событий.
+        """
+        mtime_ns = self._file_mtime_ns()
+        if mtime_ns is None or (not force and mtime_ns == self.loaded_mtime_ns):
+            return None
+        with open(self.filepath, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return self.build(data), mtime_ns
+
+    def load_initial(self):
+        """Синхронная загрузка при старте. Некорректный файл не мешает запуску бота."""
+        try:
+            result = self.load_from_file(force=True)
+        except (ValueError, OSError) as e:
+            logger.error(f"Файл {self.filepath} некорректен, используется пустой {self.name}: {e}")
+            result = None
+        if result is None:
+            self.swap(self.builder({}, next(self._versions)))
+        else:
+            self.swap(*result)
+
+    async def reload_if_changed(self) -> bool:
+        """Проверяет mtime файла и, если он изменился, публикует новую версию."""
+        try:
+            result = await asyncio.to_thread(self.load_from_file)
+        except (ValueError, OSError) as e:
+            # Запоминаем mtime, чтобы не повторять ошибку на каждой проверке до следующего изменения файла
+            self.loaded_mtime_ns = self._file_mtime_ns()
+            logger.error(f"Новый {self.filepath} не загружен, остается версия {self.current.version}: {e}")
+            return False
+        if result is None:
+            return False
+        self.swap(*result)
+        return True
+
+    async def replace_file(self, data):
+        """Проверяет новые данные, атомарно записывает файл и публикует снимок. Ошибки проверки - ValueError."""
+        snapshot = await asyncio.to_thread(self.build, data)
+        await run_in_storage(_atomic_write_json, self.filepath, data)
+        self.swap(snapshot, mtime_ns=self._file_mtime_ns())
+        return snapshot
+
+def _atomic_write_json(filepath, data):
+    """Записывает JSON во временный файл и подменяет им исходный (файл никогда не бывает недописанным)."""
+    tmp_path = f"{filepath}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, indent=4)
+    os.replace(tmp_path, filepath)
+
+# --- Сохранение состояний диалогов ---
+
+def _encode_persisted(value):
+    """Кодирует date/time/datetime из user_data (reservation_data) для JSON."""
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, date):
+        return {"__date__": value.isoformat()}
+    if isinstance(value, time):
+        return {"__time__": value.isoformat()}
+    raise TypeError(f"Тип {type(value).__name__} нельзя сохранить в состоянии диалога")
+
+def _decode_persisted(obj):
+    if "__datetime__" in obj:
+        value = datetime.fromisoformat(obj["__datetime__"])
+        # Время брони хранится в московском поясе - возвращаем pytz-зону, а не фиксированное смещение
+        return value.astimezone(MOSCOW_TZ) if value.tzinfo is not None else value
+    if "__date__" in obj:
+        return date.fromisoformat(obj["__date__"])
+    if "__time__" in obj:
+        return time.fromisoformat(obj["__time__"])
+    return obj
+
+class DeltaLogPersistence(BasePersistence):
+    """
+    Persistence для user_data и состояний ConversationHandler.
+    Каждое изменение, которое передает Application (только затронутые пользователи и диалоги),
+    дописывается одной строкой в журнал deltas.jsonl - стоимость не зависит от общего объема данных.
+    Раз в compact_every записей текущее состояние пишется снимком snapshot.json, а журнал очищается.
+    При запуске читается снимок и поверх него проигрывается журнал.
+    """
+
+    def __init__(self, directory: str, update_interval: float = 60, compact_every: int = 1000):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.directory = directory
+        self.snapshot_file = os.path.join(directory, 'snapshot.json')
+        self.deltas_file = os.path.join(directory, 'deltas.jsonl')
+        self.compact_every = compact_every
+        self.user_data = None # {user_id: dict}
+        self.conversations = {} # {имя диалога: {ключ: состояние}}
+        self._deltas_written = 0
+        self._deltas_fh = None
+
+    def _load(self):
+        """Читает снимок и журнал. Выполняется в потоке хранилища."""
+        os.makedirs(self.directory, exist_ok=True)
+        user_data, conversations = {}, {}
+        if os.path.exists(self.snapshot_file):
+            with open(self.snapshot_file, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f, object_hook=_decode_persisted)
+            user_data = {int(user_id): data for user_id, data in snapshot.get("user_data", {}).items()}
+            conversations = {name: {tuple(key): state for key, state in items}
+                             for name, items in snapshot.get("conversations", {}).items()}
+        replayed = 0
+        if os.path.exists(self.deltas_file):
+            with open(self.deltas_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        delta = json.loads(line, object_hook=_decode_persisted)
+                    except json.JSONDecodeError:
+                        logger.warning(f"Пропущена поврежденная запись журнала {self.deltas_file}.")
+                        continue
+                    self._apply(user_data, conversations, delta)
+                    replayed += 1
+        self.user_data, self.conversations = user_data, conversations
+        # Сразу сворачиваем журнал в снимок: следующий запуск будет читать только снимок
+        self._write_snapshot(self._snapshot_text())
+        logger.info(f"Состояния диалогов загружены: пользователей {len(user_data)}, записей журнала {replayed}.")
+
+    @staticmethod
+    def _apply(user_data, conversations, delta):
+        kind = delta["op"]
+        if kind == "user":
+            user_data[delta["id"]] = delta["data"]
+        elif kind == "drop_user":
+            user_data.pop(delta["id"], None)
+        elif kind == "conv":
+            states = conversations.setdefault(delta["name"], {})
+            key = tuple(delta["key"])
+            if delta["state"] is None:
+                states.pop(key, None)
+            else:
+                states[key] = delta["state"]
+
+    def _snapshot_text(self) -> str:
+        snapshot = {
+            "user_data": {str(user_id): data for user_id, data in self.user_data.items()},
+            "conversations": {name: [[list(key), state] for key, state in states.items()]
+                              for name, states in self.conversations.items()},
         }
-        logger.info(f"Новый пользователь зарегистрирован: {user_id_str} ({user.username or user.full_name})")
-    else:
-        users[user_id_str]["last_seen"] = now
-        # Можно обновить другие поля, если они могли измениться (например, username)
-        users[user_id_str]["username"] = user.username
-        users[user_id_str]["first_name"] = user.first_name
-        users[user_id_str]["last_name"] = user.last_name
-        users[user_id_str]["profile_link"] = user_mention_link # Обновляем на случай изменения username
+        return json.dumps(snapshot, ensure_ascii=False, default=_encode_persisted)
+
+    def _write_snapshot(self, text: str):
+        """Подменяет снимок и очищает журнал. Выполняется в потоке хранилища после всех ранее поставленных записей."""
+        tmp_path = f"{self.snapshot_file}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, self.snapshot_file)
+        # Если упадем до очистки журнала, повторное проигрывание безопасно: записи содержат полные значения
+        if self._deltas_fh is not None:
+            self._deltas_fh.close()
+        self._deltas_fh = open(self.deltas_file, 'w', encoding='utf-8')
+
+    def _append_line(self, line: str):
+        self._deltas_fh.write(line)
+        self._deltas_fh.flush()
+
+    async def _record(self, delta: dict):
+        self._apply(self.user_data, self.conversations, delta)
+        line = json.dumps(delta, ensure_ascii=False, default=_encode_persisted) + "\n"
+        await run_in_storage(self._append_line, line)
+        self._deltas_written += 1
+        if self._deltas_written >= self.compact_every:
+            self._deltas_written = 0
+            # Снимок сериализуется здесь, в цикле событий, чтобы не читать словари из другого потока
+            await run_in_storage(self._write_snapshot, self._snapshot_text())
+
+    async def get_user_data(self):
+        if self.user_data is None:
+            await run_in_storage(self._load)
+        return {user_id: dict(data) for user_id, data in self.user_data.items()}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        if self.user_data is None:
+            await run_in_storage(self._load)
+        return dict(self.conversations.get(name, {}))
+
+    async def update_conversation(self, name, key, new_state):
+        if self.conversations.get(name, {}).get(key) == new_state:
+            return
+        await self._record({"op": "conv", "name": name, "key": list(key), "state": new_state})
+
+    async def update_user_data(self, user_id, data):
+        if self.user_data.get(user_id) == data:
+            return
+        await self._record({"op": "user", "id": user_id, "data": data})
+
+    async def drop_user_data(self, user_id):
+        if user_id in self.user_data:
+            await self._record({"op": "drop_user", "id": user_id})
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        """При остановке сворачивает журнал в снимок."""
+        if self.user_data is not None:
+            await run_in_storage(self._write_snapshot, self._snapshot_text())
+            await run_in_storage(self._deltas_fh.close)
+
+# --- Распределение гостей по воркерам (режим WORKERS) ---
+
+class ShardRing:
+    """
+    Консистентное хеширование ID пользователя на номер воркера.
+    У каждого воркера VNODES точек на кольце; пользователь принадлежит ближайшей точке
+    по часовой стрелке. При изменении числа воркеров переезжает лишь ~1/N гостей
+    (их незавершенные диалоги на новом воркере начинаются заново).
+    """
+    VNODES = 256
+
+    def __init__(self, shards: int):
+        points = sorted((self._hash(f"worker-{shard}-{vnode}"), shard)
+                        for shard in range(shards) for vnode in range(self.VNODES))
+        self._hashes = [point for point, _ in points]
+        self._shards = [shard for _, shard in points]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        # Не hash(): он различается между процессами
+        return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+    def owner(self, user_id) -> int:
+        index = bisect_left(self._hashes, self._hash(str(user_id)))
+        return self._shards[index % len(self._shards)]
+
+shard_ring = ShardRing(WORKERS) if WORKERS > 0 else None
+
+def owns_user(user_id) -> bool:
+    """Обслуживается ли гость этим процессом (без воркеров - всегда)."""
+    return WORKER_INDEX < 0 or shard_ring.owner(int(user_id)) == WORKER_INDEX
+
+# --- Глобальные переменные для данных ---
+# Заполняются в load_bot_data() на этапе запуска (post_init), а не при импорте модуля.
+# Часто изменяемые данные (логи, отзывы, проблемы, состояния чатов) пишутся через storage небольшими порциями.
+storage = None
+menu_snapshots = ContentSnapshots("menu", MENU_FILE, MenuSnapshot, validate_menu)
+faq_snapshots = ContentSnapshots("faq", FAQ_FILE, FaqSnapshot, validate_faq)
+user_states_data = {} # Для активных чатов поддержки (если не используете Persistence)
+reviews_data = []
+problems_data = []
+
+def load_bot_data():
+    """Открывает хранилище и загружает данные бота. Выполняется в потоке хранилища при запуске."""
+    global storage, user_states_data, reviews_data, problems_data
+    os.makedirs(DATA_DIR, exist_ok=True)
+    storage = create_storage(STORAGE_BACKEND)
+    user_registry.storage = storage
+    load_data(MENU_FILE) # Создает пустые файлы, если их еще нет
+    load_data(FAQ_FILE)
+    menu_snapshots.load_initial()
+    faq_snapshots.load_initial()
+    # Воркер держит в памяти только чаты своих гостей: чужие ведет и закрывает по TTL их воркер
+    user_states_data = {user_id: state for user_id, state in storage.load_user_states().items() if owns_user(user_id)}
+    now = _time.time()
+    for state in user_states_data.values():
+        state.setdefault("last_activity", now) # Чаты, открытые до появления TTL, отсчитываются с момента запуска
+    reviews_data = storage.load_records("reviews")
+    problems_data = storage.load_records("problems")
+
+class UserRegistry:
+    """
+    Реестр пользователей в памяти с отложенной записью (write-behind).
+    Обработчики только обновляют запись в памяти и помечают ее "грязной";
+    на диск изменения уходят пачкой по таймеру, при накоплении USERS_MAX_DIRTY
+    изменений и при остановке бота.
+    """
+
+    def __init__(self, storage=None):
+        self.storage = storage # Назначается в load_bot_data()
+        self._users = None # Загружается при первом обращении
+        self._dirty = set()
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self):
+        if self._users is None:
+            self._users = self.storage.load_users()
+
+    async def aload(self):
+        """Загружает реестр в потоке хранилища (вызывается при старте)."""
+        await run_in_storage(self._load_locked)
+
+    def _load_locked(self):
+        with self._lock:
+            self._ensure_loaded()
+
+    def get(self, user_id):
+        with self._lock:
+            self._ensure_loaded()
+            return self._users.get(str(user_id))
+
+    def touch(self, user) -> bool:
+        """
+        Регистрирует пользователя или обновляет 'last_seen' и данные профиля.
+        Возвращает True, если накопилось достаточно изменений для сброса на диск.
+        """
+        user_id_str = str(user.id)
+        now = datetime.now().isoformat()
+        today = datetime.now(MOSCOW_TZ).date().isoformat() # День для статистики - по Москве
+
+        user_mention_link = f"tg://user?id={user.id}"
+        if user.username:
+            user_mention_link = f"@{user.username}"
+
+        with self._lock:
+            self._ensure_loaded()
+            previous = self._users.get(user_id_str)
+            # Запись заменяется целиком (а не изменяется на месте), чтобы flush мог работать с поверхностной копией
+            last_seen = moscow_datetime(previous.get("last_seen")) if previous else None
+            first_visit_today = last_seen is None or last_seen.date().isoformat() != today
+            self._users[user_id_str] = {
+                "telegram_id": user.id,
+                "username": user.username,
+                "first_name": user.first_name,
+                "last_name": user.last_name,
+                "profile_link": user_mention_link, # Обновляем на случай изменения username
+                "first_seen": previous["first_seen"] if previous else now,
+                "last_seen": now
+            }
+            self._dirty.add(user_id_str)
+            needs_flush = len(self._dirty) >= USERS_MAX_DIRTY
+
+        if first_visit_today:
+            stats_rollups.add("users", day=today)
+        if previous is None:
+            stats_rollups.add("new_users", day=today)
+            logger.info(f"Новый пользователь зарегистрирован: {user_id_str} ({user.username or user.full_name})")
+        return needs_flush
+
+    @property
+    def dirty_count(self) -> int:
+        return len(self._dirty)
+
+    def flush(self) -> int:
+        """Сохраняет накопленные изменения одной записью. Возвращает число сохраненных пользователей."""
+        with self._lock:
+            if not self._dirty:
+                return 0
+            flushed = len(self._dirty)
+            changed = {user_id: self._users[user_id] for user_id in self._dirty}
+            self._dirty = set()
+        self.storage.save_users(changed)
+        logger.debug(f"Реестр пользователей сохранен: {flushed} изменений.")
+        return flushed
+
+    async def aflush(self) -> int:
+        """Асинхронный сброс изменений через поток хранилища."""
+        return await run_in_storage(self.flush)
+
+user_registry = UserRegistry()
+
+def moscow_datetime(timestamp: str) -> datetime | None:
+    """Время записи по Москве. Журналы хранят местное время сервера без пояса, брони - время с поясом."""
+    try:
+        return datetime.fromisoformat(timestamp).astimezone(MOSCOW_TZ)
+    except (TypeError, ValueError):
+        return None
+
+class StatsRollups:
+    """
+    Счетчики статистики, которые обновляются в момент записи события, а не пересчитываются
+    по логам. Ключ счетчика - (день, метрика, метка): метка - час для сообщений, слот для
+    броней, пустая строка для остальных метрик. В памяти копятся только приращения; они
+    уходят в хранилище пачкой по таймеру и перед ответом на /stats. Приращения складываются,
+    поэтому воркеры пишут их в общую базу независимо друг от друга. Дни и часы - по Москве.
+    """
+
+    def __init__(self):
+        self._pending = {} # (день, метрика, метка) -> приращение
+        self._lock = threading.Lock()
+
+    def add(self, metric: str, label="", amount: int = 1, day: str | None = None):
+        key = (day or datetime.now(MOSCOW_TZ).date().isoformat(), metric, str(label))
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + amount
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    def flush(self) -> int:
+        """Сохраняет накопленные приращения одной записью. Возвращает число измененных счетчиков."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            storage.add_rollups(pending)
+        except Exception:
+            # Возвращаем приращения в очередь, чтобы не потерять их при следующем сбросе
+            with self._lock:
+                for key, value in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + value
+            raise
+        return len(pending)
+
+    async def aflush(self) -> int:
+        return await run_in_storage(self.flush)
+
+    async def query(self, since: date, until: date) -> dict:
+        """Счетчики за период (включительно) вместе с еще не сохраненными приращениями."""
+        await self.aflush()
+        return await run_in_storage(storage.load_rollups, since.isoformat(), until.isoformat())
 
-    save_data(USERS_FILE, users)
+stats_rollups = StatsRollups()
 
-def _log_message(update: Update):
+# --- Функции логирования ---
+
+async def _log_user(user):
+    """Логирует информацию о пользователе, если он еще не зарегистрирован, или обновляет 'last_seen'."""
+    if user_registry.touch(user):
+        await user_registry.aflush()
+
+async def _log_message(update: Update):
     """Логирует все текстовые сообщения от пользователей."""
     user = update.effective_user
     message = update.effective_message
 
     if message and message.text:
-        messages = load_data(MESSAGES_FILE, default_value=[])
+        now = datetime.now()
         message_entry = {
             "message_id": message.message_id,
             "user_id": user.id,
             "username": user.username, # Добавлено для удобства поиска
             "text": message.text,
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": now.isoformat(),
             "chat_id": update.effective_chat.id
         }
-        messages.append(message_entry)
-        save_data(MESSAGES_FILE, messages)
+        await run_in_storage(storage.append_message, message_entry) # Дозапись одной записи вместо перезаписи всего файла
+        moscow_now = now.astimezone(MOSCOW_TZ)
+        stats_rollups.add("messages", f"{moscow_now.hour:02d}", day=moscow_now.date().isoformat())
         logger.info(f"Сообщение от {user.id} ({user.username or user.full_name}): {message.text}")
 
-def _log_review(update: Update, review_text: str):
-    """Логирует отзыв пользователя."""
-    user = update.effective_user
-    reviews = load_data(REVIEWS_FILE, default_value=[])
-    review_entry = {
-        "user_id": user.id,
-        "username": user.username, # Добавлено
-        "first_name": user.first_name, # Добавлено
-        "last_name": user.last_name, # Добавлено
-        "review_text": review_text,
-        "timestamp": datetime.now().isoformat(),
-        "chat_id": update.effective_chat.id
-    }
-    reviews.append(review_entry) 
-    save_data(REVIEWS_FILE, reviews)
-    logger.info(f"Пользователь {user.id} ({user.username or user.full_name}) оставил отзыв: {review_text}")
+# --- Очередь исходящих уведомлений в админ-чат ---
+
+# Классы приоритета (меньше - важнее)
+PRIORITY_RESERVATION = 0
+PRIORITY_LIVE_CHAT = 1
+PRIORITY_PROBLEM = 2
+PRIORITY_REVIEW = 3
+PRIORITY_NAMES = {
+    PRIORITY_RESERVATION: "reservation",
+    PRIORITY_LIVE_CHAT: "live_chat",
+    PRIORITY_PROBLEM: "problem",
+    PRIORITY_REVIEW: "review",
+}
 
-def _log_problem(update: Update, problem_text: str):
-    """Логирует сообщение о проблеме от пользователя."""
-    user = update.effective_user
-    problems = load_data(PROBLEMS_FILE, default_value=[])
-    problem_entry = {
-        "user_id": user.id,
-        "username": user.username, # Добавлено
-        "first_name": user.first_name, # Добавлено
-        "last_name": user.last_name, # Добавлено
-        "problem_text": problem_text,
-        "timestamp": datetime.now().isoformat(),
-        "chat_id": update.effective_chat.id
-    }
-    problems.append(problem_entry)
-    save_data(PROBLEMS_FILE, problems)
-    logger.info(f"Пользователь {user.id} ({user.username or user.full_name}) сообщил о проблеме: {problem_text}")
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity в запасе."""
 
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = _time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до появления одного токена (0 - можно отправлять сейчас)."""
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+class ReplyRoutes:
+    """
+    Таблица "ID сообщения в админ-чате -> ID гостя" для ответов админа реплаем.
+    В памяти - LRU на capacity последних сообщений, на диске - журнал пар [message_id, user_id],
+    который переписывается заново, когда становится вдвое длиннее таблицы.
+    """
+
+    def __init__(self, filepath: str, capacity: int):
+        self.filepath = filepath
+        self.capacity = capacity
+        self._routes = OrderedDict()
+        self._lines_on_disk = 0
+        self._fh = None
+
+    def __len__(self):
+        return len(self._routes)
+
+    def load(self):
+        """Читает журнал маршрутов. Выполняется в потоке хранилища при запуске."""
+        self._routes.clear()
+        self._lines_on_disk = 0
+        if os.path.exists(self.filepath):
+            with open(self.filepath, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        message_id, user_id = json.loads(line)
+                    except (json.JSONDecodeError, ValueError, TypeError):
+                        continue # Недописанная строка после аварийной остановки
+                    _lru_put(self._routes, message_id, user_id, self.capacity)
+                    self._lines_on_disk += 1
+        self._compact() # Заодно отрезаем возможную недописанную строку
+
+    def lookup(self, message_id: int) -> int | None:
+        user_id = self._routes.get(message_id)
+        if user_id is not None:
+            self._routes.move_to_end(message_id)
+        return user_id
+
+    async def record(self, message_id: int, user_id: int):
+        _lru_put(self._routes, message_id, user_id, self.capacity)
+        await run_in_storage(self._append, message_id, user_id)
+
+    def _append(self, message_id, user_id):
+        if self._fh is None:
+            self._fh = open(self.filepath, 'a', encoding='utf-8')
+        self._fh.write(json.dumps([message_id, user_id]) + "\n")
+        self._fh.flush()
+        self._lines_on_disk += 1
+        if self._lines_on_disk > 2 * self.capacity:
+            self._compact()
+
+    def _compact(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        routes = list(self._routes.items())
+        os.makedirs(os.path.dirname(self.filepath) or ".", exist_ok=True)
+        tmp_path = f"{self.filepath}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps([message_id, user_id]) + "\n" for message_id, user_id in routes)
+        os.replace(tmp_path, self.filepath)
+        self._lines_on_disk = len(routes)
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+reply_routes = ReplyRoutes(REPLY_ROUTES_FILE, REPLY_ROUTES_SIZE)
+
+class ForumTopics:
+    """
+    Темы форума в админ-чате: одна тема на гостя живого чата.
+    Хранит индексы гость -> тема и тема -> гость; файл переписывается только при создании темы.
+    """
+
+    def __init__(self, filepath: str, enabled: bool):
+        self.filepath = filepath
+        self.enabled = enabled
+        self._topics = {} # user_id -> {"thread_id": ..., "name": ...}
+        self._users_by_thread = {}
+        self._lock = asyncio.Lock()
+
+    def load(self):
+        """Читает сохраненные темы. Выполняется в потоке хранилища при запуске."""
+        topics = load_data(self.filepath, {}) if self.enabled else {}
+        self._topics = {int(user_id): topic for user_id, topic in topics.items()}
+        self._users_by_thread = {topic["thread_id"]: user_id for user_id, topic in self._topics.items()}
+
+    def thread_for(self, user_id: int) -> int | None:
+        topic = self._topics.get(user_id)
+        return topic["thread_id"] if topic else None
+
+    def user_for_thread(self, thread_id: int) -> int | None:
+        return self._users_by_thread.get(thread_id)
+
+    async def ensure(self, bot, user_id: int, name: str) -> int:
+        """Возвращает тему гостя, создавая ее при первом обращении."""
+        thread_id = self.thread_for(user_id)
+        if thread_id is not None:
+            return thread_id
+        async with self._lock:
+            thread_id = self.thread_for(user_id)
+            if thread_id is None:
+                thread_id = await self._create(bot, user_id, name)
+        return thread_id
+
+    async def recreate(self, bot, user_id: int) -> int:
+        """Создает тему заново (старую удалили в админ-чате)."""
+        async with self._lock:
+            topic = self._topics.pop(user_id, None)
+            if topic is not None:
+                self._users_by_thread.pop(topic["thread_id"], None)
+            return await self._create(bot, user_id, topic["name"] if topic else str(user_id))
+
+    async def _create(self, bot, user_id, name):
+        # Создание темы идет напрямую, а не через admin_outbox: recreate вызывается из обработчика очереди
+        topic = await bot.create_forum_topic(chat_id=ADMIN_CHAT_ID, name=f"{name} ({user_id})"[:128])
+        thread_id = topic.message_thread_id
+        self._topics[user_id] = {"thread_id": thread_id, "name": name}
+        self._users_by_thread[thread_id] = user_id
+        snapshot = {str(uid): dict(t) for uid, t in self._topics.items()}
+        await run_in_storage(_atomic_write_json, self.filepath, snapshot)
+        logger.info(f"Создана тема {thread_id} в админ-чате для гостя {user_id}.")
+        return thread_id
+
+forum_topics = ForumTopics(FORUM_TOPICS_FILE, ADMIN_FORUM_TOPICS)
+
+def admin_thread_kwargs(user_id: int) -> dict:
+    """Параметр message_thread_id для сообщений живого чата, если у гостя есть тема форума."""
+    thread_id = forum_topics.thread_for(user_id) if forum_topics.enabled else None
+    return {"message_thread_id": thread_id} if thread_id is not None else {}
+
+async def ensure_guest_topic(bot, user) -> None:
+    """Создает тему форума для гостя (в режиме ADMIN_FORUM_TOPICS). Без темы сообщения идут в общий чат."""
+    if not forum_topics.enabled:
+        return
+    try:
+        await forum_topics.ensure(bot, user.id, user.full_name)
+    except Exception as e:
+        logger.error(f"Не удалось создать тему форума для гостя {user.id}: {e}")
+
+class AdminOutbox:
+    """
+    Центральный планировщик сообщений в админ-чат.
+    Все уведомления (брони, живой чат, проблемы, отзывы) ставятся в одну очередь
+    с приоритетами и отправляются одной задачей с учетом общего лимита бота и лимита
+    на чат (token bucket). RetryAfter от Telegram выдерживается и сообщение отправляется
+    повторно, а не теряется. Сообщение, не ушедшее из-за сетевой ошибки, откладывается
+    до времени повтора и не задерживает остальную очередь.
+    """
+
+    def __init__(self, global_rate: float, chat_rate_per_minute: float, chat_burst: int):
+        self.global_bucket = TokenBucket(global_rate, max(1.0, global_rate))
+        self.chat_rate = chat_rate_per_minute / 60
+        self.chat_burst = chat_burst
+        self._chat_buckets = {}
+        # (приоритет, порядковый номер, chat_id, метод, kwargs, гость для reply_routes, future, сделано попыток)
+        self._heap = []
+        self._deferred = [] # (не раньше чем, порядковый номер, элемент очереди) - повтор после сетевой ошибки
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._worker = None
+        self._bot = None
+        self.sent = 0
+        self.failed = 0
+        self.retry_after_count = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self._heap) + len(self._deferred)
+
+    def stats(self) -> dict:
+        by_priority = {name: 0 for name in PRIORITY_NAMES.values()}
+        for item in itertools.chain(self._heap, (deferred[2] for deferred in self._deferred)):
+            by_priority[PRIORITY_NAMES.get(item[0], str(item[0]))] += 1
+        return {"depth": self.depth, "deferred": len(self._deferred), "by_priority": by_priority,
+                "sent": self.sent, "failed": self.failed, "retry_after": self.retry_after_count}
+
+    def start(self, bot):
+        self._bot = bot
+        self._wakeup = asyncio.Event()
+        if self._heap:
+            self._wakeup.set()
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self, drain_timeout: float = 10.0):
+        """
+        Дожидается отправки очереди (не дольше drain_timeout) и останавливает обработчик.
+        Вызывается из post_stop, пока бот еще может обращаться к Bot API.
+        """
+        if self._worker is None:
+            return
+        deadline = _time.monotonic() + drain_timeout
+        while self.depth and _time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+        self._worker = None
+        if self.depth:
+            logger.warning(f"Очередь админ-чата не отправлена полностью при остановке: {self.depth} сообщений.")
+            # Ожидающие отправки получают ошибку, а не зависают навсегда
+            for item in itertools.chain(self._heap, (deferred[2] for deferred in self._deferred)):
+                if not item[6].done():
+                    item[6].set_exception(RuntimeError("очередь админ-чата остановлена"))
+            self._heap.clear()
+            self._deferred.clear()
+
+    def submit(self, priority: int, method: str, route_to: int | None = None, **kwargs) -> asyncio.Future:
+        """
+        Ставит вызов метода Bot API (например, 'send_message') в очередь. Результат - future с ответом Telegram.
+        route_to - ID гостя, к которому относится сообщение: после отправки оно попадет в reply_routes.
+        """
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), kwargs.get("chat_id"), method, kwargs, route_to, future, 0))
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return future
+
+    async def send(self, priority: int, method: str, route_to: int | None = None, **kwargs):
+        """Ставит сообщение в очередь и ждет, пока оно будет отправлено."""
+        return await self.submit(priority, method, route_to, **kwargs)
+
+    def notify(self, priority: int, method: str, route_to: int | None = None, **kwargs) -> None:
+        """Ставит сообщение в очередь, не дожидаясь отправки (ошибки только логируются)."""
+        future = self.submit(priority, method, route_to, **kwargs)
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def _release_deferred(self, now: float):
+        """Возвращает в очередь отложенные сообщения, время повтора которых наступило."""
+        while self._deferred and self._deferred[0][0] <= now:
+            heapq.heappush(self._heap, heapq.heappop(self._deferred)[2])
+
+    async def _wait_for_wakeup(self, timeout: float | None):
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self):
+        while True:
+            now = _time.monotonic()
+            self._release_deferred(now)
+            if not self._heap:
+                # Спим до нового сообщения или до ближайшего повтора отложенного
+                await self._wait_for_wakeup(self._deferred[0][0] - now if self._deferred else None)
+                continue
+            chat_id = self._heap[0][2]
+            delay = max(self.global_bucket.delay(now), self._chat_bucket(chat_id).delay(now))
+            if delay > 0:
+                # Ждем токен, но просыпаемся раньше, если пришло новое (возможно, более важное) сообщение
+                await self._wait_for_wakeup(delay)
+                continue
+            item = heapq.heappop(self._heap)
+            self.global_bucket.consume()
+            self._chat_bucket(chat_id).consume()
+            await self._deliver(item)
+
+    async def _deliver(self, item):
+        priority, seq, chat_id, method, kwargs, route_to, future, attempt = item
+        error = None
+        while attempt < OUTBOX_MAX_ATTEMPTS:
+            attempt += 1
+            try:
+                result = await getattr(self._bot, method)(**kwargs)
+            except RetryAfter as e:
+                # Telegram просит подождать - ждем и повторяем (вся очередь стоит, т.к. лимит общий)
+                self.retry_after_count += 1
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else float(e.retry_after)
+                logger.warning(f"RetryAfter {retry_after} с при {method} в чат {kwargs.get('chat_id')}, ждем.")
+                await asyncio.sleep(retry_after)
+                continue
+            except BadRequest as e:
+                # Тему гостя удалили в админ-чате - создаем новую и отправляем туда же
+                topic_missing = any(marker in str(e).lower() for marker in ("thread not found", "topic_deleted"))
+                if topic_missing and route_to is not None and "message_thread_id" in kwargs and attempt < OUTBOX_MAX_ATTEMPTS:
+                    try:
+                        kwargs["message_thread_id"] = await forum_topics.recreate(self._bot, route_to)
+                        continue
+                    except Exception as create_error:
+                        logger.error(f"Не удалось пересоздать тему для гостя {route_to}: {create_error}")
+                error = e
+            except (TimedOut, NetworkError) as e:
+                if attempt < OUTBOX_MAX_ATTEMPTS:
+                    # Откладываем только это сообщение: остальная очередь продолжает отправляться
+                    retry_at = _time.monotonic() + min(2 ** attempt, 30)
+                    heapq.heappush(self._deferred, (retry_at, seq, (priority, seq, chat_id, method, kwargs, route_to, future, attempt)))
+                    logger.warning(f"Сетевая ошибка при {method} в чат {kwargs.get('chat_id')} (попытка {attempt}): {e}. "
+                                   f"Повтор через {min(2 ** attempt, 30)} с.")
+                    return
+                error = e
+            except Exception as e:
+                error = e
+            else:
+                self.sent += 1
+                if route_to is not None and getattr(result, "message_id", None):
+                    try:
+                        await reply_routes.record(result.message_id, route_to)
+                    except Exception as e:
+                        logger.error(f"Не удалось сохранить маршрут ответа для сообщения {result.message_id}: {e}")
+                if not future.done():
+                    future.set_result(result)
+                return
+            break
+        self.failed += 1
+        if error is None:
+            error = RuntimeError("превышено число попыток отправки")
+            logger.error(f"{method} в чат {kwargs.get('chat_id')} не отправлен после {OUTBOX_MAX_ATTEMPTS} попыток.")
+        else:
+            logger.error(f"Не удалось отправить {method} ({PRIORITY_NAMES.get(priority, priority)}) в чат {kwargs.get('chat_id')}: {error}")
+        if not future.done():
+            future.set_exception(error)
+
+admin_outbox = AdminOutbox(OUTBOX_GLOBAL_RATE, OUTBOX_CHAT_RATE_PER_MINUTE, OUTBOX_CHAT_BURST)
 
 # --- Вспомогательные функции ---
 
@@ -241,6 +2309,7 @@ def get_main_keyboard():
         [InlineKeyboardButton("🍽️ Меню", callback_data="menu")],
         [InlineKeyboardButton("❓ Вопросы", callback_data="faq")],
         [InlineKeyboardButton("📝 Забронировать стол", callback_data="start_reservation")],
+        [InlineKeyboardButton("📋 Мои брони", callback_data="my_reservations")],
         [InlineKeyboardButton("✍️ Оставить отзыв", callback_data="start_review")],
         [InlineKeyboardButton("⚠️ Сообщить о проблеме", callback_data="start_problem")],
         [InlineKeyboardButton("🗣️ Связаться со службой заботы", callback_data="support")]
@@ -272,8 +2341,8 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         "Чем мы можем Вам помочь?",
         reply_markup=get_main_keyboard()
     )
-    _log_user(user)
-    _log_message(update) # Логируем само сообщение /start
+    await _log_user(user)
+    await _log_message(update) # Логируем само сообщение /start
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /help."""
@@ -283,14 +2352,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         "Мы можем:\n"
         "- Показать Вам меню;\n"
         "- Ответить на часто задаваемые вопросы;\n"
-        "- Забронировать стол;\n"
+        "- Забронировать стол, показать или отменить Ваши брони (/mybookings);\n"
         "- Принять Ваш отзыв или сообщение о проблеме;\n"
         "- Связать Вас с менеджером службы заботы о наших гостях;\n\n"
         "Воспользуйтесь кнопками ниже:",
         reply_markup=get_main_keyboard()
     )
-    _log_user(user)
-    _log_message(update) # Логируем само сообщение /help
+    await _log_user(user)
+    await _log_message(update) # Логируем само сообщение /help
 
 # --- Функции меню ---
 
@@ -300,15 +2369,9 @@ async def show_menu_categories(update: Update, context: ContextTypes.DEFAULT_TYP
     query = update.callback_query
     await query.answer()
 
-    keyboard = []
-    for category in menu_data.keys():
-        keyboard.append([InlineKeyboardButton(category, callback_data=f"menu_cat_{category}")])
-    keyboard.append([InlineKeyboardButton("🔙 В главное меню", callback_data="start")])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(text="Выберите категорию меню:", reply_markup=reply_markup)
-    _log_user(user)
-    _log_message(update) # Логируем само сообщение /menu
+    await query.edit_message_text(text="Выберите категорию меню:", reply_markup=menu_snapshots.current.categories_markup)
+    await _log_user(user)
+    await _log_message(update) # Логируем само сообщение /menu
     return MENU_CATEGORY
 
 async def show_menu_items(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -316,29 +2379,21 @@ async def show_menu_items(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user = update.effective_user
     query = update.callback_query
     await query.answer()
-    category = query.data.replace("menu_cat_", "")
+    version, category = _parse_versioned_callback(query.data, "menu_cat_")
 
-    if category not in menu_data:
+    snapshot = menu_snapshots.get(version) # Берем ссылку один раз: весь ответ строится из одного снимка
+    message_text = snapshot.category_text(category)
+    if message_text is None:
         await query.edit_message_text("Извините, эта категория не найдена.")
         return await show_menu_categories(update, context)
 
-    items = menu_data[category]
-    message_text = f"--- {category} ---\n\n"
-    for item in items:
-        message_text += f"*{item['name']}* \n"
-        message_text += f"{item['description']} \n"
-        message_text += f"_Цена:_ {item['price']}₽ \n\n"
-
-    keyboard = [[InlineKeyboardButton("🔙 К категориям", callback_data="menu")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await query.edit_message_text(
         text=message_text,
-        reply_markup=reply_markup,
-        parse_mode="Markdown"
+        reply_markup=snapshot.category_markup,
+        parse_mode=MenuSnapshot.PARSE_MODE
     )
-    _log_user(user)
-    _log_message(update) # Логируем само сообщение /menu
+    await _log_user(user)
+    await _log_message(update) # Логируем само сообщение /menu
     return MENU_ITEM
 
 
@@ -350,15 +2405,9 @@ async def show_faq_questions(update: Update, context: ContextTypes.DEFAULT_TYPE)
     query = update.callback_query
     await query.answer()
 
-    keyboard = []
-    for i, item in enumerate(faq_data.get("Вопросы", [])):
-        keyboard.append([InlineKeyboardButton(item['question'], callback_data=f"faq_q_{i}")])
-    keyboard.append([InlineKeyboardButton("🔙 В главное меню", callback_data="start")])
-
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(text="Выберите вопрос, чтобы узнать ответ:", reply_markup=reply_markup)
-    _log_user(user)
-    _log_message(update) # Логируем само сообщение /faq
+    await query.edit_message_text(text="Выберите вопрос, чтобы узнать ответ:", reply_markup=faq_snapshots.current.questions_markup)
+    await _log_user(user)
+    await _log_message(update) # Логируем само сообщение /faq
     return FAQ_QUESTION
 
 async def show_faq_answer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -366,25 +2415,20 @@ async def show_faq_answer(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user = update.effective_user
     query = update.callback_query
     await query.answer()
-    index = int(query.data.replace("faq_q_", ""))
+    version, index = _parse_versioned_callback(query.data, "faq_q_")
 
-    questions = faq_data.get("Вопросы", [])
-    if 0 <= index < len(questions):
-        question_item = questions[index]
-        message_text = f"*{question_item['question']}*\n\n{question_item['answer']}"
-    else:
+    snapshot = faq_snapshots.get(version)
+    message_text = snapshot.answer_text(int(index)) if str(index).isdigit() else None
+    if message_text is None:
         message_text = "Извините, вопрос не найден."
 
-    keyboard = [[InlineKeyboardButton("🔙 К вопросам", callback_data="faq")]]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-
     await query.edit_message_text(
         text=message_text,
-        reply_markup=reply_markup,
-        parse_mode="Markdown"
+        reply_markup=snapshot.answer_markup,
+        parse_mode=FaqSnapshot.PARSE_MODE
     )
-    _log_user(user)
-    _log_message(update) # Логируем само сообщение /faq_ques
+    await _log_user(user)
+    await _log_message(update) # Логируем само сообщение /faq_ques
     return FAQ_QUESTION
 
     # --- Функции Отзывов ---
@@ -409,8 +2453,8 @@ async def start_review(update: Update, context: ContextTypes.DEFAULT_TYPE) -> in
     else:
         logger.error("start_review вызван без update.message или update.callback_query")
         return ConversationHandler.END # Завершаем, если не удалось определить, куда отвечать
-    _log_user(user)
-    _log_message(update) # Логируем само сообщение
+    await _log_user(user)
+    await _log_message(update) # Логируем само сообщение
     return REVIEW_TEXT
 
 async def process_review(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
@@ -440,7 +2484,7 @@ async def process_review(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         review_entry["type"] = "text"
         admin_notification_text += f"Текст отзыва: {escape(message.text)}" # Экранируем для админов
         # Отправляем сообщение админам
-        await context.bot.send_message(
+        admin_outbox.notify(PRIORITY_REVIEW, "send_message", route_to=user.id,
             chat_id=ADMIN_CHAT_ID,
             text=admin_notification_text,
             parse_mode="HTML"
@@ -457,7 +2501,7 @@ async def process_review(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         else:
             admin_notification_text += "Без подписи"
         # Пересылаем фото админам
-        await context.bot.send_photo(
+        admin_outbox.notify(PRIORITY_REVIEW, "send_photo", route_to=user.id,
             chat_id=ADMIN_CHAT_ID,
             photo=photo_file_id,
             caption=admin_notification_text,
@@ -475,7 +2519,7 @@ async def process_review(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         else:
             admin_notification_text += "Без подписи"
         # Пересылаем видео админам
-        await context.bot.send_video(
+        admin_outbox.notify(PRIORITY_REVIEW, "send_video", route_to=user.id,
             chat_id=ADMIN_CHAT_ID,
             video=video_file_id,
             caption=admin_notification_text,parse_mode="HTML"
@@ -492,7 +2536,7 @@ async def process_review(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         else:
             admin_notification_text += "Без подписи"
         # Пересылаем голосовое админам
-        await context.bot.send_voice(
+        admin_outbox.notify(PRIORITY_REVIEW, "send_voice", route_to=user.id,
             chat_id=ADMIN_CHAT_ID,
             voice=voice_file_id,
             caption=admin_notification_text, # Подпись у голосового может быть короткой
@@ -512,7 +2556,8 @@ async def process_review(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # !!! Используем ГЛОБАЛЬНУЮ переменную reviews_data !!!
         global reviews_data 
         reviews_data.append(review_entry)
-        save_data(REVIEWS_FILE, reviews_data) # Сохраняем данные в файл
+        await run_in_storage(storage.append_record, "reviews", review_entry) # Сохраняем только новую запись
+        stats_rollups.add("reviews")
 
     await update.message.reply_text(
        "Спасибо за Ваш отзыв! Мы стараемся для Вас!",
@@ -583,7 +2628,7 @@ async def process_problem(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         admin_notification_text = f"{admin_notification_text_prefix}Проблема: {escape(message.text)}" # Экранируем для админов
 
         # Отправляем сообщение админам
-        await context.bot.send_message(
+        admin_outbox.notify(PRIORITY_PROBLEM, "send_message", route_to=user.id,
             chat_id=ADMIN_CHAT_ID,
             text=admin_notification_text,
             parse_mode="HTML"
@@ -601,7 +2646,7 @@ async def process_problem(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             admin_notification_text = f"{admin_notification_text_prefix}Проблема (фото без подписи)"
 
         # Пересылаем фото админам
-        await context.bot.send_photo(
+        admin_outbox.notify(PRIORITY_PROBLEM, "send_photo", route_to=user.id,
             chat_id=ADMIN_CHAT_ID,
             photo=photo_file_id,
             caption=admin_notification_text,
@@ -620,7 +2665,7 @@ async def process_problem(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             admin_notification_text = f"{admin_notification_text_prefix}Проблема (видео без подписи)"
 
         # Пересылаем видео админам
-        await context.bot.send_video(
+        admin_outbox.notify(PRIORITY_PROBLEM, "send_video", route_to=user.id,
             chat_id=ADMIN_CHAT_ID,video=video_file_id,
             caption=admin_notification_text,
             parse_mode="HTML"
@@ -638,7 +2683,7 @@ async def process_problem(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             admin_notification_text = f"{admin_notification_text_prefix}Проблема (голосовое без подписи)"
 
         # Пересылаем голосовое админам
-        await context.bot.send_voice(
+        admin_outbox.notify(PRIORITY_PROBLEM, "send_voice", route_to=user.id,
             chat_id=ADMIN_CHAT_ID,
             voice=voice_file_id,
             caption=admin_notification_text,
@@ -655,7 +2700,8 @@ async def process_problem(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
     # --- Сохраняем проблему и отвечаем пользователю ---
     problems_data.append(problem_entry)
-    save_data(PROBLEMS_FILE, problems_data)
+    await run_in_storage(storage.append_record, "problems", problem_entry)
+    stats_rollups.add("problems")
 
     await update.message.reply_text(
        "Спасибо за сообщение. Мы уже работаем над решением!",
@@ -690,6 +2736,110 @@ async def _send_chat_status_message(update: Update, context: ContextTypes.DEFAUL
 
 # --- Функции Live Chat (Служба поддержки) ---
 
+class AdminMessageCoalescer:
+    """
+    Склеивает подряд идущие текстовые сообщения гостя в одно сообщение в админ-чате.
+    Первое сообщение окна отправляется сразу; текст, пришедший в течение окна,
+    накапливается и дописывается в него одним редактированием в конце окна.
+    Так пять коротких строк гостя дают одну отправку и одно редактирование вместо пяти отправок.
+    """
+    MAX_TEXT_LENGTH = 4000 # Лимит Telegram - 4096 символов, оставляем запас под префикс
+
+    def __init__(self, window_seconds: float):
+        self.window_seconds = window_seconds
+        self._windows = {} # user_id -> открытое окно склейки
+
+    async def send_text(self, bot, user_id: str, prefix: str, safe_text: str, reply_markup):
+        """Отправляет текст гостя админам или дописывает его в сообщение текущего окна."""
+        loop = asyncio.get_running_loop()
+        window = self._windows.get(user_id)
+        if window is not None:
+            fits = len(window["prefix"]) + len(window["text"]) + len(safe_text) + 1 <= self.MAX_TEXT_LENGTH
+            if loop.time() < window["expires"] and fits:
+                window["text"] += "\n" + safe_text
+                window["dirty"] = True
+                if window["task"] is None:
+                    window["task"] = asyncio.create_task(self._flush_when_expired(bot, user_id, window))
+                return
+            await self.flush(bot, user_id)
+
+        # Не ждем отправки: при очереди в админ-чат обработчик не должен задерживать следующие обновления
+        sent = admin_outbox.submit(PRIORITY_LIVE_CHAT, "send_message", route_to=int(user_id),
+            chat_id=ADMIN_CHAT_ID,
+            **admin_thread_kwargs(int(user_id)),
+            text=f"{prefix}{safe_text}",
+            parse_mode="HTML",
+            reply_markup=reply_markup,
+            disable_web_page_preview=True # Отключаем превью ссылок
+        )
+        sent.add_done_callback(lambda f: f.cancelled() or f.exception())
+        if self.window_seconds > 0:
+            self._windows[user_id] = {
+                "sent": sent, # future с отправленным сообщением (нужен его message_id для редактирования)
+                "prefix": prefix,
+                "text": safe_text,
+                "reply_markup": reply_markup,
+                "expires": loop.time() + self.window_seconds,
+                "dirty": False,
+                "task": None,
+            }
+
+    async def _flush_when_expired(self, bot, user_id: str, window: dict):
+        await asyncio.sleep(max(0.0, window["expires"] - asyncio.get_running_loop().time()))
+        if self._windows.get(user_id) is window:
+            window["task"] = None # Сама задача не должна отменять себя во flush
+            await self.flush(bot, user_id)
+
+    async def flush(self, bot, user_id: str):
+        """
+        Закрывает окно гостя и, если текст дописывался, планирует редактирование сообщения в админ-чате.
+        Возвращает задачу редактирования (или None): она ждет, пока исходное сообщение выйдет из очереди.
+        """
+        window = self._windows.pop(user_id, None)
+        if window is None:
+            return None
+        if window["task"] is not None:
+            window["task"].cancel()
+        if not window["dirty"]:
+            return None
+        return asyncio.create_task(self._edit_when_sent(user_id, window))
+
+    async def _edit_when_sent(self, user_id: str, window: dict):
+        try:
+            message = await window["sent"]
+        except Exception as e:
+            logger.error(f"Не удалось дописать сообщения гостя {user_id} в админ-чат: исходное сообщение не отправлено ({e})")
+            return
+        admin_outbox.notify(PRIORITY_LIVE_CHAT, "edit_message_text",
+            chat_id=ADMIN_CHAT_ID,
+            message_id=message.message_id,
+            text=f"{window['prefix']}{window['text']}",
+            parse_mode="HTML",
+            reply_markup=window["reply_markup"],
+            disable_web_page_preview=True
+        )
+
+    async def flush_all(self, bot):
+        """
+        Закрывает все окна и дожидается постановки редактирований в очередь.
+        Вызывается из post_stop до остановки очереди админ-чата, иначе правки не будут отправлены.
+        """
+        tasks = [await self.flush(bot, user_id) for user_id in list(self._windows)]
+        await asyncio.gather(*(task for task in tasks if task is not None))
+
+live_chat_coalescer = AdminMessageCoalescer(LIVE_CHAT_COALESCE_SECONDS)
+
+async def touch_live_chat(user_id: str) -> None:
+    """Отмечает активность в чате поддержки (для автозакрытия по LIVE_CHAT_IDLE_TTL)."""
+    state = user_states_data.get(user_id)
+    if state is None:
+        return
+    now = _time.time()
+    previous = state.get("last_activity", 0)
+    state["last_activity"] = now
+    if now - previous >= LIVE_CHAT_ACTIVITY_WRITE_INTERVAL:
+        await run_in_storage(storage.put_user_state, user_id, dict(state))
+
 async def start_live_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начинает чат пользователя с менеджером."""
     query = update.callback_query
@@ -707,12 +2857,15 @@ async def start_live_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await _send_chat_status_message(update, context, is_new_chat=True)
 
     # Сохраняем состояние пользователя
-    user_states_data[user_id] = {"state": "chat_active", "admin_chat_id": ADMIN_CHAT_ID}
-    save_data(USER_STATES_FILE, user_states_data)
+    user_states_data[user_id] = {"state": "chat_active", "admin_chat_id": ADMIN_CHAT_ID, "last_activity": _time.time()}
+    await run_in_storage(storage.put_user_state, user_id, user_states_data[user_id])
+    stats_rollups.add("chats_opened")
 
-    # Уведомляем админов о новом запросе
-    await context.bot.send_message(
+    # Уведомляем админов о новом запросе (в режиме тем форума - в новую тему гостя)
+    await ensure_guest_topic(context.bot, user)
+    admin_outbox.notify(PRIORITY_LIVE_CHAT, "send_message", route_to=user.id,
         chat_id=ADMIN_CHAT_ID,
+        **admin_thread_kwargs(user.id),
         text=f"🗣️ НОВЫЙ ЗАПРОС В ПОДДЕРЖКУ: \n\n"
              f"От: {user.mention_html()} \n"
              f"Напишите /reply {user.id} для ответа пользователю или нажмите 'ответить' и напишите сообщение.",
@@ -720,6 +2873,19 @@ async def start_live_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     )
     return LIVE_CHAT_USER
 
+class LiveChatActiveFilter(filters.MessageFilter):
+    """
+    Пропускает сообщения только гостей с открытым чатом поддержки.
+    Чат закрывается и без участия диалога (по неактивности, админом), поэтому сохраненный
+    диалог live_chat может остаться в LIVE_CHAT_USER. Такие сообщения не перехватываются,
+    а достаются остальным обработчикам (например, мастеру бронирования).
+    """
+    def filter(self, message) -> bool:
+        user = message.from_user
+        return user is not None and user_states_data.get(str(user.id), {}).get("state") == "chat_active"
+
+live_chat_active = LiveChatActiveFilter(name="live_chat_active")
+
 async def handle_user_message_in_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Пересылает сообщение пользователя админам."""
     user = update.effective_user
@@ -734,6 +2900,8 @@ async def handle_user_message_in_chat(update: Update, context: ContextTypes.DEFA
 
     # Проверяем, что пользователь действительно в режиме чата
     if user_id in user_states_data and user_states_data[user_id].get("state") == "chat_active":
+        await touch_live_chat(user_id)
+        await ensure_guest_topic(context.bot, user)
         admin_message_prefix = f"💬 Новое сообщение от {user.mention_html()} (ID: {user.id}) \n\n"
         reply_markup_for_admin = InlineKeyboardMarkup(
             [[InlineKeyboardButton("🚫 Завершить этот чат", callback_data=f"admin_end_chat_{user_id}")]]
@@ -742,29 +2910,28 @@ async def handle_user_message_in_chat(update: Update, context: ContextTypes.DEFA
         message = update.message
 
         if message.text:
-            # Если это текстовое сообщение
+            # Если это текстовое сообщение - отправляем или дописываем в сообщение текущего окна склейки
             safe_text = escape(message.text) # Экранируем текст от HTML инъекций
-            await context.bot.send_message(
-                chat_id=ADMIN_CHAT_ID,
-                text=f"{admin_message_prefix}{safe_text}",
-                parse_mode="HTML",
-                reply_markup=reply_markup_for_admin,
-                disable_web_page_preview=True # Отключаем превью ссылок
-            )
-        elif message.photo:
+            await live_chat_coalescer.send_text(context.bot, user_id, admin_message_prefix, safe_text, reply_markup_for_admin)
+            await update.message.reply_text("Ваше сообщение отправлено менеджеру.")
+            return LIVE_CHAT_USER
+
+        # Медиа отправляется отдельным сообщением: сначала дописываем накопленный текст, чтобы не нарушить порядок
+        await live_chat_coalescer.flush(context.bot, user_id)
+        if message.photo:
             # Если это фото
             # Получаем самое большое разрешение фото (последний элемент в списке photo)
             photo_file_id = message.photo[-1].file_id
             caption_text = message.caption if message.caption else ""
             safe_caption = escape(caption_text) # Экранируем подпись
 
-            await context.bot.send_photo(
+            admin_outbox.notify(PRIORITY_LIVE_CHAT, "send_photo", route_to=user.id,
                 chat_id=ADMIN_CHAT_ID,
+                **admin_thread_kwargs(user.id),
                 photo=photo_file_id,
-                caption=f"{admin_message_prefix}{safe_text}",
+                caption=f"{admin_message_prefix}{safe_caption}",
                 parse_mode="HTML",
-                reply_markup=reply_markup_for_admin,
-                disable_web_page_preview=True # Отключаем превью ссылок
+                reply_markup=reply_markup_for_admin
             )
         elif message.video:
             # Если это видео
@@ -772,13 +2939,13 @@ async def handle_user_message_in_chat(update: Update, context: ContextTypes.DEFA
             caption_text = message.caption if message.caption else ""
             safe_caption = escape(caption_text) # Экранируем подпись
 
-            await context.bot.send_video(
+            admin_outbox.notify(PRIORITY_LIVE_CHAT, "send_video", route_to=user.id,
                 chat_id=ADMIN_CHAT_ID,
+                **admin_thread_kwargs(user.id),
                 video=video_file_id,
-                caption=f"{admin_message_prefix}{safe_text}",
+                caption=f"{admin_message_prefix}{safe_caption}",
                 parse_mode="HTML",
-                reply_markup=reply_markup_for_admin,
-                disable_web_page_preview=True # Отключаем превью ссылок
+                reply_markup=reply_markup_for_admin
             )
         elif message.voice:
             # Если это голосовое сообщение
@@ -786,25 +2953,25 @@ async def handle_user_message_in_chat(update: Update, context: ContextTypes.DEFA
             caption_text = message.caption if message.caption else "" # Голосовые тоже могут иметь подпись
             safe_caption = escape(caption_text) # Экранируем подпись
 
-            await context.bot.send_voice(
+            admin_outbox.notify(PRIORITY_LIVE_CHAT, "send_voice", route_to=user.id,
                 chat_id=ADMIN_CHAT_ID,
+                **admin_thread_kwargs(user.id),
                 voice=voice_file_id,
-                caption=f"{admin_message_prefix}{safe_text}",
+                caption=f"{admin_message_prefix}{safe_caption}",
                 parse_mode="HTML",
-                reply_markup=reply_markup_for_admin,
-                disable_web_page_preview=True # Отключаем превью ссылок
+                reply_markup=reply_markup_for_admin
             )
         elif message.document:
             file_id = message.document.file_id
             caption_text = message.caption if message.caption else ""
             safe_caption = escape(caption_text)
-            await context.bot.send_document(
+            admin_outbox.notify(PRIORITY_LIVE_CHAT, "send_document", route_to=user.id,
                 chat_id=ADMIN_CHAT_ID,
+                **admin_thread_kwargs(user.id),
                 document=file_id,
-                caption=f"{admin_message_prefix}{safe_text}",
+                caption=f"{admin_message_prefix}{safe_caption}",
                 parse_mode="HTML",
-                reply_markup=reply_markup_for_admin,
-                disable_web_page_preview=True # Отключаем превью ссылок
+                reply_markup=reply_markup_for_admin
             )
         else:
             # Если сообщение неизвестного или неподдерживаемого типа
@@ -814,13 +2981,10 @@ async def handle_user_message_in_chat(update: Update, context: ContextTypes.DEFA
         await update.message.reply_text("Ваше сообщение отправлено менеджеру.")
         return LIVE_CHAT_USER
     else:
-        # Если почему-то не в чате, но сообщение пришло сюда
-        # Очищаем некорректное состояние, если оно было
-        if "state" in context.user_data:
-            del context.user_data["state"]
-
-        await send_main_menu(update, context, "Не удалось определить ваше состояние. Пожалуйста, попробуйте еще раз.")
-        return ConversationHandler.END
+        # Чат закрыли (по неактивности или админ), пока сообщение ждало обработки:
+        # открываем новый чат и пересылаем в него это сообщение
+        await start_live_chat(update, context)
+        return await handle_user_message_in_chat(update, context)
 
 # --- НОВАЯ/МОДИФИЦИРОВАННАЯ Вспомогательная функция для извлечения user_id ---
 # Эта функция теперь будет искать ID в формате "(ID: 123456789)"
@@ -834,6 +2998,34 @@ def extract_user_id_from_text(text: str) -> int | None:
             return None
     return None
 
+def known_to_other_workers(message_id: int | None, thread_id: int | None) -> bool:
+    """
+    Знает ли гостя для этого ответа админа какой-нибудь другой воркер.
+    Читает с диска таблицы ответов и темы форума остальных воркеров. Нужна только воркеру 0,
+    когда фронт разослал ответ всем и свой воркер гостя не нашел: ошибку пишем, если не нашел никто.
+    """
+    for index in range(WORKERS):
+        if index == WORKER_INDEX:
+            continue
+        topics_path = os.path.join(DATA_DIR, f'forum_topics-{index}.json')
+        if thread_id is not None and os.path.exists(topics_path):
+            try:
+                with open(topics_path, 'r', encoding='utf-8') as f:
+                    if any(topic.get("thread_id") == thread_id for topic in json.load(f).values()):
+                        return True
+            except (OSError, json.JSONDecodeError, AttributeError):
+                pass
+        routes_path = os.path.join(DATA_DIR, f'reply_routes-{index}.jsonl')
+        if message_id is not None and os.path.exists(routes_path):
+            with open(routes_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        if json.loads(line)[0] == message_id:
+                            return True
+                    except (json.JSONDecodeError, ValueError, TypeError, IndexError):
+                        continue # Недописанная строка
+    return False
+
 async def handle_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """
     Обрабатывает ответ админа на сообщение, пересланное от пользователя.
@@ -851,33 +3043,64 @@ async def handle_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
     # Проверяем, что это ответ на сообщение бота
     # message.reply_to_message.from_user.id == context.bot.id
     # Это означает, что админ ответил на сообщение, которое отправил БОТ.
-    if message.reply_to_message and message.reply_to_message.from_user.id == context.bot.id:
-        # Текст оригинального сообщения, на которое ответил админ
-        original_bot_message_text = message.reply_to_message.text or message.reply_to_message.caption
-        
-        if not original_bot_message_text:
-            await update.message.reply_text("Не удалось найти исходный текст сообщения для определения пользователя.")
-            return
-
-        # Извлекаем user_id из скрытого HTML-комментария в тексте оригинального сообщения
-        user_to_reply_id = extract_user_id_from_text(original_bot_message_text)
-
-        if user_to_reply_id:
+    # В режиме тем форума любое сообщение в теме гостя - ответ этому гостю
+    topic_user_id = None
+    reply_thread_id = message.message_thread_id if message.is_topic_message else None # Отвечаем админу в той же теме
+    # Фронт не смог определить гостя и разослал сообщение всем воркерам: отвечает только воркер этого гостя,
+    # остальные молчат. Ошибку "не удалось определить" пишет один воркер 0, если гостя не знает ни один воркер
+    broadcast = bool(update.api_kwargs.get(WORKER_BROADCAST_FIELD))
+    if forum_topics.enabled and reply_thread_id:
+        topic_user_id = forum_topics.user_for_thread(reply_thread_id)
+
+    async def should_report_unresolved() -> bool:
+        if not broadcast:
+            return True
+        if WORKER_INDEX != 0:
+            return False
+        replied_id = message.reply_to_message.message_id if message.reply_to_message else None
+        return not await run_in_storage(known_to_other_workers, replied_id, reply_thread_id)
+
+    if topic_user_id is not None or (message.reply_to_message and message.reply_to_message.from_user.id == context.bot.id):
+        # Гость определяется по таблице маршрутов: каждое пересланное в админ-чат сообщение записано в reply_routes
+        user_to_reply_id = topic_user_id or reply_routes.lookup(message.reply_to_message.message_id)
+
+        if user_to_reply_id is None:
+            # Старые сообщения (до появления таблицы или вытесненные из нее) - ищем "ID: ..." в тексте
+            original_bot_message_text = message.reply_to_message.text or message.reply_to_message.caption
+            if not original_bot_message_text:
+                if await should_report_unresolved():
+                    await update.message.reply_text("Не удалось найти исходный текст сообщения для определения пользователя.", message_thread_id=reply_thread_id)
+                return
+            user_to_reply_id = extract_user_id_from_text(original_bot_message_text)
+
+        if user_to_reply_id and not owns_user(user_to_reply_id):
+            logger.debug(f"Ответ гостю {user_to_reply_id} отправит его воркер.")
+        elif user_to_reply_id:
             try:
                 # Отправляем ответ пользователю
-                await context.bot.send_message(
-                    chat_id=user_to_reply_id,
-                    text=f"💬 *Ответ службы заботы:*\n_{message.text}_",
-                    parse_mode="Markdown"
-                )
-                await update.message.reply_text(f"Ответ успешно отправлен пользователю.")
+                if message.text:
+                    await context.bot.send_message(
+                        chat_id=user_to_reply_id,
+                        text=f"💬 *Ответ службы заботы:*\n_{message.text}_",
+                        parse_mode="Markdown"
+                    )
+                else:
+                    # Фото, голосовое, документ и т.п. из темы гостя копируем как есть
+                    await context.bot.copy_message(
+                        chat_id=user_to_reply_id,
+                        from_chat_id=ADMIN_CHAT_ID,
+                        message_id=message.message_id
+                    )
+                await update.message.reply_text(f"Ответ успешно отправлен пользователю.", message_thread_id=reply_thread_id)
+                await touch_live_chat(str(user_to_reply_id))
                 logger.info(f"Админ {admin_id} отправил ответ пользователю {user_to_reply_id}.")
             except Exception as e:
-                await update.message.reply_text(f"Не удалось отправить ответ пользователю: {e}")
+                await update.message.reply_text(f"Не удалось отправить ответ пользователю: {e}", message_thread_id=reply_thread_id)
                 logger.error(f"Error sending reply from admin {admin_id} to user {user_to_reply_id}: {e}")
-        else:
+        elif await should_report_unresolved():
             await update.message.reply_text(
-                "Не удалось определить ID пользователя из исходного сообщения."
+                "Не удалось определить ID пользователя из исходного сообщения.",
+                message_thread_id=reply_thread_id
             )
     else:
         # Если админ ответил, но не на сообщение бота, или не в админ-чате
@@ -897,14 +3120,17 @@ async def end_live_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
         await update.message.reply_text("❌ Чат со службой заботы завершен. Если у Вас возникнут новые вопросы, Вы всегда можете начать новый чат.")
 
     if user_id in user_states_data:
+        await live_chat_coalescer.flush(context.bot, user_id) # Дописываем последние сообщения гостя до уведомления о завершении
         # Уведомляем админа о завершении чата пользователем
-        await context.bot.send_message(
+        admin_outbox.notify(PRIORITY_LIVE_CHAT, "send_message", route_to=user.id,
             chat_id=ADMIN_CHAT_ID,
+            **admin_thread_kwargs(user.id),
             text=f"🚪 Пользователь {user.mention_html()} завершил чат.",
             parse_mode="HTML"
         )
-        del user_states_data[user_id] 
-        save_data(USER_STATES_FILE, user_states_data)
+        del user_states_data[user_id]
+        await run_in_storage(storage.delete_user_states, [user_id])
+        stats_rollups.add("chats_closed", "guest")
 
     return ConversationHandler.END
 
@@ -920,8 +3146,10 @@ async def admin_end_chat(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     user_to_end_id = query.data.replace("admin_end_chat_", "")
 
     if user_to_end_id in user_states_data:
+        await live_chat_coalescer.flush(context.bot, user_to_end_id)
         del user_states_data[user_to_end_id]
-        save_data(USER_STATES_FILE, user_states_data)
+        await run_in_storage(storage.delete_user_states, [user_to_end_id])
+        stats_rollups.add("chats_closed", "admin")
 
         # Уведомляем пользователя
         try:
@@ -964,6 +3192,7 @@ async def reply_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
                 text=f"💬 *Ответ службы заботы:*\n_{reply_text}_",
                 parse_mode="Markdown"
             )
+            await touch_live_chat(user_to_reply_id)
             await update.message.reply_text(f"Ответ отправлен {user_to_reply_id.mention_html()}.")
         except Exception as e:
             await update.message.reply_text(f"Не удалось отправить ответ {user_to_reply_id.mention_html()}: {e}")
@@ -971,6 +3200,181 @@ async def reply_to_user(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     else:
         await update.message.reply_text(f"{user_to_reply_id.mention_html()} не находится в активном чате или не найден.")
 
+def _write_text(filepath, text):
+    with open(filepath, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /profile для админов: сводка по медленным обновлениям и cProfile. /profile reset - сбросить."""
+    if update.effective_chat.id != ADMIN_CHAT_ID:
+        await update.message.reply_text("У вас нет прав для использования этой команды.")
+        return
+    if context.args and context.args[0] == "reset":
+        update_profiler.reset()
+        await update.message.reply_text("Статистика профилирования сброшена.")
+        return
+
+    summary = update_profiler.summary()
+    report = update_profiler.report()
+    if report is None:
+        await update.message.reply_text(f"{summary}\n\nДанных cProfile нет (PROFILE_SAMPLE_RATE={PROFILE_SAMPLE_RATE}).")
+        return
+    await run_in_storage(_write_text, PROFILE_STATS_FILE, f"{summary}\n\n{report}")
+    await update.message.reply_document(
+        document=f"{summary}\n\n{report}".encode(),
+        filename="profile_stats.txt",
+        caption=f"{summary[:900]}\n\nСохранено в {PROFILE_STATS_FILE}"
+    )
+
+# --- Статистика по счетчикам ---
+
+STATS_MAX_DAYS = 366 # Самый длинный период для /stats
+STATS_DAILY_BREAKDOWN_DAYS = 31 # До такой длины периода /stats показывает строку на каждый день
+CHAT_CLOSE_REASONS = {"guest": "гостем", "admin": "админом", "idle": "по неактивности"}
+
+def parse_stats_period(args, today: date) -> tuple | None:
+    """
+    Период для /stats: без аргументов - сегодня; N - последние N дней;
+    одна дата - этот день; две даты - период включительно. Возвращает (since, until) или None.
+    """
+    if not args:
+        return today, today
+    if len(args) == 1 and args[0].isdigit():
+        days = int(args[0])
+        return (today - timedelta(days=days - 1), today) if 0 < days <= STATS_MAX_DAYS else None
+    if len(args) > 2:
+        return None
+    dates = [parse_command_date(arg, today) for arg in args]
+    if None in dates:
+        return None
+    since, until = min(dates), max(dates)
+    return (since, until) if (until - since).days < STATS_MAX_DAYS else None
+
+def summarize_rollups(rollups: dict) -> tuple:
+    """Сворачивает счетчики {(день, метрика, метка): n} в итоги по (метрика, метка) и по дням {день: {метрика: n}}."""
+    totals, per_day = {}, {}
+    for (day, metric, label), value in rollups.items():
+        totals[(metric, label)] = totals.get((metric, label), 0) + value
+        day_totals = per_day.setdefault(day, {})
+        day_totals[metric] = day_totals.get(metric, 0) + value
+    return totals, per_day
+
+def format_stats(rollups: dict, since: date, until: date) -> list:
+    """Строки ответа /stats (HTML)."""
+    totals, per_day = summarize_rollups(rollups)
+
+    def total(metric):
+        return sum(value for (name, _), value in totals.items() if name == metric)
+
+    def by_label(metric):
+        return sorted((label, value) for (name, label), value in totals.items() if name == metric and value)
+
+    period = (f"за {format_date_for_display(since)}" if since == until
+              else f"с {format_date_for_display(since)} по {format_date_for_display(until)}")
+    lines = [f"📊 <b>Статистика {period}</b>", ""]
+    guests_note = " (сумма уникальных за каждый день)" if since != until else ""
+    lines.append(f"👥 Гостей: {total('users')}{guests_note}, новых: {total('new_users')}")
+    if total("users_estimated"):
+        lines.append("    за дни до пересчета (rebuild-stats) гости посчитаны только по сообщениям, отзывам, "
+                     "проблемам, броням и последнему визиту - реальное число может быть больше")
+    lines.append(f"💬 Сообщений: {total('messages')}")
+    hours = by_label("messages")
+    if hours:
+        lines.append("    по часам: " + ", ".join(f"{hour} ч - {value}" for hour, value in hours))
+    lines.append(f"✍️ Отзывов: {total('reviews')}")
+    lines.append(f"⚠️ Проблем: {total('problems')}")
+    closed = ", ".join(f"{CHAT_CLOSE_REASONS.get(reason, reason)} {value}" for reason, value in by_label("chats_closed"))
+    lines.append(f"🗣️ Чатов поддержки: открыто {total('chats_opened')}, закрыто {total('chats_closed')}"
+                 + (f" ({closed})" if closed else ""))
+    lines.append(f"📝 Броней оформлено: {total('reservations_created')}")
+    lines.append(f"📅 Броней на эти дни: {total('reservations')}, отменено {total('reservations_cancelled')}, "
+                 f"отказов из-за мест {total('reservations_rejected')}")
+    slots = by_label("reservations")
+    if slots:
+        lines.append("    по слотам: " + ", ".join(f"{slot} - {value}" for slot, value in slots))
+
+    if since != until and (until - since).days < STATS_DAILY_BREAKDOWN_DAYS:
+        lines += ["", "<b>По дням:</b>"]
+        day = since
+        while day <= until:
+            counters = per_day.get(day.isoformat(), {})
+            lines.append(f"{day.strftime('%d.%m')}: гостей {counters.get('users', 0)}, "
+                         f"сообщений {counters.get('messages', 0)}, отзывов {counters.get('reviews', 0)}, "
+                         f"проблем {counters.get('problems', 0)}, чатов {counters.get('chats_opened', 0)}, "
+                         f"броней {counters.get('reservations_created', 0)}")
+            day += timedelta(days=1)
+    return lines
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /stats [N | дата | дата дата] для админов: ответ из счетчиков, без чтения логов."""
+    if update.effective_chat.id != ADMIN_CHAT_ID:
+        await update.message.reply_text("У вас нет прав для использования этой команды.")
+        return
+    period = parse_stats_period(context.args, datetime.now(MOSCOW_TZ).date())
+    if period is None:
+        await update.message.reply_text(
+            "Использование: /stats - сегодня; /stats 7 - последние 7 дней; "
+            "/stats 2026-10-01 - один день; /stats 2026-10-01 2026-10-18 - период "
+            f"(не длиннее {STATS_MAX_DAYS} дней)."
+        )
+        return
+    since, until = period
+    rollups = await stats_rollups.query(since, until)
+    for chunk in split_text_lines(format_stats(rollups, since, until)):
+        await update.message.reply_html(chunk)
+
+def rebuild_stats_rollups():
+    """
+    Пересчитывает счетчики статистики по уже накопленным данным (один раз после обновления бота).
+    Живой счетчик гостей учитывает любое обращение к боту, а в данных остаются только сообщения,
+    отзывы, проблемы, брони и последний визит из реестра. Поэтому гости за пересчитанные дни -
+    оценка снизу; такие дни помечаются счетчиком users_estimated, и /stats об этом предупреждает.
+    Открытые и закрытые чаты восстановить нельзя.
+    """
+    storage = create_storage(STORAGE_BACKEND)
+    counts, users_by_day = {}, {}
+
+    def add(day, metric, label="", amount=1):
+        key = (day, metric, label)
+        counts[key] = counts.get(key, 0) + amount
+
+    def seen(moment, user_id):
+        if moment is not None and user_id is not None:
+            users_by_day.setdefault(moment.date().isoformat(), set()).add(int(user_id))
+
+    for entry in storage.iter_messages():
+        moment = moscow_datetime(entry.get("timestamp"))
+        if moment is not None:
+            add(moment.date().isoformat(), "messages", f"{moment.hour:02d}")
+            seen(moment, entry.get("user_id"))
+    for user_id, record in storage.load_users().items():
+        first_seen = moscow_datetime(record.get("first_seen"))
+        if first_seen is not None:
+            add(first_seen.date().isoformat(), "new_users")
+        seen(first_seen, user_id)
+        seen(moscow_datetime(record.get("last_seen")), user_id)
+    for kind in RECORD_KINDS:
+        for entry in storage.load_records(kind):
+            moment = moscow_datetime(str(_record_timestamp(entry) or "")) # Записи с датой не в ISO-формате пропускаем
+            if moment is not None:
+                add(moment.date().isoformat(), kind)
+                seen(moment, entry.get("user_id"))
+    for entry in storage.load_reservations():
+        created_at = moscow_datetime(entry["created_at"])
+        add(created_at.date().isoformat(), "reservations_created")
+        seen(created_at, entry.get("user_id"))
+        add(entry["date"], "reservations", entry["time"])
+        if entry["status"] == "cancelled":
+            add(entry["date"], "reservations_cancelled", entry["time"])
+    for day, users in users_by_day.items():
+        add(day, "users", amount=len(users))
+        add(day, "users_estimated")
+
+    storage.clear_rollups()
+    storage.add_rollups(counts)
+    storage.close()
+    logger.info(f"Счетчики статистики пересчитаны: {len(counts)} значений за {len({day for day, _, _ in counts})} дней.")
+
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Ответ на неизвестные команды."""
     await update.message.reply_text("Извините, я не понял эту команду. Пожалуйста, используйте кнопки или /help.")
@@ -1013,6 +3417,40 @@ def create_month_calendar(year: int, month: int, min_date: date):
 
     return InlineKeyboardMarkup(keyboard)    
 
+# Кэш готовых клавиатур календаря (вместе с кнопкой "В главное меню").
+# В течение суток результат зависит только от (year, month, min_date), поэтому
+# кэш сбрасывается при смене дня по Москве.
+CALENDAR_CACHE_SIZE = 24
+_calendar_cache = OrderedDict()
+_calendar_cache_day = None
+
+def moscow_today() -> date:
+    return datetime.now(MOSCOW_TZ).date()
+
+def get_reservation_calendar(year: int, month: int, min_date: date) -> InlineKeyboardMarkup:
+    """Возвращает клавиатуру календаря с кнопкой возврата в главное меню (LRU-кэш)."""
+    global _calendar_cache_day
+    today = moscow_today()
+    if _calendar_cache_day != today:
+        _calendar_cache.clear()
+        _calendar_cache_day = today
+
+    key = (year, month, min_date)
+    markup = _calendar_cache.get(key)
+    if markup is not None:
+        _calendar_cache.move_to_end(key)
+        return markup
+
+    calendar_markup = create_month_calendar(year, month, min_date=min_date)
+    current_keyboard_rows = list(calendar_markup.inline_keyboard)
+    current_keyboard_rows.append([InlineKeyboardButton("🔙 В главное меню", callback_data="start")])
+    markup = InlineKeyboardMarkup(current_keyboard_rows) # InlineKeyboardMarkup неизменяем, его можно отдавать повторно
+
+    _calendar_cache[key] = markup
+    if len(_calendar_cache) > CALENDAR_CACHE_SIZE:
+        _calendar_cache.popitem(last=False)
+    return markup
+
 
 # Функция бронирование
 async def start_reservation(update: Update, context) -> InlineKeyboardMarkup:
@@ -1026,13 +3464,9 @@ async def start_reservation(update: Update, context) -> InlineKeyboardMarkup:
         message_editor = update.message.reply_text
 
     context.user_data['reservation_data'] = {} # Инициализация данных для бронирования
-    now = datetime.now()
+    today = moscow_today()
 
-    calendar_markup = create_month_calendar(now.year, now.month, min_date=now.date())
-
-    current_keyboard_rows = list(calendar_markup.inline_keyboard)
-    current_keyboard_rows.append([InlineKeyboardButton("🔙 В главное меню", callback_data="start")])
-    final_markup = InlineKeyboardMarkup(current_keyboard_rows)
+    final_markup = get_reservation_calendar(today.year, today.month, min_date=today)
 
     await message_editor(
         "В какой день Вы планируете посетить наше бистро? Пожалуйста, выберите дату:",
@@ -1046,7 +3480,7 @@ async def calendar_callback_handler(update: Update, context: ContextTypes.DEFAUL
     data = query.data
 
     # Определяем сегодняшнюю дату для валидации min_date и max_date
-    now_date = date.today() # Используем date.today() для консистентности
+    now_date = moscow_today() # Та же дата, что и в календаре и клавиатуре времени
     MAX_RESERVATION_DAYS = 30 # Можно вынести в константу
     max_reserv_date = now_date + timedelta(days=MAX_RESERVATION_DAYS)
 
@@ -1062,15 +3496,17 @@ async def calendar_callback_handler(update: Update, context: ContextTypes.DEFAUL
         # Дополнительная валидация выбранной даты
         if selected_date < now_date:
             await query.edit_message_text("Эх, если бы мы могли бронировать столы на '"'вчера'"', мы бы сами там сидели!😉 Увы, машина времени пока в ремонте. Выберите, пожалуйста, дату, которая еще не наступила.",
-                                          reply_markup=create_month_calendar(now_date.year, now_date.month, now_date))
+                                          reply_markup=get_reservation_calendar(now_date.year, now_date.month, now_date))
             return ASK_DATE # Остаемся в состоянии выбора даты
         elif selected_date > max_reserv_date:
             await query.edit_message_text(f"Вы не можете бронировать даты далее чем на {MAX_RESERVATION_DAYS} дней вперед.",
-                                          reply_markup=create_month_calendar(now_date.year, now_date.month, now_date))
+                                          reply_markup=get_reservation_calendar(now_date.year, now_date.month, now_date))
             return ASK_DATE # Остаемся в состоянии выбора даты
 
         # Если дата валидна, сохраняем ее и переходим к следующему шагу (например, выбор времени)
         context.user_data['reservation_data']['selected_date'] = selected_date
+        if WORKER_INDEX >= 0:
+            await reservation_book.refresh(selected_date) # Занятость слотов меняют и другие воркеры
         await query.edit_message_text(
             f"Отлично! Дата: {format_date_for_display(selected_date)}.\n"
             "Теперь укажите желаемое время:",
@@ -1086,50 +3522,181 @@ async def calendar_callback_handler(update: Update, context: ContextTypes.DEFAUL
             await query.edit_message_text("Ошибка: Неверный формат месяца.")
             return ASK_DATE
 
-        # Заново генерируем календарь для нового месяца
-        calendar_markup = create_month_calendar(year, month, min_date=now_date)
-        
-        # Добавляем кнопку "В главное меню"
-        current_keyboard_rows = list(calendar_markup.inline_keyboard)
-        current_keyboard_rows.append([InlineKeyboardButton("🔙 В главное меню", callback_data="start")])
-        final_markup = InlineKeyboardMarkup(current_keyboard_rows)
+        # Календарь нового месяца (с кнопкой "В главное меню") берем из кэша
+        final_markup = get_reservation_calendar(year, month, min_date=now_date)
 
         await query.edit_message_reply_markup(reply_markup=final_markup)
         return ASK_DATE # Остаемся в состоянии выбора даты
 
     return ASK_DATE
 
-def generate_time_keyboard(selected_date: date):
-    now_dt = datetime.now(MOSCOW_TZ) # Текущая дата и время
-    
-    #диапазон работы заведения
-    start_hour = 11
-    end_hour = 21 # До 21:00 включительно
+def _parse_slot_time(value: str) -> time:
+    hours, minutes = value.strip().split(":")
+    return time(int(hours), int(minutes))
 
-    time_slots = []
+def build_slot_grid(first: str, last: str, step_minutes: int) -> tuple:
+    """Сетка слотов бронирования: время от first до last включительно с шагом step_minutes."""
+    if step_minutes <= 0:
+        raise ValueError("Шаг слотов должен быть положительным")
+    first_time, last_time = _parse_slot_time(first), _parse_slot_time(last)
+    start = first_time.hour * 60 + first_time.minute
+    end = last_time.hour * 60 + last_time.minute
+    return tuple(time(minutes // 60, minutes % 60) for minutes in range(start, end + 1, step_minutes))
 
-    for hour in range(start_hour, end_hour + 1):
-        for minute_step in [0, 30]: # Шаги по 30 минут
-            proposed_naive_dt = datetime.combine(selected_date, datetime.min.replace(hour=hour, minute=minute_step).time())
-            proposed_aware_dt_moscow = MOSCOW_TZ.localize(proposed_naive_dt)
-            if proposed_aware_dt_moscow >= now_dt:
-                time_slots.append(proposed_naive_dt) # Добавляем "naive" время для отображения
+# Сетка слотов фиксирована, поэтому считается один раз при запуске
+SLOT_TIMES = build_slot_grid(RESERVATION_FIRST_SLOT, RESERVATION_LAST_SLOT, RESERVATION_SLOT_MINUTES)
+SLOT_LABELS = tuple(slot.strftime("%H:%M") for slot in SLOT_TIMES)
 
-    # Размещаем кнопки времени по 4 в ряд
-    row = []
-    keyboard = []
-    for i, slot in enumerate(time_slots):
-        row.append(InlineKeyboardButton(slot.strftime("%H:%M"), callback_data=f"time_{slot.strftime('%H:%M')}"))
-        if len(row) == 4 or i == len(time_slots) - 1: # Закрываем ряд каждые 4 кнопки или если это последняя
-            keyboard.append(row)
-            row = []
-    
+class ReservationBook:
+    """
+    Брони столов и индекс занятости слотов.
+    Сами брони (журнал с индексами по дате, гостю и телефону) хранятся в storage.
+    Индекс {(дата ISO, 'ЧЧ:ММ'): занято столов} держится в памяти, поэтому проверка
+    слота при выводе клавиатуры времени - O(1) без обращения к хранилищу.
+    Бронь принимается только через reserve(): под замком проверяется индекс, затем
+    хранилище повторно проверяет вместимость при записи (sqlite - в транзакции, общей
+    для всех воркеров), и индекс обновляется по ответу хранилища.
+    """
+
+    def __init__(self, tables_per_slot: int, seats_per_table: int):
+        self.tables_per_slot = tables_per_slot
+        self.seats_per_table = max(1, seats_per_table)
+        self._booked = {} # (дата ISO, 'ЧЧ:ММ') -> занято столов
+        self._full = {} # дата ISO -> frozenset полностью занятых слотов (входит в ключ кэша клавиатуры)
+        self._lock = asyncio.Lock()
+
+    def load(self, storage):
+        """Строит индекс по активным броням хранилища. Выполняется в потоке хранилища при запуске."""
+        self._booked.clear()
+        for entry in storage.load_reservations():
+            if entry.get("status") == "active":
+                key = (entry["date"], entry["time"])
+                self._booked[key] = self._booked.get(key, 0) + entry["tables"]
+        self._full = {}
+        for (day, label), booked in self._booked.items():
+            if booked >= self.tables_per_slot:
+                self._full[day] = self._full.get(day, frozenset()) | {label}
+
+    def tables_for(self, guests: int) -> int:
+        return -(-guests // self.seats_per_table)
+
+    def free_tables(self, day: date, label: str) -> int:
+        return max(0, self.tables_per_slot - self._booked.get((day.isoformat(), label), 0))
+
+    def fits(self, day: date, label: str, guests: int) -> bool:
+        return self.tables_for(guests) <= self.free_tables(day, label)
+
+    def full_slots(self, day: date) -> frozenset:
+        return self._full.get(day.isoformat(), frozenset())
+
+    def _set_booked(self, key: tuple, booked: int):
+        day, label = key
+        self._booked[key] = booked
+        full = self._full.get(day, frozenset())
+        if booked >= self.tables_per_slot:
+            full = full | {label}
+        else:
+            full = full - {label}
+        if full:
+            self._full[day] = full
+        else:
+            self._full.pop(day, None)
+
+    async def refresh(self, day: date):
+        """Перечитывает занятость слотов дня из хранилища (воркеры: брони и отмены могли пройти в других процессах)."""
+        booked = await run_in_storage(storage.slot_tables, day.isoformat())
+        for label in SLOT_LABELS:
+            self._set_booked((day.isoformat(), label), booked.get(label, 0))
+
+    async def reserve(self, user_id: int, day: date, slot: time, guests: int, **details) -> dict | None:
+        """
+        Занимает столы в слоте и сохраняет бронь в журнал.
+        details - данные гостя (name, phone, wishes, username). Возвращает запись брони или None, если мест уже нет.
+        """
+        entry = {
+            "id": secrets.token_hex(6),
+            "user_id": user_id,
+            "date": day.isoformat(),
+            "time": slot.strftime("%H:%M"),
+            "guests": guests,
+            "tables": self.tables_for(guests),
+            **details,
+            "status": "active",
+            "created_at": datetime.now(MOSCOW_TZ).isoformat(),
+        }
+        key = (entry["date"], entry["time"])
+        async with self._lock:
+            if not self.fits(day, entry["time"], guests):
+                return None
+            # Хранилище проверяет вместимость еще раз: другой воркер мог занять стол, пока наш индекс не знал об этом
+            accepted, booked = await run_in_storage(storage.reserve_slot, entry, self.tables_per_slot)
+            self._set_booked(key, booked)
+        if not accepted:
+            stats_rollups.add("reservations_rejected", entry["time"], day=entry["date"])
+            return None
+        stats_rollups.add("reservations_created")
+        stats_rollups.add("reservations", entry["time"], day=entry["date"])
+        return entry
+
+    async def cancel(self, reservation_id: str) -> dict | None:
+        """Отменяет бронь и освобождает ее столы. Возвращает обновленную запись или None, если брони нет."""
+        async with self._lock:
+            entry, booked = await run_in_storage(storage.set_reservation_status, reservation_id, "cancelled")
+            if entry is not None:
+                self._set_booked((entry["date"], entry["time"]), booked)
+                stats_rollups.add("reservations_cancelled", entry["time"], day=entry["date"])
+        return entry
+
+reservation_book = ReservationBook(RESERVATION_TABLES_PER_SLOT, RESERVATION_SEATS_PER_TABLE)
+
+TIME_KEYBOARD_CACHE_SIZE = 64
+_slot_datetimes_cache = OrderedDict() # дата -> кортеж aware datetime слотов (по Москве)
+_time_keyboard_cache = OrderedDict() # (дата, индекс первого доступного слота, занятые слоты) -> клавиатура
+
+def _lru_put(cache: OrderedDict, key, value, max_size=TIME_KEYBOARD_CACHE_SIZE):
+    cache[key] = value
+    if len(cache) > max_size:
+        cache.popitem(last=False)
+    return value
+
+def slot_datetimes(selected_date: date) -> tuple:
+    """Начало каждого слота выбранной даты как aware datetime по Москве (localize - один раз на дату)."""
+    cached = _slot_datetimes_cache.get(selected_date)
+    if cached is not None:
+        _slot_datetimes_cache.move_to_end(selected_date)
+        return cached
+    values = tuple(MOSCOW_TZ.localize(datetime.combine(selected_date, slot)) for slot in SLOT_TIMES)
+    return _lru_put(_slot_datetimes_cache, selected_date, values)
+
+def generate_time_keyboard(selected_date: date):
+    now_dt = datetime.now(MOSCOW_TZ) # Текущая дата и время
+
+    # Первый слот, который еще не прошел (для будущих дат это всегда 0)
+    first_available = bisect_left(slot_datetimes(selected_date), now_dt)
+
+    full = reservation_book.full_slots(selected_date)
+    key = (selected_date, first_available, full)
+    cached = _time_keyboard_cache.get(key)
+    if cached is not None:
+        _time_keyboard_cache.move_to_end(key)
+        return cached
+
+    # Размещаем кнопки времени по 4 в ряд; занятые слоты остаются на своих местах, но помечены
+    buttons = [
+        InlineKeyboardButton(f"🚫 {label}", callback_data="slot_full") if label in full
+        else InlineKeyboardButton(label, callback_data=f"time_{label}")
+        for label in SLOT_LABELS[first_available:]
+    ]
+    keyboard = [buttons[i:i + 4] for i in range(0, len(buttons), 4)]
     keyboard.append([InlineKeyboardButton("Отмена бронирования", callback_data="cancel_reserve")])
-    return InlineKeyboardMarkup(keyboard)
+    return _lru_put(_time_keyboard_cache, key, InlineKeyboardMarkup(keyboard))
 
 # Хендлер для обработки выбора времени из инлайн-клавиатуры
 async def process_time_selection(update: Update, context):
     query = update.callback_query
+    if query.data == "slot_full":
+        await query.answer("На это время все столы уже заняты. Пожалуйста, выберите другое время.", show_alert=True)
+        return ASK_TIME
     await query.answer()
     print(f"DEBUG: context.user_data at process_time_selection start: {context.user_data}")
 
@@ -1175,6 +3742,14 @@ async def process_time_selection(update: Update, context):
         )
         return ASK_TIME
 
+    # Клавиатура могла устареть: пока гость выбирал, последний стол на это время заняли
+    if reservation_book.free_tables(reservation_data['selected_date'], time_str) == 0:
+        await query.edit_message_text(
+            "К сожалению, на это время все столы уже заняты. Пожалуйста, выберите другое время:",
+            reply_markup=generate_time_keyboard(reservation_data['selected_date'])
+        )
+        return ASK_TIME
+
     reservation_data['time'] = selected_time_naive
     reservation_data['full_datetime'] = selected_full_dt_moscow # Сохраняем aware datetime для дальнейших операций
     logger.info(f"Время бронирования выбрано: {selected_time_naive}")
@@ -1214,6 +3789,17 @@ async def get_guests(update: Update, context):
         await update.message.reply_text("Пожалуйста, введите количество человек числом (например, 4).")
         return ASK_GUESTS
 
+    selected_date = reservation_data['selected_date']
+    slot_label = reservation_data['time'].strftime('%H:%M')
+    if not reservation_book.fits(selected_date, slot_label, num_guests):
+        free = reservation_book.free_tables(selected_date, slot_label)
+        await update.message.reply_text(
+            f"На {slot_label} осталось свободных столов: {free}, а для компании из {num_guests} человек "
+            f"нужно {reservation_book.tables_for(num_guests)}. Пожалуйста, выберите другое время:",
+            reply_markup=generate_time_keyboard(selected_date)
+        )
+        return ASK_TIME
+
     reservation_data['num_guests'] = num_guests
     await update.message.reply_text(
         f"Отлично, {num_guests} человек.\n"
@@ -1269,20 +3855,12 @@ async def get_name(update: Update, context):
 
 RUSSIAN_MOBILE_PHONE_PATTERN = re.compile(r"^\+79\d{9}$")
 
-# 6. Получение телефона
-async def get_phone(update: Update, context):
-    text = update.message.text
-    reservation_data = context.user_data['reservation_data']
-
-    if text.lower() == "отмена бронирования":
-        await update.message.reply_text("❌ Бронирование отменено.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В главное меню", callback_data="start")]]))
-        context.user_data.pop('reservation_data', None)
-        return ConversationHandler.END
-
+def standardize_phone(text: str) -> str:
+    """Приводит мобильный номер к виду +79XXXXXXXXX; для некорректного номера возвращает пустую строку."""
     cleaned_phone = text.strip().replace(" ", "").replace("-", "").replace("(", "").replace(")", "")
     standardized_phone = ""
 
-    # 2. Стандартизация префикса и начальная проверка длины
+    # Стандартизация префикса и проверка длины
     if cleaned_phone.startswith("8"):
         # Если номер начинается с 8 и имеет общую длину 11 цифр (8 + 10 цифр)
         if len(cleaned_phone) == 11:
@@ -1307,9 +3885,20 @@ async def get_phone(update: Update, context):
     else:
         # Все остальные варианты (например, номера без префикса, слишком короткие/длинные)
         pass # standardized_phone останется пустым
+    return standardized_phone if RUSSIAN_MOBILE_PHONE_PATTERN.fullmatch(standardized_phone) else ""
+
+# 6. Получение телефона
+async def get_phone(update: Update, context):
+    text = update.message.text
+    reservation_data = context.user_data['reservation_data']
 
-    # 3. Финальная проверка стандартизированного номера с помощью регулярного выражения
-    if not RUSSIAN_MOBILE_PHONE_PATTERN.fullmatch(standardized_phone):
+    if text.lower() == "отмена бронирования":
+        await update.message.reply_text("❌ Бронирование отменено.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В главное меню", callback_data="start")]]))
+        context.user_data.pop('reservation_data', None)
+        return ConversationHandler.END
+
+    standardized_phone = standardize_phone(text)
+    if not standardized_phone:
         await update.message.reply_text(
             "Пожалуйста, введите корректный мобильный номер. "
             "Номер должен содержать 11 цифр и начинаться с +7 или 8 "
@@ -1371,6 +3960,26 @@ async def get_wishes(update: Update, context):
     return CONFIRM_RESERVATION
 
 # 9. Подтверждение или отмена бронирования (callback)
+def _on_reservation_notice_done(bot, user_id: int, booking: dict, reservation_data: dict, future: asyncio.Future):
+    """Логирует доставку уведомления о брони менеджеру; при неудаче сообщает гостю, что нужно позвонить."""
+    if future.cancelled() or future.exception() is None:
+        logger.info(f"Запрос на бронирование от {user_id} отправлен менеджеру.")
+        return
+    logger.error(f"Не удалось отправить менеджеру бронь № {booking['id']} от {user_id}: {future.exception()}")
+    text = (
+        f"⚠️ Бронь № {booking['id']} на {format_date_for_display(reservation_data['selected_date'])} "
+        f"в {reservation_data['time'].strftime('%H:%M')} сохранена, но мы не смогли передать ее менеджеру.\n"
+        "Пожалуйста, позвоните нам для подтверждения: +7 (918) 582-31-51."
+    )
+
+    async def warn_guest():
+        try:
+            await bot.send_message(chat_id=user_id, text=text)
+        except Exception as e:
+            logger.error(f"Не удалось предупредить гостя {user_id} о неотправленной брони: {e}")
+
+    asyncio.get_running_loop().create_task(warn_guest())
+
 async def confirm_or_cancel_reservation(update: Update, context):
     query = update.callback_query
     await query.answer() # Обязательно ответить на CallbackQuery
@@ -1378,9 +3987,35 @@ async def confirm_or_cancel_reservation(update: Update, context):
     reservation_data = context.user_data['reservation_data']
 
     if query.data == "confirm_reserve":
+        # Сначала занимаем столы: из двух гостей, претендующих на последний стол, бронь получит только один
+        try:
+            booking = await reservation_book.reserve(
+                update.effective_user.id, reservation_data['selected_date'], reservation_data['time'],
+                reservation_data['num_guests'], name=reservation_data['name'], phone=reservation_data['phone'],
+                wishes=reservation_data['wishes'], username=update.effective_user.username
+            )
+        except Exception as e:
+            logger.error(f"Не удалось сохранить бронь пользователя {update.effective_user.id}: {e}")
+            await query.edit_message_text(
+                "Произошла ошибка при сохранении брони. Пожалуйста, попробуйте позже.",
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В главное меню", callback_data="start")]])
+            )
+            context.user_data.pop('reservation_data', None)
+            return ConversationHandler.END
+        if booking is None:
+            logger.info(f"Бронь пользователя {update.effective_user.id} отклонена: слот "
+                        f"{reservation_data['selected_date']} {reservation_data['time'].strftime('%H:%M')} занят.")
+            await query.edit_message_text(
+                "😔 Пока Вы оформляли бронь, на это время заняли последние столы.\n"
+                "Пожалуйста, выберите другое время:",
+                reply_markup=generate_time_keyboard(reservation_data['selected_date'])
+            )
+            return ASK_TIME
+
         # Формируем сообщение для администратора
         admin_message = (
             "🔔 *НОВЫЙ ЗАПРОС НА БРОНИРОВАНИЕ СТОЛИКА!* 🔔\n\n"
+            f"Бронь № `{booking['id']}`, столов: {booking['tables']}\n"
             f"От пользователя: @{update.effective_user.username or update.effective_user.id}\n"
             f"ID пользователя: {update.effective_user.id}\n\n"
             f"📅 Дата: *{format_date_for_display(reservation_data['selected_date'])}*\n"
@@ -1396,25 +4031,26 @@ async def confirm_or_cancel_reservation(update: Update, context):
 
         admin_message += "\n*Не забудьте связаться с гостем для подтверждения!*"
 
-        try:
-            await context.bot.send_message(
-                chat_id=ADMIN_CHAT_ID,
-                text=admin_message,
-                parse_mode='Markdown'
-            )
-            logger.info(f"Запрос на бронирование от {update.effective_user.id} отправлен менеджеру.")
-            await query.edit_message_text(
-                "✅ Ваш запрос на бронирование отправлен менеджеру.\n"
-                "Мы свяжемся с Вами в ближайшее время для подтверждения!\n"
-                "Спасибо за выбор нашего заведения!",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В главное меню", callback_data="start")]])  # Убираем кнопки после подтверждения
-            )
-        except Exception as e:
-            logger.error(f"Не удалось отправить сообщение менеджеру: {e}")
-            await query.edit_message_text(
-                "Произошла ошибка при отправке запроса менеджеру. Пожалуйста, попробуйте позже.",
-                 reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В главное меню", callback_data="start")]])
-            )
+        # Уведомление уходит через очередь админ-чата, гостю отвечаем сразу, не дожидаясь отправки.
+        # Если менеджеру сообщение так и не доставлено, гость узнает об этом отдельным сообщением.
+        notice = admin_outbox.submit(PRIORITY_RESERVATION, "send_message", route_to=update.effective_user.id,
+            chat_id=ADMIN_CHAT_ID,
+            text=admin_message,
+            parse_mode='Markdown'
+        )
+        notice.add_done_callback(functools.partial(
+            _on_reservation_notice_done, context.bot, update.effective_user.id, booking, reservation_data
+        ))
+        await query.edit_message_text(
+            "✅ Ваш запрос на бронирование отправлен менеджеру.\n"
+            "Мы свяжемся с Вами в ближайшее время для подтверждения!\n"
+            "Посмотреть или отменить бронь можно в разделе «Мои брони».\n"
+            "Спасибо за выбор нашего заведения!",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("📋 Мои брони", callback_data="my_reservations")],
+                [InlineKeyboardButton("🔙 В главное меню", callback_data="start")]
+            ])  # Убираем кнопки после подтверждения
+        )
 
     elif query.data == "cancel_reserve":
         await query.edit_message_text("❌ Бронирование отменено.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В главное меню", callback_data="start")]]))
@@ -1436,6 +4072,188 @@ async def fallback_handler(update: Update, context):
     await update.message.reply_text("Пожалуйста, следуйте инструкциям.", reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В главное меню", callback_data="start")]]))
     return ConversationHandler.END
         
+# --- Брони гостя и журнал броней для админов ---
+
+RESERVATION_STATUS_LABELS = {"active": "активна", "cancelled": "отменена"}
+BACK_TO_MAIN_MENU_MARKUP = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 В главное меню", callback_data="start")]])
+
+def _reservation_date(entry: dict) -> str:
+    return format_date_for_display(date.fromisoformat(entry["date"]))
+
+def split_text_lines(lines, limit=4000) -> list:
+    """Склеивает строки в сообщения не длиннее limit символов (лимит Telegram - 4096)."""
+    chunks, current = [], ""
+    for line in lines:
+        if current and len(current) + len(line) + 1 > limit:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{line}" if current else line
+    if current:
+        chunks.append(current)
+    return chunks
+
+async def upcoming_reservations(user_id: int) -> list:
+    """Активные брони гостя, время которых еще не наступило (из индекса журнала по гостю)."""
+    now = datetime.now(MOSCOW_TZ).strftime("%Y-%m-%d %H:%M")
+    entries = await run_in_storage(storage.reservations_of_user, user_id)
+    return [entry for entry in entries if entry["status"] == "active" and f"{entry['date']} {entry['time']}" > now]
+
+async def show_my_reservations(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /mybookings и кнопка "Мои брони": предстоящие брони гостя с кнопками отмены."""
+    query = update.callback_query
+    if query:
+        await query.answer()
+        message_editor = query.edit_message_text
+    else:
+        message_editor = update.message.reply_text
+
+    entries = await upcoming_reservations(update.effective_user.id)
+    if not entries:
+        await message_editor(
+            "У Вас нет предстоящих броней.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("📝 Забронировать стол", callback_data="start_reservation")],
+                [InlineKeyboardButton("🔙 В главное меню", callback_data="start")]
+            ])
+        )
+        return
+
+    lines = ["📋 Ваши предстоящие брони:\n"]
+    keyboard = []
+    for entry in entries:
+        lines.append(f"• {_reservation_date(entry)} в {entry['time']}, гостей: {entry['guests']}")
+        keyboard.append([InlineKeyboardButton(f"❌ Отменить {_reservation_date(entry)} {entry['time']}",
+                                              callback_data=f"resv_ask_{entry['id']}")])
+    keyboard.append([InlineKeyboardButton("🔙 В главное меню", callback_data="start")])
+    await message_editor("\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def _find_upcoming_reservation(update: Update, prefix: str) -> dict | None:
+    """Бронь из callback_data, если она принадлежит этому гостю и еще не прошла."""
+    reservation_id = update.callback_query.data[len(prefix):]
+    entries = await upcoming_reservations(update.effective_user.id)
+    return next((entry for entry in entries if entry["id"] == reservation_id), None)
+
+async def ask_cancel_my_reservation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Кнопка "Отменить" в списке броней: переспрашиваем гостя."""
+    query = update.callback_query
+    await query.answer()
+    entry = await _find_upcoming_reservation(update, "resv_ask_")
+    if entry is None:
+        await query.edit_message_text("Бронь не найдена или уже отменена.", reply_markup=BACK_TO_MAIN_MENU_MARKUP)
+        return
+    await query.edit_message_text(
+        f"Отменить бронь на {_reservation_date(entry)} в {entry['time']} (гостей: {entry['guests']})?",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("✅ Да, отменить", callback_data=f"resv_cancel_{entry['id']}")],
+            [InlineKeyboardButton("🔙 Назад", callback_data="my_reservations")]
+        ])
+    )
+
+async def cancel_my_reservation(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Гость подтвердил отмену: освобождаем столы и сообщаем менеджеру."""
+    query = update.callback_query
+    await query.answer()
+    entry = await _find_upcoming_reservation(update, "resv_cancel_")
+    if entry is None:
+        await query.edit_message_text("Бронь не найдена или уже отменена.", reply_markup=BACK_TO_MAIN_MENU_MARKUP)
+        return
+    entry = await reservation_book.cancel(entry["id"])
+    logger.info(f"Пользователь {update.effective_user.id} отменил бронь {entry['id']} ({entry['date']} {entry['time']}).")
+
+    admin_outbox.notify(PRIORITY_RESERVATION, "send_message", route_to=update.effective_user.id,
+        chat_id=ADMIN_CHAT_ID,
+        text=(
+            "❌ *ГОСТЬ ОТМЕНИЛ БРОНЬ*\n\n"
+            f"Бронь № `{entry['id']}`\n"
+            f"ID пользователя: {update.effective_user.id}\n"
+            f"📅 Дата: *{_reservation_date(entry)}*\n"
+            f"⏰ Время: *{entry['time']}*\n"
+            f"👥 Гостей: *{entry['guests']}*\n"
+            f"👤 Имя: *{entry.get('name')}*\n"
+            f"📞 Телефон: *{entry.get('phone')}*\n"
+        ),
+        parse_mode='Markdown'
+    )
+    await query.edit_message_text(
+        f"✅ Бронь на {_reservation_date(entry)} в {entry['time']} отменена.\n"
+        "Будем рады видеть Вас в другой раз!",
+        reply_markup=InlineKeyboardMarkup([
+            [InlineKeyboardButton("📋 Мои брони", callback_data="my_reservations")],
+            [InlineKeyboardButton("🔙 В главное меню", callback_data="start")]
+        ])
+    )
+
+def parse_command_date(value: str, today: date) -> date | None:
+    """Дата из аргумента команды: today/сегодня, tomorrow/завтра, yesterday/вчера, ГГГГ-ММ-ДД или ДД.ММ.ГГГГ."""
+    value = value.lower()
+    if value in ("today", "сегодня"):
+        return today
+    if value in ("tomorrow", "завтра"):
+        return today + timedelta(days=1)
+    if value in ("yesterday", "вчера"):
+        return today - timedelta(days=1)
+    for date_format in ("%Y-%m-%d", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+    return None
+
+def _admin_reservation_line(entry: dict, show_date: bool) -> str:
+    parts = [f"<b>{_reservation_date(entry) + ' ' if show_date else ''}{entry['time']}</b>",
+             f"{entry['guests']} чел.", escape(str(entry.get('name') or '—')), escape(str(entry.get('phone') or '—'))]
+    if entry.get("wishes"):
+        parts.append(f"<i>{escape(str(entry['wishes']))}</i>")
+    if entry["status"] != "active":
+        parts.append(RESERVATION_STATUS_LABELS.get(entry["status"], entry["status"]))
+    parts.append(f"№ <code>{entry['id']}</code>")
+    return " · ".join(parts)
+
+async def agenda_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /agenda [today|tomorrow|ГГГГ-ММ-ДД] для админов: брони на день из индекса журнала по дате."""
+    if update.effective_chat.id != ADMIN_CHAT_ID:
+        await update.message.reply_text("У вас нет прав для использования этой команды.")
+        return
+    day = parse_command_date(context.args[0] if context.args else "today", moscow_today())
+    if day is None:
+        await update.message.reply_text("Использование: /agenda [today|tomorrow|ГГГГ-ММ-ДД|ДД.ММ.ГГГГ]")
+        return
+
+    entries = await run_in_storage(storage.reservations_on, day.isoformat())
+    active = [entry for entry in entries if entry["status"] == "active"]
+    lines = [
+        f"📅 <b>Брони на {format_date_for_display(day)}</b>",
+        f"Активных: {len(active)}, гостей: {sum(entry['guests'] for entry in active)}, "
+        f"столов: {sum(entry['tables'] for entry in active)} (на слот - {reservation_book.tables_per_slot})",
+        "",
+    ]
+    lines += [_admin_reservation_line(entry, show_date=False) for entry in active] or ["Броней нет."]
+    cancelled = len(entries) - len(active)
+    if cancelled:
+        lines.append(f"\nОтменено: {cancelled}")
+    for chunk in split_text_lines(lines):
+        await update.message.reply_html(chunk)
+
+async def guest_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Команда /guest <телефон> для админов: все брони гостя из индекса журнала по телефону."""
+    if update.effective_chat.id != ADMIN_CHAT_ID:
+        await update.message.reply_text("У вас нет прав для использования этой команды.")
+        return
+    phone = standardize_phone("".join(context.args))
+    if not phone:
+        await update.message.reply_text("Использование: /guest +79XXXXXXXXX")
+        return
+
+    entries = await run_in_storage(storage.reservations_by_phone, phone)
+    if not entries:
+        await update.message.reply_text(f"Броней с телефоном {phone} нет.")
+        return
+    user_ids = sorted({str(entry["user_id"]) for entry in entries})
+    lines = [f"📞 <b>{phone}</b>: броней {len(entries)}, ID пользователя: {', '.join(user_ids)}", ""]
+    lines += [_admin_reservation_line(entry, show_date=True) for entry in entries]
+    for chunk in split_text_lines(lines):
+        await update.message.reply_html(chunk)
+
 async def make_order_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /order."""
     await update.message.reply_text("Функция онлайн-заказа пока не доступна.Вы можете просмотреть наше меню, а для заказа свяжитесь с нами напрямую по телефону +7 (918) 582-31-51.",
@@ -1462,11 +4280,700 @@ async def handle_all_messages(update: Update, context: ContextTypes.DEFAULT_TYPE
         # Для других типов чатов (например, канал), если бот может быть добавлен туда.
         pass
 
+# --- Обновление меню и FAQ без перезапуска ---
+
+CONTENT_FILES = {
+    os.path.basename(MENU_FILE): menu_snapshots,
+    os.path.basename(FAQ_FILE): faq_snapshots,
+}
+
+async def watch_content_files_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодически проверяет menu.json и faq.json и подхватывает изменения."""
+    for snapshots in CONTENT_FILES.values():
+        await snapshots.reload_if_changed()
+
+async def upload_content_file(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Админ присылает в админ-чат новый menu.json или faq.json документом."""
+    document = update.message.document
+    snapshots = CONTENT_FILES.get(document.file_name or "")
+    if snapshots is None:
+        await update.message.reply_text(f"Поддерживаются только файлы: {', '.join(CONTENT_FILES)}.")
+        return
+
+    try:
+        telegram_file = await document.get_file()
+        raw = await telegram_file.download_as_bytearray()
+        data = json.loads(bytes(raw).decode('utf-8-sig'))
+        snapshot = await snapshots.replace_file(data)
+    except (ValueError, UnicodeDecodeError) as e:
+        await update.message.reply_text(f"Файл {document.file_name} не принят: {e}")
+        return
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке {document.file_name} от админа: {e}")
+        await update.message.reply_text(f"Не удалось обновить {document.file_name}: {e}")
+        return
+
+    logger.info(f"Админ {update.effective_user.id} загрузил {document.file_name} (версия {snapshot.version}).")
+    await update.message.reply_text(f"✅ {document.file_name} обновлен (версия {snapshot.version}).")
+
+# --- Периодические задачи и завершение работы ---
+
+async def flush_users_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодически сбрасывает на диск изменения реестра пользователей."""
+    await user_registry.aflush()
+
+async def flush_stats_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Периодически сбрасывает в хранилище приращения счетчиков статистики."""
+    await stats_rollups.aflush()
+
+async def expire_idle_live_chats_job(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """
+    Закрывает чаты поддержки без активности дольше LIVE_CHAT_IDLE_TTL.
+    Чаты закрываются пачками по LIVE_CHAT_SWEEP_BATCH: одна запись в хранилище на пачку,
+    затем уведомления гостю и в админ-чат.
+    """
+    now = _time.time()
+    stale = [user_id for user_id, state in user_states_data.items()
+             if state.get("state") == "chat_active" and now - state.get("last_activity", now) >= LIVE_CHAT_IDLE_TTL]
+    if not stale:
+        return
+    idle_minutes = int(LIVE_CHAT_IDLE_TTL // 60)
+    closed_total = 0
+    for start in range(0, len(stale), LIVE_CHAT_SWEEP_BATCH):
+        closed = []
+        for user_id in stale[start:start + LIVE_CHAT_SWEEP_BATCH]:
+            state = user_states_data.get(user_id)
+            # Пока шла обработка, гость мог написать или чат мог быть завершен
+            if state is None or now - state.get("last_activity", now) < LIVE_CHAT_IDLE_TTL:
+                continue
+            await live_chat_coalescer.flush(context.bot, user_id)
+            del user_states_data[user_id]
+            closed.append(user_id)
+        if not closed:
+            continue
+        await run_in_storage(storage.delete_user_states, closed)
+        stats_rollups.add("chats_closed", "idle", len(closed))
+        closed_total += len(closed)
+
+        for user_id in closed:
+            try:
+                await context.bot.send_message(
+                    chat_id=int(user_id),
+                    text="⌛ Чат со службой заботы закрыт, так как в нем долго не было сообщений. "
+                         "Если у Вас остались вопросы, начните чат заново из главного меню.",
+                    reply_markup=get_main_keyboard()
+                )
+            except Exception as e:
+                logger.error(f"Не удалось уведомить пользователя {user_id} о закрытии чата: {e}")
+            admin_outbox.notify(PRIORITY_LIVE_CHAT, "send_message", route_to=int(user_id),
+                chat_id=ADMIN_CHAT_ID,
+                **admin_thread_kwargs(int(user_id)),
+                text=f"⌛ Чат с пользователем (ID: {user_id}) закрыт автоматически: нет сообщений больше {idle_minutes} мин."
+            )
+    logger.info(f"Закрыто брошенных чатов поддержки: {closed_total}.")
+
+def _record_startup_metrics(metrics: dict):
+    """Дописывает замер времени запуска в STARTUP_METRICS_FILE (для сравнения между релизами)."""
+    try:
+        with open(STARTUP_METRICS_FILE, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(metrics, ensure_ascii=False) + "\n")
+    except OSError as e:
+        logger.error(f"Не удалось записать {STARTUP_METRICS_FILE}: {e}")
+
+startup_metrics = {} # Последний замер времени запуска
+
+async def on_startup(application: Application) -> None:
+    """Этап запуска: загрузка данных до начала обработки обновлений и замер времени старта."""
+    started = _time.perf_counter()
+    await run_in_storage(load_bot_data)
+    await run_in_storage(reservation_book.load, storage)
+    await user_registry.aload()
+    await run_in_storage(reply_routes.load)
+    await run_in_storage(forum_topics.load)
+    admin_outbox.start(application.bot)
+    finished = _time.perf_counter()
+
+    startup_metrics.update({
+        "timestamp": datetime.now().isoformat(),
+        "version": BOT_VERSION,
+        "storage_backend": STORAGE_BACKEND,
+        "bot_mode": BOT_MODE,
+        "import_seconds": round(_MODULE_IMPORT_FINISHED - _MODULE_IMPORT_STARTED, 4),
+        "data_load_seconds": round(finished - started, 4),
+        "total_seconds": round(finished - _MODULE_IMPORT_STARTED, 4), # От начала импорта до готовности обрабатывать обновления
+    })
+    logger.info(
+        f"Запуск: импорт {startup_metrics['import_seconds']} с, загрузка данных {startup_metrics['data_load_seconds']} с, "
+        f"всего {startup_metrics['total_seconds']} с."
+    )
+    await run_in_storage(_record_startup_metrics, dict(startup_metrics))
+    if METRICS_PORT:
+        await start_metrics_listener()
+
+async def on_stop(application: Application) -> None:
+    """Отправляет то, что осталось в очереди админ-чата, пока HTTP-клиент бота еще открыт."""
+    await live_chat_coalescer.flush_all(application.bot) # Дописанные сообщения гостей ставятся в очередь до ее остановки
+    await admin_outbox.stop()
+
+async def on_shutdown(application: Application) -> None:
+    """Сохраняет все несохраненные данные при остановке бота."""
+    await stop_metrics_listener()
+    flushed = await user_registry.aflush()
+    await stats_rollups.aflush()
+    await run_in_storage(storage.close)
+    await run_in_storage(reply_routes.close)
+    STORAGE_EXECUTOR.shutdown(wait=True) # Дожидаемся всех запланированных записей
+    logger.info(f"Данные сохранены перед остановкой (пользователей: {flushed}).")
+
+# --- HTTP-сервер для режима вебхука ---
+
+class HttpListener:
+    """
+    Минимальный HTTP/1.1-сервер на asyncio (keep-alive, Content-Length).
+    Маршруты: {(метод, путь): async handler(headers, body) -> (статус, content_type, тело)}.
+    """
+    MAX_BODY_SIZE = 1 << 20
+    STATUS_TEXT = {200: "OK", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+                   413: "Payload Too Large", 429: "Too Many Requests", 500: "Internal Server Error"}
+
+    def __init__(self, host: str, port: int, max_connections: int | None = None):
+        self.host = host
+        self.port = port
+        self.max_connections = max_connections
+        self.routes = {}
+        self._server = None
+        self._connections = None
+
+    def route(self, method: str, path: str, handler):
+        self.routes[(method.upper(), path)] = handler
+
+    async def start(self):
+        self._connections = asyncio.Semaphore(self.max_connections) if self.max_connections else None
+        self._server = await asyncio.start_server(self._handle_connection, self.host, self.port)
+        self.port = self._server.sockets[0].getsockname()[1] # Если был указан порт 0
+        logger.info(f"HTTP-сервер слушает {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _handle_connection(self, reader, writer):
+        if self._connections is not None:
+            await self._connections.acquire()
+        try:
+            while await self._handle_request(reader, writer):
+                pass
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError, asyncio.CancelledError):
+            pass # Обрыв соединения или остановка сервера
+        finally:
+            if self._connections is not None:
+                self._connections.release()
+            writer.close()
+
+    async def _handle_request(self, reader, writer) -> bool:
+        """Обрабатывает один запрос. Возвращает True, если соединение остается открытым."""
+        request_line = await reader.readline()
+        if not request_line:
+            return False
+        method, target, version = request_line.decode('latin-1').split()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        length = int(headers.get("content-length", "0"))
+        if length > self.MAX_BODY_SIZE:
+            await self._respond(writer, 413, "text/plain", b"payload too large", keep_alive=False)
+            return False
+        body = await reader.readexactly(length) if length else b""
+
+        handler = self.routes.get((method.upper(), target.split("?", 1)[0]))
+        if handler is None:
+            status, content_type, payload = 404, "text/plain", b"not found"
+        else:
+            try:
+                status, content_type, payload = await handler(headers, body)
+            except Exception as e:
+                logger.error(f"Ошибка обработки HTTP-запроса {method} {target}: {e}", exc_info=True)
+                status, content_type, payload = 500, "text/plain", b"internal error"
+
+        keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+        await self._respond(writer, status, content_type, payload, keep_alive)
+        return keep_alive
+
+    async def _respond(self, writer, status, content_type, payload: bytes, keep_alive: bool):
+        head = (
+            f"HTTP/1.1 {status} {self.STATUS_TEXT.get(status, 'Unknown')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(payload)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode('latin-1') + payload)
+        await writer.drain()
+
+def secret_matches(headers: dict, expected_secret: bytes) -> bool:
+    """Проверяет заголовок X-Telegram-Bot-Api-Secret-Token (пустой ожидаемый секрет - без проверки)."""
+    if not expected_secret:
+        return True
+    received = headers.get("x-telegram-bot-api-secret-token", "").encode()
+    return hmac.compare_digest(received, expected_secret)
+
+def create_webhook_listener(application: Application, host=None, port=None, path=None, secret_token=None) -> HttpListener:
+    """
+    Создает HTTP-сервер с маршрутами вебхука (WEBHOOK_PATH) и проверки здоровья (/health).
+    Воркер режима WORKERS использует тот же сервер со своими адресом, путем и секретом фронта.
+    """
+    listener = HttpListener(host or WEBHOOK_LISTEN, WEBHOOK_PORT if port is None else port, WEBHOOK_MAX_CONNECTIONS)
+    expected_secret = (WEBHOOK_SECRET_TOKEN if secret_token is None else secret_token).encode()
+
+    async def webhook(headers, body):
+        if not secret_matches(headers, expected_secret):
+            logger.warning("Отклонен запрос вебхука с неверным секретным токеном.")
+            return 403, "text/plain", b"forbidden"
+        try:
+            update = Update.de_json(json.loads(body), application.bot)
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Некорректное обновление в вебхуке: {e}")
+            return 400, "text/plain", b"bad request"
+        await application.update_queue.put(update) # Обработка идет отдельно, Telegram получает ответ сразу
+        return 200, "text/plain", b"ok"
+
+    async def health(headers, body):
+        status = {
+            "status": "ok" if application.running else "starting",
+            "mode": f"worker {WORKER_INDEX}" if WORKER_INDEX >= 0 else "webhook",
+            "update_queue": application.update_queue.qsize(),
+            "admin_outbox": admin_outbox.stats(),
+            "updates": update_processor.stats(),
+        }
+        return 200, "application/json", json.dumps(status).encode()
+
+    listener.route("POST", path or WEBHOOK_PATH, webhook)
+    listener.route("GET", HEALTH_PATH, health)
+    return listener
+
+metrics_listener = None
+
+async def metrics_endpoint(headers, body):
+    return 200, "text/plain; version=0.0.4; charset=utf-8", metrics.render().encode()
+
+async def start_metrics_listener(host=None, port=None) -> HttpListener | None:
+    """Поднимает локальный HTTP-сервер с METRICS_PATH (формат Prometheus)."""
+    global metrics_listener
+    listener = HttpListener(host or METRICS_HOST, METRICS_PORT if port is None else port)
+    listener.route("GET", METRICS_PATH, metrics_endpoint)
+    try:
+        await listener.start()
+    except OSError as e:
+        logger.error(f"Не удалось запустить сервер метрик на {listener.host}:{listener.port}: {e}")
+        return None
+    metrics_listener = listener
+    return listener
+
+async def stop_metrics_listener():
+    global metrics_listener
+    if metrics_listener is not None:
+        await metrics_listener.stop()
+        metrics_listener = None
+
+def stop_event_on_signals() -> asyncio.Event:
+    """Событие, которое выставляется по SIGINT/SIGTERM."""
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except (NotImplementedError, RuntimeError):
+            pass # Windows: остановка по KeyboardInterrupt
+    return stop_event
+
+async def serve_application(application: Application, listener: HttpListener, before_start=None) -> None:
+    """Запускает Application без Updater: обновления приходят в listener. Работает до сигнала остановки."""
+    stop_event = stop_event_on_signals()
+    await application.initialize()
+    try:
+        if application.post_init:
+            await application.post_init(application)
+        if before_start is not None:
+            await before_start()
+        await application.start()
+        await listener.start()
+        try:
+            await stop_event.wait()
+        except asyncio.CancelledError:
+            pass
+        await listener.stop()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+    finally:
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+async def run_webhook(application: Application) -> None:
+    """Запускает бота в режиме вебхука: регистрирует вебхук в Telegram и слушает HTTP до сигнала остановки."""
+    if not WEBHOOK_URL:
+        raise ValueError("Для BOT_MODE=webhook нужно задать WEBHOOK_URL")
+
+    async def register_webhook():
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET_TOKEN or None,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=Update.ALL_TYPES
+        )
+        logger.info(f"Вебхук зарегистрирован: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+
+    await serve_application(application, create_webhook_listener(application), register_webhook)
+
+async def run_worker(application: Application) -> None:
+    """Процесс-воркер режима WORKERS: принимает обновления от фронта на 127.0.0.1 и обрабатывает их как обычно."""
+    listener = create_webhook_listener(application, host="127.0.0.1", port=WORKER_BASE_PORT + WORKER_INDEX,
+                                       path=WORKER_UPDATE_PATH, secret_token=WORKER_SECRET)
+    await serve_application(application, listener)
+
+# --- Параллельная обработка обновлений ---
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает обновления разных чатов параллельно, а обновления одного чата - по одному
+    и в порядке поступления. Так медленная отправка видео в админ-чат или большая запись на диск
+    не задерживают остальных гостей, а переходы состояний ConversationHandler внутри чата
+    остаются такими же, как при последовательной обработке.
+    Обновления без чата (inline-запросы и т.п.) упорядочиваются по пользователю.
+    """
+
+    # Семафор базового класса не должен ждать: обновление, стоящее в нем, еще не заняло место
+    # в очереди своего чата и могло бы обогнать более раннее обновление того же чата.
+    # Общий лимит поэтому проверяется своим семафором - уже после очереди чата.
+    _UNBOUNDED = 2 ** 30
+
+    def __init__(self, max_concurrent_updates: int):
+        self._limit = max_concurrent_updates # До super().__init__: базовый класс проверяет max_concurrent_updates
+        super().__init__(self._UNBOUNDED)
+        self._running = None # asyncio.Semaphore, создается в initialize() в цикле событий приложения
+        self._chats = {} # ключ чата -> [asyncio.Lock, сколько обновлений чата в работе и в ожидании]
+        self.running = 0
+        self.processed = 0
+
+    @property
+    def max_concurrent_updates(self) -> int:
+        return self._limit
+
+    @property
+    def waiting(self) -> int:
+        """Обновления, ожидающие своей очереди в чате или свободного места."""
+        return sum(entry[1] for entry in self._chats.values()) - self.running
+
+    def stats(self) -> dict:
+        return {"limit": self._limit, "running": self.running, "waiting": self.waiting,
+                "chats": len(self._chats), "processed": self.processed}
+
+    async def initialize(self) -> None:
+        self._running = asyncio.Semaphore(self._limit)
+        self._chats.clear()
+
+    async def shutdown(self) -> None:
+        pass
+
+    @staticmethod
+    def ordering_key(update: object):
+        if isinstance(update, Update):
+            if update.effective_chat is not None:
+                return update.effective_chat.id
+            if update.effective_user is not None:
+                return update.effective_user.id
+        return None
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        key = self.ordering_key(update)
+        entry = None
+        if key is not None:
+            entry = self._chats.get(key)
+            if entry is None:
+                entry = self._chats[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+        started = False
+        try:
+            # Lock в asyncio выдается строго по очереди ожидания, а до этой точки нет ни одного await,
+            # поэтому обновления чата проходят в том порядке, в котором Application создал для них задачи
+            async with entry[0] if entry is not None else contextlib.nullcontext():
+                async with self._running:
+                    self.running += 1
+                    started = True
+                    try:
+                        await coroutine
+                    finally:
+                        self.running -= 1
+                        self.processed += 1
+        finally:
+            if not started:
+                coroutine.close() # Отменено в ожидании очереди: корутина обработки так и не запускалась
+            if entry is not None:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._chats[key]
+
+update_processor = ChatOrderedUpdateProcessor(max(1, UPDATE_CONCURRENCY))
+
+# --- Фронт режима WORKERS: прием обновлений и раздача воркерам ---
+
+_ADMIN_END_CHAT_RE = re.compile(r"^admin_end_chat_(\d+)$")
+
+def _guest_in_admin_update(body: dict) -> int | None:
+    """ID гостя, которого касается действие в админ-чате, если он виден из самого обновления."""
+    match = _ADMIN_END_CHAT_RE.match(body.get("data") or "")
+    if match:
+        return int(match.group(1))
+    text = body.get("text") or ""
+    if text.startswith("/reply"):
+        args = text.split()
+        return int(args[1]) if len(args) > 1 and args[1].isdigit() else None
+    replied = body.get("reply_to_message") or {}
+    # Сообщения живого чата несут кнопку "Завершить этот чат" с ID гостя
+    for row in (replied.get("reply_markup") or {}).get("inline_keyboard", []):
+        for button in row:
+            match = _ADMIN_END_CHAT_RE.match(button.get("callback_data") or "")
+            if match:
+                return int(match.group(1))
+    return extract_user_id_from_text(replied.get("text") or replied.get("caption") or "")
+
+def shard_for_update(payload: dict) -> int | None:
+    """
+    Номер воркера для обновления (payload - JSON от Telegram); None - разослать всем воркерам.
+    Гости распределяются по from.id. Действие в админ-чате уходит воркеру гостя, которого оно касается.
+    Если гостя по самому обновлению не определить (ответ на фото без подписи, сообщение в теме форума),
+    его знает только таблица маршрутов воркера-владельца: такое обновление получают все воркеры,
+    а обрабатывает только владелец. Остальное из админ-чата (команды, загрузка меню) - воркеру 0.
+    """
+    body = next((value for key, value in payload.items() if key != "update_id" and isinstance(value, dict)), {})
+    chat = body.get("chat") or (body.get("message") or {}).get("chat") or {}
+    if chat.get("id") == ADMIN_CHAT_ID:
+        guest_id = _guest_in_admin_update(body)
+        if guest_id is not None:
+            return shard_ring.owner(guest_id)
+        replied = body.get("reply_to_message") or {}
+        if body.get("is_topic_message") or (replied.get("from") or {}).get("is_bot"):
+            return None
+        return 0
+    user = body.get("from") or body.get("user") or chat
+    return shard_ring.owner(user["id"]) if "id" in user else 0
+
+class WorkerLink:
+    """
+    Связь фронта с одним воркером: процесс, очередь обновлений и одна задача отправки,
+    поэтому обновления одного гостя приходят в воркер в том же порядке, что и во фронт.
+    """
+    RETRY_DELAY = 1.0
+
+    def __init__(self, index: int, secret: str):
+        self.index = index
+        self.secret = secret
+        self.url = f"http://127.0.0.1:{WORKER_BASE_PORT + index}"
+        self.queue = asyncio.Queue()
+        self.process = None
+        self.forwarded = 0
+        self.restarts = 0
+
+    def stats(self) -> dict:
+        return {"worker": self.index, "alive": self.process is not None and self.process.poll() is None,
+                "queue": self.queue.qsize(), "forwarded": self.forwarded, "restarts": self.restarts}
+
+    def spawn(self):
+        env = dict(os.environ, BOTBAO_WORKER_INDEX=str(self.index), BOTBAO_WORKER_SECRET=self.secret)
+        # Своя группа процессов: Ctrl+C в терминале получает только фронт, воркеров он останавливает сам
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env, start_new_session=True)
+        logger.info(f"Воркер {self.index} запущен (pid {self.process.pid}, порт {WORKER_BASE_PORT + self.index}).")
+
+    async def wait_ready(self, client, timeout: float = 60):
+        deadline = _time.monotonic() + timeout
+        while _time.monotonic() < deadline:
+            try:
+                if (await client.get(self.url + HEALTH_PATH)).status_code == 200:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+        raise RuntimeError(f"Воркер {self.index} не ответил за {timeout} с")
+
+    async def supervise(self):
+        """Перезапускает воркер, если его процесс завершился."""
+        while True:
+            await asyncio.sleep(self.RETRY_DELAY)
+            code = self.process.poll()
+            if code is not None:
+                logger.error(f"Воркер {self.index} завершился с кодом {code}, перезапуск.")
+                self.restarts += 1
+                self.spawn()
+
+    async def forward(self, client):
+        headers = {"X-Telegram-Bot-Api-Secret-Token": self.secret, "Content-Type": "application/json"}
+        while True:
+            body = await self.queue.get()
+            while True:
+                try:
+                    response = await client.post(self.url + WORKER_UPDATE_PATH, content=body, headers=headers)
+                except httpx.HTTPError as e:
+                    logger.warning(f"Воркер {self.index} недоступен ({e!r}), повтор через {self.RETRY_DELAY} с.")
+                else:
+                    if response.status_code == 200:
+                        break
+                    if response.status_code == 400:
+                        logger.error(f"Воркер {self.index} отклонил некорректное обновление: {body[:200]!r}")
+                        break
+                    logger.warning(f"Воркер {self.index} ответил {response.status_code}, повтор.")
+                await asyncio.sleep(self.RETRY_DELAY)
+            self.forwarded += 1
+            self.queue.task_done()
+
+    async def stop(self, timeout: float = 30):
+        """SIGTERM: воркер завершает обработку и сохраняет данные, как обычный бот при остановке."""
+        if self.process is None or self.process.poll() is not None:
+            return
+        self.process.terminate()
+        try:
+            await asyncio.to_thread(self.process.wait, timeout)
+        except subprocess.TimeoutExpired:
+            logger.error(f"Воркер {self.index} не остановился за {timeout} с, завершаем принудительно.")
+            self.process.kill()
+
+async def _front_polling(client, api_url: str, dispatch) -> None:
+    """Long polling getUpdates без разбора обновлений в объекты PTB: фронту нужен только JSON."""
+    offset = 0
+    while True:
+        try:
+            response = await client.post(api_url + "getUpdates", timeout=60,
+                                         json={"offset": offset, "timeout": 30, "allowed_updates": Update.ALL_TYPES})
+            result = response.json()
+        except (httpx.HTTPError, ValueError) as e:
+            logger.warning(f"Ошибка getUpdates: {e!r}")
+            await asyncio.sleep(1)
+            continue
+        if not result.get("ok"):
+            logger.error(f"getUpdates: {result.get('description')}")
+            await asyncio.sleep((result.get("parameters") or {}).get("retry_after", 1))
+            continue
+        for payload in result["result"]:
+            dispatch(payload, json.dumps(payload, ensure_ascii=False).encode())
+            offset = payload["update_id"] + 1
+
+def _front_webhook_listener(links, dispatch) -> HttpListener:
+    listener = HttpListener(WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_MAX_CONNECTIONS)
+    expected_secret = WEBHOOK_SECRET_TOKEN.encode()
+
+    async def webhook(headers, body):
+        if not secret_matches(headers, expected_secret):
+            logger.warning("Отклонен запрос вебхука с неверным секретным токеном.")
+            return 403, "text/plain", b"forbidden"
+        try:
+            payload = json.loads(body)
+        except ValueError:
+            payload = None
+        if not isinstance(payload, dict):
+            logger.warning("Некорректное обновление в вебхуке.")
+            return 400, "text/plain", b"bad request"
+        dispatch(payload, body) # Тело пересылается воркеру как есть
+        return 200, "text/plain", b"ok"
+
+    async def health(headers, body):
+        status = {"status": "ok", "mode": "front", "workers": [link.stats() for link in links]}
+        return 200, "application/json", json.dumps(status).encode()
+
+    listener.route("POST", WEBHOOK_PATH, webhook)
+    listener.route("GET", HEALTH_PATH, health)
+    return listener
+
+async def run_front() -> None:
+    """
+    Фронт режима WORKERS: запускает воркеров, получает обновления (polling или webhook)
+    и раздает их по shard_for_update. Сам обработчиков не выполняет.
+    """
+    if STORAGE_BACKEND != "sqlite":
+        raise ValueError("Режиму WORKERS нужен STORAGE_BACKEND=sqlite: воркеры пишут общие данные в одну базу по ключам")
+    if BOT_MODE == "webhook" and not WEBHOOK_URL:
+        raise ValueError("Для BOT_MODE=webhook нужно задать WEBHOOK_URL")
+    links = [WorkerLink(index, secrets.token_hex(16)) for index in range(WORKERS)]
+    api_url = f"{TELEGRAM_API_URL or 'https://api.telegram.org'}/bot{BOT_TOKEN}/"
+    stop_event = stop_event_on_signals()
+
+    def dispatch(payload: dict, body: bytes):
+        shard = shard_for_update(payload)
+        if shard is None:
+            body = json.dumps({**payload, WORKER_BROADCAST_FIELD: True}, ensure_ascii=False).encode()
+            for link in links:
+                link.queue.put_nowait(body)
+        else:
+            links[shard].queue.put_nowait(body)
+
+    tasks = []
+    try:
+        async with httpx.AsyncClient(timeout=10) as client:
+            for link in links:
+                link.spawn()
+            await asyncio.gather(*(link.wait_ready(client) for link in links))
+            tasks = [asyncio.create_task(job) for link in links for job in (link.forward(client), link.supervise())]
+
+            if BOT_MODE == "webhook":
+                listener = _front_webhook_listener(links, dispatch)
+                await listener.start()
+                await client.post(api_url + "setWebhook", json={
+                    "url": WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH, "secret_token": WEBHOOK_SECRET_TOKEN or None,
+                    "max_connections": WEBHOOK_MAX_CONNECTIONS, "allowed_updates": Update.ALL_TYPES,
+                })
+                logger.info(f"Фронт: вебхук зарегистрирован, воркеров {WORKERS}.")
+                await stop_event.wait()
+                await listener.stop()
+            else:
+                await client.post(api_url + "deleteWebhook")
+                receiver = asyncio.create_task(_front_polling(client, api_url, dispatch))
+                logger.info(f"Фронт: получение обновлений (polling), воркеров {WORKERS}.")
+                await stop_event.wait()
+                receiver.cancel()
+
+            # Все принятые обновления отдаем воркерам до их остановки
+            try:
+                await asyncio.wait_for(asyncio.gather(*(link.queue.join() for link in links)), 30)
+            except asyncio.TimeoutError:
+                logger.error(f"Не все обновления переданы воркерам: {[link.queue.qsize() for link in links]}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*(link.stop() for link in links))
+        logger.info("Фронт и воркеры остановлены.")
+
 # --- Главная функция бота ---
 
-def main() -> None:
-    """Запускает бота."""
-    application = Application.builder().token(BOT_TOKEN).build()
+def build_application(request=None, get_updates_request=None) -> Application:
+    """Собирает Application со всеми обработчиками и задачами (request - для подмены сетевого слоя)."""
+    builder = Application.builder().token(BOT_TOKEN).post_init(on_startup).post_stop(on_stop).post_shutdown(on_shutdown)
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(f"{TELEGRAM_API_URL}/bot").base_file_url(f"{TELEGRAM_API_URL}/file/bot")
+    builder = builder.persistence(DeltaLogPersistence(PERSISTENCE_DIR, PERSISTENCE_UPDATE_INTERVAL, PERSISTENCE_COMPACT_EVERY))
+    # По умолчанию - HTTPXRequest с метриками (параметры пула как у ApplicationBuilder)
+    builder = builder.request(request if request is not None else InstrumentedRequest(connection_pool_size=256))
+    builder = builder.get_updates_request(get_updates_request if get_updates_request is not None else InstrumentedRequest())
+    # При UPDATE_CONCURRENCY=1 Application обрабатывает обновления последовательно, как раньше
+    builder = builder.concurrent_updates(update_processor)
+    application = builder.build()
+
+    application.job_queue.run_repeating(flush_users_job, interval=USERS_FLUSH_INTERVAL, first=USERS_FLUSH_INTERVAL)
+    application.job_queue.run_repeating(flush_stats_job, interval=STATS_FLUSH_INTERVAL, first=STATS_FLUSH_INTERVAL)
+    if LIVE_CHAT_IDLE_TTL > 0:
+        application.job_queue.run_repeating(expire_idle_live_chats_job, interval=LIVE_CHAT_SWEEP_INTERVAL, first=LIVE_CHAT_SWEEP_INTERVAL)
+    if CONTENT_RELOAD_INTERVAL > 0:
+        application.job_queue.run_repeating(watch_content_files_job, interval=CONTENT_RELOAD_INTERVAL, first=CONTENT_RELOAD_INTERVAL)
+
+    # Загрузка нового menu.json / faq.json документом в админ-чат (раньше остальных обработчиков)
+    application.add_handler(MessageHandler(
+        filters.Chat(ADMIN_CHAT_ID) & filters.Document.FileExtension("json"),
+        upload_content_file
+    ))
 
     # ConversationHandler для меню
     menu_conv_handler = ConversationHandler(
@@ -1484,7 +4991,8 @@ def main() -> None:
     faq_conv_handler = ConversationHandler(
         entry_points=[CallbackQueryHandler(show_faq_questions, pattern="^faq$")],
         states={
-            FAQ_QUESTION: [CallbackQueryHandler(show_faq_answer, pattern="^faq_q_")]
+            FAQ_QUESTION: [CallbackQueryHandler(show_faq_answer, pattern="^faq_q_"),
+                           CallbackQueryHandler(show_faq_questions, pattern="^faq$")] # Кнопка "К вопросам" под ответом
         },
         fallbacks=[CallbackQueryHandler(send_main_menu, pattern="^start$"),
                    CommandHandler("start", start)]
@@ -1502,7 +5010,9 @@ def main() -> None:
                    MessageHandler(filters.TEXT & ~filters.COMMAND, cancel_conversation),
                    CallbackQueryHandler(send_main_menu, pattern="^start$"),
                    CommandHandler("start", start)],
-        allow_reentry=True
+        allow_reentry=True,
+        name="review",
+        persistent=True
     )
     application.add_handler(review_conversation)
 
@@ -1516,12 +5026,16 @@ def main() -> None:
         fallbacks=[CommandHandler("cancel", cancel_conversation),
                    MessageHandler(filters.TEXT & ~filters.COMMAND, cancel_conversation),
                    CallbackQueryHandler(send_main_menu, pattern="^start$"),
-                   CommandHandler("start", start)]
+                   CommandHandler("start", start)],
+        name="problem",
+        persistent=True
     )
     application.add_handler(problem_conversation)
 
     application.add_handler(MessageHandler(
-        filters.TEXT & filters.Chat(ADMIN_CHAT_ID) & ~filters.COMMAND,
+        # Текстовые ответы, а в темах форума - любые сообщения админа (медиа копируется гостю)
+        filters.Chat(ADMIN_CHAT_ID) & ~filters.COMMAND & ~filters.StatusUpdate.ALL
+        & (filters.TEXT | filters.IS_TOPIC_MESSAGE),
         handle_admin_reply
     ))
 
@@ -1530,13 +5044,16 @@ def main() -> None:
         entry_points=[CallbackQueryHandler(start_live_chat, pattern="^support$")],
         states={
             LIVE_CHAT_USER: [
-                MessageHandler(filters.ALL & ~filters.COMMAND & ~filters.Chat(ADMIN_CHAT_ID), handle_user_message_in_chat),
+                MessageHandler(filters.ALL & ~filters.COMMAND & ~filters.Chat(ADMIN_CHAT_ID) & live_chat_active, handle_user_message_in_chat),
                 CallbackQueryHandler(end_live_chat, pattern="^end_chat$")
             ]
         },
         fallbacks=[CommandHandler("cancel", end_live_chat), # Пользователь может завершить чат командой /cancel
                    CallbackQueryHandler(send_main_menu, pattern="^start$"),
-                   CommandHandler("start", start)]
+                   CommandHandler("start", start)],
+        name="live_chat",
+        persistent=True,
+        allow_reentry=True # Кнопка "Связаться" работает и после закрытия чата по неактивности или админом
     )
     application.add_handler(live_chat_conv_handler)
 
@@ -1547,7 +5064,7 @@ def main() -> None:
         ],
         states={
             ASK_DATE: [CallbackQueryHandler(calendar_callback_handler, pattern="^(date_|month_|start|ignore)")], # Календарь
-            ASK_TIME:  [CallbackQueryHandler(process_time_selection, pattern="^time_.*|cancel_reserve$")], # Выбор времени и отмена
+            ASK_TIME:  [CallbackQueryHandler(process_time_selection, pattern="^(time_.*|slot_full|cancel_reserve)$")], # Выбор времени и отмена
             ASK_GUESTS: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_guests)],
             ASK_NAME: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_name)],
             ASK_PHONE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_phone)],
@@ -1562,6 +5079,8 @@ def main() -> None:
         ],
         per_user=True,
         allow_reentry=True, # Позволяет пользователю начать новый разговор, даже если предыдущий не был завершен
+        name="reservation", # Незавершенные бронирования переживают перезапуск (DeltaLogPersistence)
+        persistent=True,
     )
     application.add_handler(reservation_conversation)
 
@@ -1575,6 +5094,10 @@ def main() -> None:
     application.add_handler(CommandHandler("order", make_order_command))     # Добавляем новый обработчик
     application.add_handler(CommandHandler("reserve", start_reservation))
     application.add_handler(CommandHandler("help", help_command))
+    application.add_handler(CommandHandler("mybookings", show_my_reservations))
+    application.add_handler(CallbackQueryHandler(show_my_reservations, pattern="^my_reservations$"))
+    application.add_handler(CallbackQueryHandler(ask_cancel_my_reservation, pattern="^resv_ask_"))
+    application.add_handler(CallbackQueryHandler(cancel_my_reservation, pattern="^resv_cancel_"))
 
 
 
@@ -1582,6 +5105,10 @@ def main() -> None:
     application.add_handler(CallbackQueryHandler(send_main_menu, pattern="^start$"))
     # Команда для админов, чтобы отвечать пользователям
     application.add_handler(CommandHandler("reply", reply_to_user))
+    application.add_handler(CommandHandler("profile", profile_command))
+    application.add_handler(CommandHandler("agenda", agenda_command))
+    application.add_handler(CommandHandler("guest", guest_command))
+    application.add_handler(CommandHandler("stats", stats_command))
     # Обработчик для кнопки "Завершить этот чат" для админа
     application.add_handler(CallbackQueryHandler(admin_end_chat, pattern="^admin_end_chat_"))
 
@@ -1595,11 +5122,50 @@ def main() -> None:
     # Бот просто будет их игнорировать, если не добавлены специфические обработчики
     application.add_handler(MessageHandler(filters.ALL & ~filters.COMMAND & ~filters.TEXT, lambda u, c: None))
 
-    logger.info("Бот запускается...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    instrument_handlers(application)
+    application.add_handler(TypeHandler(Update, count_update), group=-2)
+    application.add_handler(TypeHandler(Update, update_profiler.before_update), group=-1)
+    application.add_handler(TypeHandler(Update, update_profiler.after_update), group=PROFILE_POST_GROUP)
+    return application
+
+def main() -> None:
+    """Запускает бота."""
+    if not BOT_TOKEN or not ADMIN_CHAT_ID:
+        raise ValueError("Нужно задать переменные окружения BOT_TOKEN и ADMIN_CHAT_ID")
+    if WORKERS > 0 and WORKER_INDEX < 0:
+        logger.info(f"Бот запускается: фронт (режим {BOT_MODE}) и {WORKERS} воркеров...")
+        asyncio.run(run_front())
+        return
+    application = build_application()
+    if WORKER_INDEX >= 0:
+        logger.info(f"Воркер {WORKER_INDEX} из {WORKERS} запускается...")
+        asyncio.run(run_worker(application))
+        return
+
+    logger.info(f"Бот запускается (режим {BOT_MODE})...")
+    if BOT_MODE == "webhook":
+        asyncio.run(run_webhook(application))
+    elif BOT_MODE == "polling":
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    else:
+        raise ValueError(f"Неизвестный BOT_MODE={BOT_MODE!r} (допустимо: polling, webhook)")
+
 
+_MODULE_IMPORT_FINISHED = _time.perf_counter()
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate-to-sqlite":
+        # Однократный перенос: python botbao.py migrate-to-sqlite [путь_к_базе]
+        try:
+            migrate_json_to_sqlite(sys.argv[2] if len(sys.argv) > 2 else None)
+        except ValueError as e:
+            logger.error(f"Перенос в SQLite не выполнен: {e}")
+            sys.exit(1)
+        sys.exit(0)
+    if len(sys.argv) > 1 and sys.argv[1] == "rebuild-stats":
+        # Однократный пересчет счетчиков /stats по накопленным данным: python botbao.py rebuild-stats
+        rebuild_stats_rollups()
+        sys.exit(0)
     try:
         logger.info("Попытка запуска бота...")
         main()
@@ -0,0 +1,378 @@
+"""
+Локальный поддельный сервер Bot API для нагрузочных проверок без сети.
+
+Реализует методы, которыми пользуется бот: getMe, getUpdates, setWebhook, deleteWebhook,
+sendMessage, sendPhoto, sendVideo, sendVoice, sendDocument, editMessageText,
+editMessageReplyMarkup, answerCallbackQuery (и createForumTopic, getFile для режима тем).
+
+Сервер сам играет гостей: каждый гость проходит случайный сценарий (/start, меню, FAQ,
+бронирование, отзыв с фото, проблема с видео, живой чат), ждет ответа бота и делает паузу
+"на подумать". Кнопки нажимаются по клавиатурам, которые бот действительно прислал, поэтому
+версии меню, даты календаря и слоты времени всегда актуальны. Админ-чат отвечает реплаем на
+часть сообщений бота. Можно добавить задержку ответа API, RetryAfter (429) и ошибки 500.
+
+Режимы бота:
+  polling - обновления отдаются через getUpdates (long polling);
+  webhook - если бот вызвал setWebhook, обновления отправляются POST-запросом на его URL
+            с секретным токеном из setWebhook.
+
+Пример (polling):
+  python tools/fake_telegram_server.py --port 8081 --guests 200 --duration 60 --seed-dir .
+  TELEGRAM_API_URL=http://127.0.0.1:8081 BOT_TOKEN=123456:fake ADMIN_CHAT_ID=-1000000000000 python botbao.py
+
+В конце печатаются пропускная способность и p50/p95/p99 времени ответа бота гостю.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import sys
+import time
+from collections import Counter
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from botbao import HttpListener # Тот же минимальный HTTP-сервер, что и у вебхука бота
+
+BOT_USER = {"id": 100000001, "is_bot": True, "first_name": "BAO", "username": "bao_fake_bot"}
+ADMIN_USER = {"id": 700000001, "is_bot": False, "first_name": "Менеджер"}
+FIRST_GUEST_ID = 600_000_000
+ADMIN_REPLY_MARK = "💬 *Ответ службы заботы:*" # Так бот пересылает гостю ответ админа
+
+MESSAGE_METHODS = ("sendMessage", "sendPhoto", "sendVideo", "sendVoice", "sendDocument",
+                   "editMessageText", "editMessageReplyMarkup")
+OTHER_METHODS = ("getMe", "getUpdates", "setWebhook", "deleteWebhook", "getWebhookInfo", "answerCallbackQuery",
+                 "createForumTopic", "getFile", "setMyCommands", "sendChatAction", "close", "logOut")
+
+# Шаги сценариев: ("text", текст) | ("click", регулярное выражение для callback_data) | ("photo"/"video", подпись)
+SCENARIOS = {
+    "start": [("text", "/start")],
+    "menu": [("text", "/start"), ("click", r"^menu$"), ("click", r"^menu_cat_"), ("click", r"^menu$"),
+             ("click", r"^menu_cat_"), ("click", r"^start$")],
+    "faq": [("text", "/start"), ("click", r"^faq$"), ("click", r"^faq_q_"), ("click", r"^faq$"), ("click", r"^faq_q_")],
+    "reservation": [("text", "/reserve"), ("click", r"^date_"), ("click", r"^time_"), ("text", "4"),
+                    ("text", "Анна"), ("text", "+79991234567"), ("text", "нет пожеланий"), ("click", r"^confirm_reserve$")],
+    "review": [("text", "/review"), ("photo", "Очень вкусно, спасибо!")],
+    "problem": [("text", "/problem"), ("video", "Долго несли заказ")],
+    "live_chat": [("text", "/start"), ("click", r"^support$"), ("text", "Здравствуйте!"),
+                  ("text", "Можно забронировать на 8 человек?"), ("photo", "Вот наш прошлый стол"),
+                  ("click", r"^end_chat$")],
+}
+DEFAULT_WEIGHTS = {"start": 2, "menu": 4, "faq": 2, "reservation": 3, "review": 1, "problem": 1, "live_chat": 2}
+
+
+def seed_bot_data(bot_dir):
+    """Кладет пример меню и FAQ в data/ рабочей папки бота, если их там нет (иначе сценарии menu/faq нечего нажимать)."""
+    data_dir = os.path.join(bot_dir, "data")
+    os.makedirs(data_dir, exist_ok=True)
+    samples = {
+        "menu.json": {f"Категория {c}": [{"name": f"Блюдо {c}.{i}", "description": "Рис, овощи, соус терияки (300 г)",
+                                          "price": 450 + 10 * i} for i in range(6)] for c in range(5)},
+        "faq.json": {"Вопросы": [{"question": f"Вопрос {i}?", "answer": f"Ответ на вопрос {i}: *да*, конечно."} for i in range(8)]},
+    }
+    for filename, data in samples.items():
+        filepath = os.path.join(data_dir, filename)
+        if not os.path.exists(filepath):
+            with open(filepath, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=4)
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))]
+
+
+class FakeTelegram:
+    """Состояние поддельного Telegram: очередь обновлений, последние клавиатуры, статистика."""
+
+    def __init__(self, args):
+        self.args = args
+        self.admin_chat_id = args.admin_chat_id
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self.pending = [] # Обновления для getUpdates
+        self._new_updates = asyncio.Event()
+        self.webhook_url = None
+        self.webhook_secret = ""
+        self.keyboards = {} # chat_id -> (message_id, [callback_data])
+        self._responses = {} # chat_id -> asyncio.Event (бот что-то отправил в этот чат)
+        self.latencies = []
+        self.api_calls = 0
+        self.injected = {"retry_after": 0, "error": 0}
+        self.updates_sent = 0
+        self.scenarios_done = 0
+        self.scenarios_failed = 0
+        self.admin_replies = 0
+        self.admin_replies_delivered = 0
+        self.failures = Counter() # "сценарий: шаг N (причина)" -> сколько раз
+
+    # --- Bot API ---
+
+    def route(self, listener: HttpListener):
+        for method in MESSAGE_METHODS + OTHER_METHODS:
+            listener.route("POST", f"/bot{self.args.token}/{method}", self._handler(method))
+
+    def _handler(self, method):
+        async def handler(headers, body):
+            self.api_calls += 1
+            if self.args.latency_ms:
+                await asyncio.sleep(random.expovariate(1000 / self.args.latency_ms))
+            if method not in ("getUpdates", "getMe", "deleteWebhook", "setWebhook"):
+                if random.random() < self.args.retry_after_rate:
+                    self.injected["retry_after"] += 1
+                    return self._reply(429, {"ok": False, "error_code": 429, "description": "Too Many Requests: retry after",
+                                             "parameters": {"retry_after": self.args.retry_after}})
+                if random.random() < self.args.error_rate:
+                    self.injected["error"] += 1
+                    return self._reply(500, {"ok": False, "error_code": 500, "description": "Internal Server Error"})
+            params = self._parse(headers, body)
+            result = await getattr(self, f"api_{method}", self._api_default)(method, params)
+            return self._reply(200, {"ok": True, "result": result})
+        return handler
+
+    @staticmethod
+    def _reply(status, payload):
+        return status, "application/json", json.dumps(payload, ensure_ascii=False).encode()
+
+    @staticmethod
+    def _parse(headers, body):
+        content_type = headers.get("content-type", "")
+        if content_type.startswith("application/json"):
+            return json.loads(body or b"{}")
+        params = {}
+        if content_type.startswith("application/x-www-form-urlencoded"):
+            for key, values in parse_qs(body.decode(), keep_blank_values=True).items():
+                value = values[-1]
+                # Не строковые параметры PTB кодирует в JSON
+                if key not in ("text", "caption") and value[:1] in '{["-0123456789tfn':
+                    try:
+                        value = json.loads(value)
+                    except ValueError:
+                        pass
+                params[key] = value
+        return params # multipart (загрузка файлов) бот не использует - параметры не нужны
+
+    async def _api_default(self, method, params):
+        return True
+
+    async def api_getMe(self, method, params):
+        return BOT_USER
+
+    async def api_setWebhook(self, method, params):
+        self.webhook_url = params.get("url")
+        self.webhook_secret = params.get("secret_token", "")
+        return True
+
+    async def api_deleteWebhook(self, method, params):
+        self.webhook_url = None
+        return True
+
+    async def api_getUpdates(self, method, params):
+        offset = int(params.get("offset") or 0)
+        self.pending = [update for update in self.pending if update["update_id"] >= offset]
+        if not self.pending:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self.pending[:int(params.get("limit") or 100)]
+
+    async def api_createForumTopic(self, method, params):
+        return {"message_thread_id": next(self._message_ids), "name": params.get("name", ""), "icon_color": 7322096}
+
+    async def api_getFile(self, method, params):
+        return {"file_id": params.get("file_id", ""), "file_unique_id": "fake", "file_path": "documents/file.json"}
+
+    async def _api_message(self, method, params):
+        chat_id = int(params.get("chat_id", 0))
+        message_id = int(params.get("message_id") or next(self._message_ids))
+        message = {"message_id": message_id, "date": int(time.time()), "from": BOT_USER,
+                   "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}}
+        for key in ("text", "caption", "message_thread_id"):
+            if key in params:
+                message[key] = params[key]
+        markup = params.get("reply_markup")
+        if isinstance(markup, dict) and "inline_keyboard" in markup:
+            message["reply_markup"] = markup # Как в Telegram: клавиатура видна и в reply_to_message ответа админа
+            buttons = [button["callback_data"] for row in markup["inline_keyboard"] for button in row if "callback_data" in button]
+            self.keyboards[chat_id] = (message_id, buttons)
+        if str(params.get("text", "")).startswith(ADMIN_REPLY_MARK):
+            # Ответ админа приходит гостю сам по себе и не считается ответом на текущий шаг сценария
+            self.admin_replies_delivered += 1
+        else:
+            self._bot_responded(chat_id)
+        if chat_id == self.admin_chat_id and method != "editMessageText" and random.random() < self.args.admin_reply_rate:
+            asyncio.get_running_loop().create_task(self._admin_reply(message))
+        return message
+
+    api_sendMessage = api_sendPhoto = api_sendVideo = api_sendVoice = api_sendDocument = _api_message
+    api_editMessageText = api_editMessageReplyMarkup = _api_message
+
+    # --- Доставка обновлений ---
+
+    def _bot_responded(self, chat_id):
+        event = self._responses.get(chat_id)
+        if event is not None:
+            event.set()
+
+    async def deliver(self, kind, payload):
+        update = {"update_id": next(self._update_ids), kind: payload}
+        self.updates_sent += 1
+        if self.webhook_url:
+            await self._post_webhook(update)
+        else:
+            self.pending.append(update)
+            self._new_updates.set()
+
+    async def _post_webhook(self, update):
+        match = re.match(r"https?://([^/:]+)(?::(\d+))?(/.*)?$", self.webhook_url)
+        host, port, path = match.group(1), int(match.group(2) or 80), match.group(3) or "/"
+        body = json.dumps(update, ensure_ascii=False).encode()
+        reader, writer = await asyncio.open_connection(host, port)
+        head = [f"POST {path} HTTP/1.1", f"Host: {host}", "Content-Type: application/json",
+                f"Content-Length: {len(body)}", "Connection: close"]
+        if self.webhook_secret:
+            head.append(f"X-Telegram-Bot-Api-Secret-Token: {self.webhook_secret}")
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode() + body)
+        await writer.drain()
+        await reader.read()
+        writer.close()
+
+    async def _admin_reply(self, bot_message):
+        self.admin_replies += 1
+        await asyncio.sleep(random.uniform(self.args.think_min, self.args.think_max))
+        await self.deliver("message", {
+            "message_id": next(self._message_ids), "date": int(time.time()), "from": ADMIN_USER,
+            "chat": {"id": self.admin_chat_id, "type": "supergroup", "title": "Админы"},
+            "text": "Здравствуйте! Уже смотрим, минуту.", "reply_to_message": bot_message,
+        })
+
+    # --- Гости ---
+
+    def _guest(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"Гость {user_id}", "username": f"guest{user_id}"}
+
+    async def _step(self, user_id, step):
+        kind, value = step
+        chat = {"id": user_id, "type": "private"}
+        base = {"message_id": next(self._message_ids), "date": int(time.time()), "chat": chat, "from": self._guest(user_id)}
+        if kind == "click":
+            message_id, buttons = self.keyboards.get(user_id, (0, []))
+            choices = [data for data in buttons if re.search(value, data)]
+            # Постоянные кнопки (menu, support, ...) можно нажать и без свежей клавиатуры
+            data = random.choice(choices) if choices else (value.strip("^$") if re.fullmatch(r"\^[a-z_]+\$", value) else None)
+            if data is None:
+                return False
+            await self.deliver("callback_query", {
+                "id": str(next(self._message_ids)), "chat_instance": str(user_id), "data": data, "from": self._guest(user_id),
+                "message": {"message_id": message_id, "date": int(time.time()), "chat": chat, "from": BOT_USER, "text": "..."},
+            })
+        elif kind == "text":
+            base["text"] = value
+            if value.startswith("/"):
+                base["entities"] = [{"type": "bot_command", "offset": 0, "length": len(value.split()[0])}]
+            await self.deliver("message", base)
+        elif kind == "photo":
+            base.update(caption=value, photo=[{"file_id": "fake-photo", "file_unique_id": "fake-photo", "width": 1280, "height": 960}])
+            await self.deliver("message", base)
+        elif kind == "video":
+            base.update(caption=value, video={"file_id": "fake-video", "file_unique_id": "fake-video",
+                                              "width": 1280, "height": 720, "duration": 12})
+            await self.deliver("message", base)
+        return True
+
+    async def run_guest(self, user_id, deadline, weights):
+        names, values = zip(*weights.items())
+        event = self._responses[user_id] = asyncio.Event()
+        while time.monotonic() < deadline:
+            scenario = random.choices(names, values)[0]
+            completed = True
+            for index, step in enumerate(SCENARIOS[scenario], 1):
+                event.clear()
+                started = time.perf_counter()
+                if not await self._step(user_id, step):
+                    completed = False
+                    self.failures[f"{scenario}: шаг {index} (нет кнопки {step[1]})"] += 1
+                    break
+                try:
+                    await asyncio.wait_for(event.wait(), self.args.response_timeout)
+                    self.latencies.append(time.perf_counter() - started)
+                except asyncio.TimeoutError:
+                    completed = False
+                    self.failures[f"{scenario}: шаг {index} (нет ответа)"] += 1
+                    break
+                await asyncio.sleep(random.uniform(self.args.think_min, self.args.think_max))
+            if completed:
+                self.scenarios_done += 1
+            else:
+                self.scenarios_failed += 1
+
+    def report(self, elapsed):
+        latencies = sorted(self.latencies)
+        print(f"Длительность {elapsed:.1f} с, гостей {self.args.guests}, режим {'webhook' if self.webhook_url else 'polling'}")
+        print(f"Обновлений отправлено: {self.updates_sent} ({self.updates_sent / elapsed:.1f}/с), "
+              f"вызовов Bot API: {self.api_calls} ({self.api_calls / elapsed:.1f}/с)")
+        print(f"Сценариев завершено: {self.scenarios_done}, прервано (нет ответа или кнопки): {self.scenarios_failed}")
+        print(f"Время ответа бота гостю: p50 {percentile(latencies, 0.5) * 1000:.1f} мс, "
+              f"p95 {percentile(latencies, 0.95) * 1000:.1f} мс, p99 {percentile(latencies, 0.99) * 1000:.1f} мс "
+              f"(ответов {len(latencies)})")
+        print(f"Ответов админа: {self.admin_replies}, доставлено гостям: {self.admin_replies_delivered}")
+        print(f"Внедрено: RetryAfter {self.injected['retry_after']}, ошибок 500 {self.injected['error']}")
+        for reason, count in self.failures.most_common(10):
+            print(f"  прервано на {reason}: {count}")
+
+
+async def serve(args):
+    fake = FakeTelegram(args)
+    listener = HttpListener(args.host, args.port)
+    fake.route(listener)
+    await listener.start()
+    print(f"Поддельный Bot API: http://{args.host}:{listener.port} (TELEGRAM_API_URL), токен {args.token}")
+
+    # Гости начинают, когда бот подключился (первый getUpdates или setWebhook)
+    while fake.api_calls == 0:
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(args.warmup)
+    weights = dict(DEFAULT_WEIGHTS)
+    if args.scenarios:
+        weights = {name: weights[name] for name in args.scenarios}
+    started = time.monotonic()
+    deadline = started + args.duration
+    await asyncio.gather(*(fake.run_guest(FIRST_GUEST_ID + i, deadline, weights) for i in range(args.guests)))
+    fake.report(time.monotonic() - started)
+    await listener.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--token", default="123456:fake", help="BOT_TOKEN, с которым запущен бот")
+    parser.add_argument("--admin-chat-id", type=int, default=-1000000000000, help="ADMIN_CHAT_ID бота")
+    parser.add_argument("--guests", type=int, default=50, help="сколько гостей действуют одновременно")
+    parser.add_argument("--duration", type=float, default=30, help="длительность нагрузки, сек")
+    parser.add_argument("--warmup", type=float, default=1.0, help="пауза после подключения бота, сек")
+    parser.add_argument("--scenarios", nargs="+", choices=sorted(SCENARIOS), help="только эти сценарии")
+    parser.add_argument("--think-min", type=float, default=0.2, help="минимальная пауза гостя между шагами, сек")
+    parser.add_argument("--think-max", type=float, default=1.0, help="максимальная пауза гостя между шагами, сек")
+    parser.add_argument("--response-timeout", type=float, default=10.0, help="сколько гость ждет ответа бота, сек")
+    parser.add_argument("--admin-reply-rate", type=float, default=0.3, help="доля сообщений в админ-чате, на которые отвечает админ")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="средняя задержка ответа Bot API, мс")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="доля вызовов, получающих 429 RetryAfter")
+    parser.add_argument("--retry-after", type=int, default=1, help="retry_after в ответе 429, сек")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля вызовов, получающих ошибку 500")
+    parser.add_argument("--seed-dir", help="рабочая папка бота: положить туда пример menu.json и faq.json, если их нет")
+    args = parser.parse_args()
+    if args.seed_dir:
+        seed_bot_data(args.seed_dir)
+    asyncio.run(serve(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""
+Замер времени холодного запуска бота без сети.
+
+Каждый замер выполняется в отдельном процессе: импорт botbao, сборка Application
+(build_application) и этап запуска post_init с офлайн-слоем Bot API. Результат
+каждого запуска бот сам дописывает в data/startup_metrics.jsonl; скрипт печатает
+медиану, чтобы сравнивать релизы.
+
+Запуск: python tools/measure_startup.py [число_замеров] [папка_с_данными]
+"""
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD_SCRIPT = """
+import asyncio, json, sys
+sys.path.insert(0, {repo!r})
+from tools.offline_bot import OfflineRequest, import_botbao, start_application, stop_application
+botbao = import_botbao({data_dir!r})
+application = botbao.build_application(request=OfflineRequest(), get_updates_request=OfflineRequest())
+async def run():
+    await start_application(application)
+    await stop_application(application)
+asyncio.run(run())
+print(json.dumps(botbao.startup_metrics))
+"""
+
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    data_dir = os.path.abspath(sys.argv[2]) if len(sys.argv) > 2 else tempfile.mkdtemp(prefix="botbao-startup-")
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", CHILD_SCRIPT.format(repo=REPO_DIR, data_dir=data_dir)],
+            check=True, capture_output=True, text=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    for key in ("import_seconds", "data_load_seconds", "total_seconds"):
+        values = [result[key] for result in results]
+        print(f"{key:18} медиана {statistics.median(values):.4f} с (мин {min(values):.4f}, макс {max(values):.4f})")
+    print(f"Журнал замеров: {os.path.join(data_dir, 'data', 'startup_metrics.jsonl')}")
+
+
+if __name__ == "__main__":
+    main()
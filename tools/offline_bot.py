@@ -0,0 +1,116 @@
+"""
+Офлайн-слой Bot API для локальных проверок и бенчмарков.
+
+OfflineRequest подменяет сетевой слой python-telegram-bot: запоминает каждый
+вызов метода Bot API и возвращает правдоподобный ответ, не обращаясь к Telegram.
+"""
+import asyncio
+import itertools
+import json
+import os
+import sys
+import tempfile
+import time
+
+from telegram.request import BaseRequest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+BOT_USER = {"id": 100000001, "is_bot": True, "first_name": "BAO", "username": "bao_test_bot"}
+
+# Методы, которые возвращают отправленное/измененное сообщение
+MESSAGE_METHODS = {
+    "sendMessage", "sendPhoto", "sendVideo", "sendVoice", "sendDocument",
+    "editMessageText", "editMessageCaption", "editMessageReplyMarkup",
+}
+
+
+def import_botbao(data_dir=None):
+    """
+    Импортирует botbao с тестовыми токеном и ID админ-чата.
+    Файлы данных создаются в data_dir (по умолчанию - во временной папке).
+    """
+    os.environ.setdefault("BOT_TOKEN", "123456:offline")
+    os.environ.setdefault("ADMIN_CHAT_ID", "-1000000000000")
+    os.chdir(data_dir or tempfile.mkdtemp(prefix="botbao-offline-"))
+    if REPO_DIR not in sys.path:
+        sys.path.insert(0, REPO_DIR)
+    import botbao
+    return botbao
+
+
+class OfflineRequest(BaseRequest):
+    """Запоминает вызовы Bot API и отвечает заготовленными результатами."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls = [] # [(метод, параметры)]
+        self._message_ids = itertools.count(1)
+        self._closed = False
+
+    async def initialize(self) -> None:
+        self._closed = False
+
+    async def shutdown(self) -> None:
+        # Как у HTTPXRequest: после shutdown() клиент закрыт и запросы не проходят
+        self._closed = True
+
+    def count(self, method: str) -> int:
+        return sum(1 for name, _ in self.calls if name == method)
+
+    def _result(self, method: str, params: dict):
+        if method == "getMe":
+            return BOT_USER
+        if method in MESSAGE_METHODS:
+            chat_id = int(params.get("chat_id", 0))
+            message = {
+                "message_id": int(params.get("message_id") or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+                "from": BOT_USER,
+            }
+            if "text" in params:
+                message["text"] = params["text"]
+            if "caption" in params:
+                message["caption"] = params["caption"]
+            if "message_thread_id" in params:
+                message["message_thread_id"] = int(params["message_thread_id"])
+            return message
+        if method == "copyMessage":
+            return {"message_id": next(self._message_ids)}
+        if method == "createForumTopic":
+            return {"message_thread_id": next(self._message_ids), "name": params.get("name", ""), "icon_color": 7322096}
+        if method == "getUpdates":
+            return []
+        if method == "getFile":
+            return {"file_id": params.get("file_id", ""), "file_unique_id": "offline", "file_path": "documents/file.json"}
+        return True
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        if self._closed:
+            raise RuntimeError("This HTTPXRequest is not initialized!")
+        api_method = url.rsplit("/", 1)[-1]
+        params = request_data.parameters if request_data is not None else {}
+        self.calls.append((api_method, params))
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return 200, json.dumps({"ok": True, "result": self._result(api_method, params)}).encode()
+
+
+async def start_application(application):
+    """Запускает Application так же, как run_polling/run_webhook, но без получения обновлений."""
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+
+
+async def stop_application(application):
+    """Останавливает Application в том же порядке, что и run_polling: stop, post_stop, shutdown, post_shutdown."""
+    await application.stop()
+    if application.post_stop:
+        await application.post_stop(application)
+    await application.shutdown()
+    if application.post_shutdown:
+        await application.post_shutdown(application)
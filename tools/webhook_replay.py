@@ -0,0 +1,85 @@
+"""
+Локальная проверка режима вебхука без Telegram.
+
+Поднимает тот же Application, что и main(), но с офлайн-слоем Bot API,
+запускает HTTP-сервер вебхука на свободном порту и отправляет в него записанные
+обновления (tools/recorded_updates.jsonl). Проверяет:
+  - /health отвечает 200;
+  - запрос с неверным секретным токеном отклоняется (403);
+  - каждое записанное обновление принимается (200) и обрабатывается ботом.
+
+Запуск: python tools/webhook_replay.py [файл_с_обновлениями.jsonl]
+"""
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("WEBHOOK_SECRET_TOKEN", "local-replay-secret")
+
+from tools.offline_bot import OfflineRequest, import_botbao, start_application, stop_application
+
+DEFAULT_UPDATES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "recorded_updates.jsonl")
+
+
+async def http_request(port, method, path, body=b"", headers=None):
+    """Отправляет один HTTP/1.1-запрос и возвращает (статус, тело)."""
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    lines = [f"{method} {path} HTTP/1.1", "Host: 127.0.0.1", f"Content-Length: {len(body)}", "Connection: close"]
+    lines += [f"{name}: {value}" for name, value in (headers or {}).items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode() + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b"\r\n\r\n")
+    return int(head.split()[1]), payload
+
+
+async def replay(updates_file):
+    # Импорт после настройки окружения: токен и ID админ-чата подставляются офлайн-значениями
+    botbao = import_botbao()
+    with open(updates_file, "r", encoding="utf-8") as f:
+        updates = [json.loads(line) for line in f if line.strip()]
+
+    request = OfflineRequest()
+    application = botbao.build_application(request=request, get_updates_request=OfflineRequest())
+    listener = botbao.create_webhook_listener(application, host="127.0.0.1", port=0)
+    secret_header = {"X-Telegram-Bot-Api-Secret-Token": botbao.WEBHOOK_SECRET_TOKEN}
+
+    await start_application(application)
+    await listener.start()
+    try:
+        status, payload = await http_request(listener.port, "GET", botbao.HEALTH_PATH)
+        assert status == 200, f"/health вернул {status}"
+        print(f"/health: {payload.decode()}")
+
+        status, _ = await http_request(listener.port, "POST", botbao.WEBHOOK_PATH, b"{}",
+                                       {"X-Telegram-Bot-Api-Secret-Token": "wrong"})
+        assert status == 403, f"Неверный секрет должен давать 403, получено {status}"
+        print("Неверный секретный токен: 403")
+
+        calls_before = len(request.calls)
+        for update in updates:
+            status, _ = await http_request(listener.port, "POST", botbao.WEBHOOK_PATH,
+                                           json.dumps(update).encode(), secret_header)
+            assert status == 200, f"Обновление {update['update_id']}: статус {status}"
+
+        # Ждем, пока очередь обновлений будет разобрана
+        while application.update_queue.qsize():
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.2)
+        api_calls = request.calls[calls_before:]
+    finally:
+        await listener.stop()
+        await stop_application(application)
+
+    print(f"Принято обновлений: {len(updates)}, вызовов Bot API в ответ: {len(api_calls)}")
+    for name, params in api_calls:
+        print(f"  {name} -> chat {params.get('chat_id', '-')}")
+    assert api_calls, "Бот не сделал ни одного вызова Bot API - обновления не обработаны"
+    print("OK")
+
+
+if __name__ == "__main__":
+    asyncio.run(replay(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_UPDATES_FILE))